@@ -0,0 +1,100 @@
+import sys
+import timeit
+import binascii
+from collections import OrderedDict
+
+from control import AcrTlv
+
+# Micro-benchmark of the byte level TLV parser against the hex string scanner
+# it replaced, on ACR1252 transparent session responses.
+#
+#   python3 bench_tlv.py [iterations]
+
+class LegacyTLV:
+    """
+    The previous hex string scanner from control.py, kept here as the baseline.
+    """
+
+    def __init__(self, tags):
+        self.tags = {}
+        for tag in tags:
+            self.tags[tag] = tag
+        self.tag_lengths = set()
+        for tag, tag_name in self.tags.items():
+            self.tag_lengths.add(len(tag))
+
+    def parse(self, tlv_string):
+        parsed_data = OrderedDict()
+        self.tlv_string = tlv_string
+
+        i = 0
+        while i < len(self.tlv_string):
+            tag_found = False
+
+            for tag_length in self.tag_lengths:
+                for tag, tag_name in self.tags.items():
+                    if self.tlv_string[i:i+tag_length] == tag:
+                        try:
+                            value_length = int(self.tlv_string[i+tag_length:i+tag_length+2], 16)
+                        except ValueError:
+                            raise ValueError('Parse error: tag ' + tag + ' has incorrect data length')
+
+                        value_start_position = i+tag_length+2
+                        value_end_position = i+tag_length+2+value_length*2
+
+                        if value_end_position > len(self.tlv_string):
+                            raise ValueError('Parse error: tag ' + tag + ' declared data of length ' + str(value_length))
+
+                        value = self.tlv_string[value_start_position:value_end_position]
+                        parsed_data[tag] = value
+
+                        i = value_end_position
+                        tag_found = True
+
+            if not tag_found:
+                raise ValueError('Unknown tag found')
+        return parsed_data
+
+
+# Status (C0) is always present; 92/96/97 come back from a transceive.
+RESPONSES = {
+    'session status': bytes.fromhex('c003009000'),
+    'timer': bytes.fromhex('c003009000' '5f4604' '40420f00'),
+    'transceive': bytes.fromhex('c003009000' '920100' '96020000' '970c' '6f0884064a0000000647' '9000'),
+    'parameters': bytes.fromhex('c003009000' 'ff6e0c' '010108' '020108' '030104' '040102'),
+    'getinfo over nfc': bytes.fromhex('c003009000' '920100' '96020000' '977c' + '00' * 122 + '9000'),
+}
+
+# Long form lengths are only handled by the new parser.
+LONG_RESPONSES = {
+    'long card response': bytes.fromhex('c003009000' '96020000' '9781fa' + 'ab' * 248 + '9000'),
+}
+
+class Response:
+    def __init__(self, data):
+        self.data = list(data)
+
+def check(acr, legacy):
+    for name, data in RESPONSES.items():
+        old = legacy.parse(binascii.hexlify(data).decode('utf8'))
+        new = acr.tlv.parse(data)
+        new = OrderedDict(('%02x' % tag, binascii.hexlify(value).decode('utf8')) for tag, value in new.items())
+        assert old == new, (name, old, new)
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    acr = AcrTlv()
+    legacy = LegacyTLV(['%02x' % k for k in acr.config.keys()])
+    check(acr, legacy)
+
+    print(f'{"response":20} {"bytes":>6} {"legacy us":>10} {"new us":>10} {"decode us":>10} {"speedup":>8}')
+    for name, data in list(RESPONSES.items()) + list(LONG_RESPONSES.items()):
+        response = Response(data)
+        new = timeit.timeit(lambda: acr.tlv.parse(bytes(response.data)), number = iterations) / iterations * 1e6
+        decode = timeit.timeit(lambda: acr.parse(response), number = iterations) / iterations * 1e6
+        if name in RESPONSES:
+            old = timeit.timeit(lambda: legacy.parse(binascii.hexlify(bytes(response.data)).decode('utf8')), number = iterations) / iterations * 1e6
+            print(f'{name:20} {len(data):6} {old:10.2f} {new:10.2f} {decode:10.2f} {old / new:7.1f}x')
+        else:
+            print(f'{name:20} {len(data):6} {"-":>10} {new:10.2f} {decode:10.2f} {"-":>8}')
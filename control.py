@@ -1,13 +1,24 @@
 import time
+_module_start = time.perf_counter()
+
+import os
 import sys
+import socket
 import binascii
+import threading
+import weakref
+import socketserver
 from collections import OrderedDict
 
-import pigpio
+# pigpio and pyscard are imported by load_dependency() only when a command
+# needs them, which keeps GPIO-only invocations from paying for pyscard.
+pigpio = None
+reader_registry = None
+CardConnection = None
+SCARD_SHARE_DIRECT = None
 
-from smartcard.System import readers
-from smartcard.CardConnection import CardConnection
-from smartcard.pcsc.PCSCPart10 import (SCARD_SHARE_DIRECT)
+# Unix socket used by `control.py serve` and control_client.py
+CONTROL_SOCKET = os.environ.get('SOLO2_CONTROL_SOCKET', '/tmp/solo2-hw-ci-control.sock')
 
 # pi pin | cable color  | pi function   | solo pin
 # -----------------------------------------
@@ -25,16 +36,6 @@ from smartcard.pcsc.PCSCPart10 import (SCARD_SHARE_DIRECT)
 # 40     | brown        | GPIO21       | nRESET
 # 
 
-def set_all_gpio_to_input(pi):
-    for pin in (2, 6,12,13,19,16,26,20,21):
-        pi.set_mode(pin, pigpio.INPUT)
-        
-    # Set buttons to HIGH default when they are next set to output.
-    # HIGH is read as idle button for device.
-    pi.write(Pins.Button1, 1)
-    pi.write(Pins.Button2, 1)
-    pi.write(Pins.Button3, 1)
-
 class Pins:
     Power = 2
 
@@ -49,16 +50,100 @@ class Pins:
     nReset = 21
     ISP = 13
 
+class PinState:
+    """
+    Last mode and output level written to each pin through one pigpio handle.
+    Lets the steps of a command skip redundant writes.  Anything else (another
+    control.py, a pigpiod restart) may drive the pins between commands, so
+    the control daemon forgets it before each one.
+    """
+    def __init__(self, pi):
+        self.pi = pi
+        self.modes = {}
+        self.levels = {}
+
+    def set_mode(self, pins, mode):
+        # pigpio has no bank mode command, so only the pins that change cost a round trip.
+        for pin in pins:
+            if self.modes.get(pin) != mode:
+                self.pi.set_mode(pin, mode)
+                self.modes[pin] = mode
+
+    def write_bits(self, set_bits, clear_bits):
+        set_bits &= ~self._mask(1)
+        clear_bits &= ~self._mask(0)
+        if set_bits:
+            self.pi.set_bank_1(set_bits)
+        if clear_bits:
+            self.pi.clear_bank_1(clear_bits)
+        self.assume_bits(set_bits, clear_bits)
+
+    def assume_bits(self, set_bits, clear_bits):
+        # Record levels that were driven some other way, e.g. by a wave.
+        for pin in range(32):
+            if set_bits & (1 << pin):
+                self.levels[pin] = 1
+            elif clear_bits & (1 << pin):
+                self.levels[pin] = 0
+
+    def forget(self):
+        self.modes.clear()
+        self.levels.clear()
+
+    def _mask(self, level):
+        mask = 0
+        for pin, pin_level in self.levels.items():
+            if pin_level == level:
+                mask |= 1 << pin
+        return mask
+
+_pin_states = weakref.WeakKeyDictionary()
+
+def pin_state(pi):
+    if pi not in _pin_states:
+        _pin_states[pi] = PinState(pi)
+    return _pin_states[pi]
+
+class PinGroup:
+    """
+    A set of pins whose mode and level are applied together, levels with a
+    single bank write.
+    """
+    def __init__(self, *pins):
+        self.pins = pins
+        self.mask = 0
+        for pin in pins:
+            self.mask |= 1 << pin
+
+    def set_mode(self, pi, mode):
+        pin_state(pi).set_mode(self.pins, mode)
+
+    def write(self, pi, level):
+        if level:
+            pin_state(pi).write_bits(self.mask, 0)
+        else:
+            pin_state(pi).write_bits(0, self.mask)
+
+ALL_PINS = PinGroup(2, 6, 12, 13, 19, 16, 26, 20, 21)
+BUTTONS = PinGroup(Pins.Button1, Pins.Button2, Pins.Button3)
+
+def set_all_gpio_to_input(pi):
+    ALL_PINS.set_mode(pi, pigpio.INPUT)
+
+    # Set buttons to HIGH default when they are next set to output.
+    # HIGH is read as idle button for device.
+    BUTTONS.write(pi, 1)
+
 class Apdu:
-    def __init__(self, cla, ins, p1, p2, data = []):
-        self.header = [cla,ins,p1,p2]
+    def __init__(self, cla, ins, p1, p2, data = b''):
+        self.header = bytes((cla, ins, p1, p2))
         self.data = data
     
-    def build(self,) -> list:
-        return (self.header + [len(self.data)] + self.data)
+    def build(self,) -> bytes:
+        return self.header + bytes((len(self.data),)) + self.data
 
     def __repr__(self,):
-        return '<< ' + binascii.hexlify(bytes(self.build())).decode('utf8')
+        return '<< ' + binascii.hexlify(self.build()).decode('utf8')
 
 class ApduResponse:
     def __init__(self, data, sw1, sw2):
@@ -69,21 +154,19 @@ class ApduResponse:
         return '>> ' + binascii.hexlify(bytes(self.data)).decode('utf8') + (' %02x' % (self.status))
 
 class Reader:
+    # Anything with record(ins, size, sw, start, end), e.g. provisioning/apdu_stats.py's ApduStats
+    stats = None
+
     def __init__(self, reader, debug = False):
         self.reader = reader
         self.debug = debug
 
     @staticmethod
     def get_acr_reader():
-        rlist = readers()
-
-        for r in rlist:
-            # print(r)
-            # print('PICC' in r.name)
-
-            if 'PICC' in r.name:
-                reader = Reader(r)
-                return reader
+        # Only re-enumerates after pcscd reports a reader came or went.
+        rlist = reader_registry.find(['PICC'])
+        if rlist:
+            return Reader(rlist[0])
         return None
 
     def connect(self, ):
@@ -97,15 +180,37 @@ class Reader:
 
     def sendRecv(self, apdu: Apdu) -> ApduResponse:
         if self.debug: print (apdu)
+        if self.stats is not None:
+            start = time.monotonic()
+        # pyscard wants a list of ints, this is the only conversion on the way out.
         data, sw1, sw2 = self.conn.transmit(
-            apdu.build()
+            list(apdu.build())
         )
         r = ApduResponse(data, sw1, sw2)
+        if self.stats is not None:
+            self.stats.record(apdu.header[1], len(apdu.data), r.status, start, time.monotonic())
         if self.debug: print(r)
         return r
 
 
 
+class TransparentExchangeError(Exception):
+    pass
+
+# Transparent session parameters, all single byte ints:
+#   frameSizeIFD/ICC   FSDI/FSCI, frame size index (5: 64, 6: 96, 7: 128, 8: 256 bytes)
+#   FWTI               frame waiting time integer
+#   maxCommSpeedIFD/ICC  bit rate (0: 106, 1: 212, 2: 424, 3: 848 kbit/s)
+#   ModulationIndex    in percent
+TRANSPARENT_PARAMETERS = ('frameSizeIFD', 'frameSizeICC', 'FWTI', 'maxCommSpeedIFD', 'maxCommSpeedICC', 'ModulationIndex')
+
+# switchProtocol value: ISO 14443 type A, layer 4, the reader then takes APDUs.
+SWITCH_TO_TYPE_A_LAYER_4 = b'\x00\x04'
+
+# The DUT's tester applet and its file buffer, as in provisioning/util.py
+TESTER_AID = b"\xA0\x00\x00\x08\x47\x01\x00\x00\x01"
+TESTER_FILE_ID = b'\xe1\x02'
+
 class Tester:
     def __init__(self, reader):
         self.reader = reader
@@ -141,30 +246,265 @@ class Tester:
         res = self.reader.sendRecv(cmd)
         print(res)
 
+    def exchange(self, tlv):
+        """
+        One transparent exchange, returns the parsed response.  Raises
+        TransparentExchangeError unless the reader reports success.
+        """
+        res = self.reader.sendRecv(Apdu(0xff, 0xc2, 0x00, 0x00, bytes(tlv)))
+        if res.status != 0x9000:
+            raise TransparentExchangeError('reader returned %04x' % res.status)
+        parsed = self.tlv.parse(res)
+        # 00 90 00, or the index of the failed data object and an error
+        status = parsed.get('Status')
+        if status is not None and bytes(status[1:3]) != b'\x90\x00':
+            raise TransparentExchangeError('data object %d failed with %s' % (status[0], binascii.hexlify(status[1:3]).decode('utf8')))
+        return parsed
+
+    def get_parameters(self, *names):
+        """
+        {name: int} of transparent session parameters, all of them by default.
+        """
+        names = names or TRANSPARENT_PARAMETERS
+        parsed = self.exchange(self.tlv.build('getParameter', [(name, b'') for name in names]))
+        # Readers answer inside a getParameter object or with bare data objects.
+        values = parsed.get('getParameter', parsed)
+        return OrderedDict((name, values[name]) for name in names if name in values)
+
+    def set_parameters(self, **values):
+        for name, value in values.items():
+            if name not in TRANSPARENT_PARAMETERS:
+                raise ValueError(f'Unknown parameter {name}, expected one of {TRANSPARENT_PARAMETERS}')
+            if not 0 <= value <= 0xff:
+                raise ValueError(f'{name} must be a byte, got {value}')
+        self.exchange(self.tlv.build('setParameter', list(values.items())))
+
+    def activate_layer_4(self):
+        """
+        Activates the card in the field as ISO 14443-4 A, after which transceive() takes APDUs.
+        """
+        self.exchange(self.tlv.build('switchProtocol', SWITCH_TO_TYPE_A_LAYER_4))
+
+    def transceive(self, apdu: Apdu) -> ApduResponse:
+        parsed = self.exchange(self.tlv.build('sendRecv', apdu.build()))
+        response = parsed.get('cardResponse')
+        if response is None or len(response) < 2:
+            raise TransparentExchangeError('no response from the card')
+        return ApduResponse(response[:-2], response[-2], response[-1])
+
 def set_buttons_to_input(pi):
     # This is necessary or setting buttons to 3v3 will actually power the device by itself..
-    pi.set_mode(Pins.Button1, pigpio.INPUT)
-    pi.set_mode(Pins.Button2, pigpio.INPUT)
-    pi.set_mode(Pins.Button3, pigpio.INPUT)
+    BUTTONS.set_mode(pi, pigpio.INPUT)
 
 def set_buttons_to_output(pi):
-    pi.set_mode(Pins.Button1, pigpio.OUTPUT)
-    pi.set_mode(Pins.Button2, pigpio.OUTPUT)
-    pi.set_mode(Pins.Button3, pigpio.OUTPUT)
+    BUTTONS.set_mode(pi, pigpio.OUTPUT)
 
-def try_to_set_nfc_field(enable):
-    # Turns on or off nfc reader if connected, skips if not.
-    reader = Reader.get_acr_reader()
-    if reader is not None:
-        reader.connect()
-        tester = Tester(reader)
-        tester.start_transparent_session()
+class Sequence:
+    """
+    Declarative pin sequence, e.g.
+
+        Sequence().low(Pins.Power, Pins.ISP).wait(150).high(Pins.Power).wait(100).high(Pins.ISP)
+
+    `run` compiles it into a single pigpio wave, so pulse timing comes from the
+    Pi's DMA engine instead of sleeps and socket round trips to pigpiod.
+    """
+    def __init__(self):
+        # [set_bits, clear_bits, delay_us] per step
+        self.steps = []
+
+    def _level(self, pins, level):
+        bits = 0
+        for pin in pins:
+            bits |= 1 << pin
+        if not self.steps or self.steps[-1][2]:
+            self.steps.append([0, 0, 0])
+        step = self.steps[-1]
+        if level:
+            step[0] |= bits
+            step[1] &= ~bits
+        else:
+            step[1] |= bits
+            step[0] &= ~bits
+        return self
+
+    def high(self, *pins):
+        return self._level(pins, 1)
+
+    def low(self, *pins):
+        return self._level(pins, 0)
+
+    def wait(self, ms):
+        if not self.steps:
+            self.steps.append([0, 0, 0])
+        self.steps[-1][2] += int(ms * 1000)
+        return self
+
+    def pin_mask(self):
+        mask = 0
+        for set_bits, clear_bits, delay in self.steps:
+            mask |= set_bits | clear_bits
+        return mask
+
+    def duration(self):
+        return sum(step[2] for step in self.steps) / 1e6
+
+    def final_levels(self):
+        set_bits = clear_bits = 0
+        for s, c, d in self.steps:
+            set_bits = (set_bits | s) & ~c
+            clear_bits = (clear_bits | c) & ~s
+        return set_bits, clear_bits
+
+    def run(self, pi):
+        state = pin_state(pi)
+        mask = self.pin_mask()
+        # Latch the starting levels before switching to output so the pins
+        # don't glitch to whatever level they held last.
+        set_bits, clear_bits, delay = self.steps[0]
+        state.write_bits(set_bits, clear_bits)
+        state.set_mode([pin for pin in range(32) if mask & (1 << pin)], pigpio.OUTPUT)
+        if len(self.steps) == 1:
+            # Nothing to time, the latched levels are the whole sequence.
+            return
+
+        pi.wave_add_new()
+        pi.wave_add_generic([pigpio.pulse(s, c, d) for s, c, d in self.steps])
+        wave = pi.wave_create()
+        try:
+            pi.wave_send_once(wave)
+            time.sleep(self.duration())
+            while pi.wave_tx_busy():
+                time.sleep(.001)
+        finally:
+            pi.wave_delete(wave)
+        state.assume_bits(*self.final_levels())
+
+# Timings are held by the wave, so these only need to cover the device, not host jitter.
+REBOOT = Sequence().low(Pins.Power).wait(150).high(Pins.Power)
+POWER_OFF = Sequence().low(Pins.Power)
+POWER_ON = Sequence().high(Pins.Power)
+RESET = Sequence().low(Pins.nReset).wait(100).high(Pins.nReset)
+# while power is turned off, assert ISP, release it 100ms after power returns.
+REBOOT_INTO_BOOTROM = Sequence().low(Pins.Power, Pins.ISP).wait(150).high(Pins.Power).wait(100).high(Pins.ISP)
+# while reset asserted, assert ISP, release it 100ms after nReset.
+RESET_INTO_BOOTROM = Sequence().low(Pins.nReset, Pins.ISP).wait(100).high(Pins.nReset).wait(100).high(Pins.ISP)
+TOGGLE_BUTTON = {
+    1: Sequence().low(Pins.Button1).wait(100).high(Pins.Button1),
+    2: Sequence().low(Pins.Button2).wait(100).high(Pins.Button2),
+    3: Sequence().low(Pins.Button3).wait(100).high(Pins.Button3),
+}
+
+class NfcSession:
+    """
+    Keeps one direct-mode connection to the ACR1252 and tracks the transparent
+    session and field state, so repeated nfc commands skip reader discovery
+    and steps of one command skip session setup and rfOn/rfOff that wouldn't
+    change anything.  Another process or a reader power cycle may switch the
+    field between commands, so the control daemon forgets it before each one.
+
+    Field on means the session is ended (reader polls for cards as usual),
+    field off means the session is left open with rfOff.
+    """
+    def __init__(self):
+        self.tester = None
+        self.in_session = False
+        # None until we have set it ourselves.
+        self.field = None
+
+    def _get_tester(self):
+        if self.tester is None:
+            reader = Reader.get_acr_reader()
+            if reader is None:
+                return None
+            reader.connect()
+            self.tester = Tester(reader)
+            self.in_session = False
+            self.field = None
+        return self.tester
+
+    def _set_field(self, tester, enable):
+        if not self.in_session:
+            tester.start_transparent_session()
+            self.in_session = True
         if enable:
             tester.turn_on_field()
             tester.end_transparent_session()
+            self.in_session = False
         else:
             tester.turn_off_field()
             # leave transparent session on, keeping the field off..
+        self.field = enable
+
+    def set_field(self, enable):
+        """
+        Turns the field on or off if the reader is connected.  Returns False if there is no reader.
+        """
+        enable = bool(enable)
+        if self.field == enable:
+            return True
+        tester = self._get_tester()
+        if tester is None:
+            return False
+        try:
+            self._set_field(tester, enable)
+        except Exception:
+            # Reader was replugged or pcscd restarted, rediscover once.
+            self.close()
+            tester = self._get_tester()
+            if tester is None:
+                return False
+            self._set_field(tester, enable)
+        return True
+
+    def run_in_session(self, func):
+        """
+        Returns func(tester) run in a transparent session, which is ended
+        afterwards with the field on.
+        """
+        tester = self._get_tester()
+        if tester is None:
+            raise TransparentExchangeError('no ACR reader found')
+        if not self.in_session:
+            tester.start_transparent_session()
+            self.in_session = True
+        try:
+            return func(tester)
+        finally:
+            tester.turn_on_field()
+            tester.end_transparent_session()
+            self.in_session = False
+            self.field = True
+
+    def forget_field(self):
+        # The next set_field() starts a session and goes to the reader
+        # whatever we set last, like a fresh control.py does.
+        self.in_session = False
+        self.field = None
+
+    def cycle_field(self, off_time = .100):
+        """
+        Field off, wait `off_time` seconds, field on.
+        """
+        self.set_field(0)
+        time.sleep(off_time)
+        return self.set_field(1)
+
+    def close(self):
+        if self.tester is not None:
+            try:
+                self.tester.reader.conn.disconnect()
+            except Exception:
+                pass
+        self.tester = None
+        self.in_session = False
+        self.field = None
+
+# Shared by all commands, so the control daemon keeps the reader connection open.
+nfc_session = NfcSession()
+
+def try_to_set_nfc_field(enable):
+    # Turns on or off nfc reader if connected, skips if not.
+    nfc_session.set_field(enable)
 
 class AcrTlv:
     def __init__(self,):
@@ -181,13 +521,14 @@ class AcrTlv:
             0x93: {'type': 'bytes', 'name': 'transmit'},
             0x94: {'type': 'bytes', 'name': 'recv'},
 
+            0xff6d: {'type': 'TLV', 'name': 'getParameter'},
             0xff6e: {'type': 'TLV', 'name': 'setParameter'},
             0x01: {'type': 'int', 'name': 'frameSizeIFD'},
             0x02: {'type': 'int', 'name': 'frameSizeICC'},
             0x03: {'type': 'int', 'name': 'FWTI'},
-            0x04: {'type': 'bytes', 'name': 'maxCommSpeedIFD'},
-            0x05: {'type': 'bytes', 'name': 'maxCommSpeedICC'},
-            0x06: {'type': 'bytes', 'name': 'ModulationIndex'},
+            0x04: {'type': 'int', 'name': 'maxCommSpeedIFD'},
+            0x05: {'type': 'int', 'name': 'maxCommSpeedICC'},
+            0x06: {'type': 'int', 'name': 'ModulationIndex'},
             0x07: {'type': 'bytes', 'name': 'PCB'},
             0x08: {'type': 'bytes', 'name': 'CID'},
             # 0x04: {'type': 'bytes', 'name': 'maxCommSpeed'},
@@ -200,93 +541,146 @@ class AcrTlv:
             0x97: {'type': 'bytes', 'name': 'cardResponse'},
         }
 
-        # print(['%02x' % k for k in self.config.keys()])
-        self.tlv = TLV(['%02x' % k for k in self.config.keys()])
-    
-    def parse(self, apdu: Apdu):
-        p = self.tlv.parse(binascii.hexlify(bytes(apdu.data)).decode('utf8'))
-        return p
-    
+        self.tlv = TLV({tag: entry['name'] for tag, entry in self.config.items()})
+        # name -> tag and tag -> encoded tag bytes, so build() doesn't search config.
+        self.tags = {entry['name']: tag for tag, entry in self.config.items()}
+        self.prefixes = {tag: tag.to_bytes(2 if tag > 0xff else 1, 'big') for tag in self.config}
+
+    def parse(self, apdu: ApduResponse):
+        """
+        Parses a reader response into {name: value}, decoding values by their
+        configured type: 'int', 'bytes' (memoryview) or nested 'TLV'.
+        """
+        return self.decode(self.tlv.parse(bytes(apdu.data)))
+
+    def decode(self, parsed):
+        result = OrderedDict()
+        for tag, value in parsed.items():
+            entry = self.config[tag]
+            if entry['type'] == 'int':
+                value = int.from_bytes(value, 'big')
+            elif entry['type'] == 'TLV':
+                value = self.decode(self.tlv.parse(value))
+            result[entry['name']] = value
+        return result
+
     def print_tlv(self, apdu):
         p = self.parse(apdu)
-        for key in p:
-            name = self.config[int(key,16)]['name']
-            print(f'{name}:', p[key])
-
-    def build(self,tag,data = []):
-        if isinstance(tag,str):
-            for t in self.config:
-                if self.config[t]['name'] == tag:
-                    tag = t
-        if isinstance(data, int):
-            data = [data]
-        if tag > 255:
-            tag = '%04x'%tag
+        for name, value in p.items():
+            if isinstance(value, memoryview):
+                value = binascii.hexlify(value).decode('utf8')
+            print(f'{name}:', value)
+
+    def build(self, tag, data = b''):
+        """
+        Encodes one TLV straight into a bytearray.  `data` may be bytes, a list
+        of ints or an int; for 'TLV' typed tags it may also be a dict or list of
+        (name, value) pairs that are encoded as nested TLVs, e.g.
+
+            build('setParameter', [('frameSizeICC', 8), ('FWTI', 4)])
+        """
+        if isinstance(tag, str):
+            tag = self.tags[tag]
+        if self.config[tag]['type'] == 'TLV' and not isinstance(data, (bytes, bytearray, memoryview)):
+            items = data.items() if isinstance(data, dict) else data
+            value = bytearray()
+            for name, item in items:
+                value += self.build(name, item)
+        elif isinstance(data, int):
+            value = data.to_bytes(max(1, (data.bit_length() + 7) // 8), 'big')
         else:
-            tag = '%02x'%tag
-        
+            value = data
+
+        out = bytearray(self.prefixes[tag])
+        length = len(value)
+        if length < 0x80:
+            out.append(length)
+        elif length <= 0xff:
+            out += bytes((0x81, length))
+        else:
+            out += bytes((0x82, length >> 8, length & 0xff))
+        out += bytes(value) if isinstance(value, list) else value
+        return out
+
+def hexify(number):
+    """
+    Convert integer to hex string representation, e.g. 12 to '0C'
+    """
+    if number < 0:
+        raise ValueError('Invalid number to hexify - must be positive')
 
-        # res = self.tlv.build(
-            # {tag : binascii.hexlify(bytes(data)).decode('utf8')}
-        # )
-        res = tag + ('%02x' % len(data)) + binascii.hexlify(bytes(data)).decode('utf8')
+    result = hex(int(number)).replace('0x', '').upper()
+    if divmod(len(result), 2)[1] == 1:
+        # Padding
+        result = '0{}'.format(result)
+    return result
 
-        # print('res',res)
-        return list(binascii.unhexlify(res))
-        
 class TLV:
+    """
+    BER-TLV parser working directly on bytes.  Tags are looked up in a dict keyed
+    by the integer value of their encoded bytes (ff 6e -> 0xff6e), and values are
+    returned as memoryviews into the input rather than copies.
+    """
 
     def __init__(self, tags):
         self.tags = {}
 
         if type(tags) == list:
             for tag in tags:
-                self.tags[tag] = tag
+                self.tags[tag] = '%02x' % tag
         elif type(tags) == dict:
             self.tags = tags
         else:
             print('Invalid tags dictionary given - use list of tags or dict as {tag: tag_name}')
 
-        self.tlv_string = ''
-        
-        self.tag_lengths = set()
-        for tag, tag_name in self.tags.items():
-            self.tag_lengths.add(len(tag))
-
 
-    def parse(self, tlv_string):
+    def parse(self, data):
         """
+        Returns an OrderedDict of tag -> memoryview of the value.
         """
         parsed_data = OrderedDict()
-        self.tlv_string = tlv_string
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        tags = self.tags
+        end = len(view)
 
         i = 0
-        while i < len(self.tlv_string): 
-            tag_found = False
-
-            for tag_length in self.tag_lengths:
-                for tag, tag_name in self.tags.items():
-                    if self.tlv_string[i:i+tag_length] == tag:
-                        try:
-                            value_length = int(self.tlv_string[i+tag_length:i+tag_length+2], 16)
-                        except ValueError:
-                            raise ValueError('Parse error: tag ' + tag + ' has incorrect data length')
-
-                        value_start_position = i+tag_length+2
-                        value_end_position = i+tag_length+2+value_length*2
-
-                        if value_end_position > len(self.tlv_string):
-                            raise ValueError('Parse error: tag ' + tag + ' declared data of length ' + str(value_length) + ', but actual data length is ' + str(int(len(self.tlv_string[value_start_position-1:-1])/2)))
-
-                        value = self.tlv_string[value_start_position:value_end_position]
-                        parsed_data[tag] = value
-
-                        i = value_end_position
-                        tag_found = True
-
-            if not tag_found:
-                msg = 'Unknown tag found: ' + binascii.hexlify(bytes(self.tlv_string[i:i+10])).decode('utf8')
+        while i < end:
+            tag_start = i
+            tag = view[i]
+            i += 1
+            if tag & 0x1f == 0x1f:
+                # Multi-byte tag, following bytes have b8 set until the last one.
+                while True:
+                    if i >= end:
+                        raise ValueError('Parse error: truncated tag at offset %d' % tag_start)
+                    b = view[i]
+                    i += 1
+                    tag = (tag << 8) | b
+                    if not b & 0x80:
+                        break
+
+            if tag not in tags:
+                msg = 'Unknown tag found: ' + binascii.hexlify(view[tag_start:tag_start + 5]).decode('utf8')
                 raise ValueError(msg)
+
+            if i >= end:
+                raise ValueError('Parse error: tag %x has incorrect data length' % tag)
+            value_length = view[i]
+            i += 1
+            if value_length & 0x80:
+                # Long form length, e.g. 0x81 0xff or 0x82 0x01 0x00
+                length_bytes = value_length & 0x7f
+                if i + length_bytes > end:
+                    raise ValueError('Parse error: tag %x has incorrect data length' % tag)
+                value_length = int.from_bytes(view[i:i + length_bytes], 'big')
+                i += length_bytes
+
+            value_end = i + value_length
+            if value_end > end:
+                raise ValueError('Parse error: tag %x declared data of length %d, but actual data length is %d' % (tag, value_length, end - i))
+
+            parsed_data[tag] = view[i:value_end]
+            i = value_end
         return parsed_data
 
 
@@ -339,10 +733,11 @@ class TLV:
         """
         dump = ''
         for tag, value in data_dict.items():
-            dump = dump + left_indent + '[' + tag.upper().rjust(4, ' ') + '] [' + self.tags[tag.upper()][:desc_column_width].rjust(desc_column_width, ' ') + ']:[' + value + ']\n'
+            value = binascii.hexlify(value).decode('utf8').upper()
+            dump = dump + left_indent + '[' + ('%X' % tag).rjust(4, ' ') + '] [' + self.tags[tag][:desc_column_width].rjust(desc_column_width, ' ') + ']:[' + value + ']\n'
             # Special tag processing:
             # TVR
-            if tag == '95':
+            if tag == 0x95:
                 tvr_indent = left_indent + '     '
                 parsed_tvr = self._parse_tvr(value, left_indent=tvr_indent, desc_column_width=48)
                 if parsed_tvr:
@@ -352,128 +747,577 @@ class TLV:
 
 
 
-if __name__ == "__main__":
-    # if running on PC, set PIGPIO_ADDR=192.168.1.111, or to whatever your pi addr is.
-    pi = pigpio.pi()
+def load_dependency(name):
+    """
+    Imports the modules behind a command dependency: 'gpio' (pigpio) or 'pcsc' (pyscard).
+    """
+    global pigpio, reader_registry, CardConnection, SCARD_SHARE_DIRECT
+    if name == 'gpio' and pigpio is None:
+        import pigpio
+    elif name == 'pcsc' and reader_registry is None:
+        from smartcard.CardConnection import CardConnection
+        from smartcard.pcsc.PCSCPart10 import (SCARD_SHARE_DIRECT)
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'provisioning'))
+        from pcsc_readers import reader_registry
+        if os.environ.get('SOLO2_APDU_STATS'):
+            import apdu_stats
+            Reader.stats = apdu_stats.from_environment({0xc2: 'TransparentExchange'})
+
+class Command:
+    def __init__(self, name, func, needs, usage = ''):
+        self.name = name
+        self.func = func
+        self.needs = needs
+        # Commands with a usage string take the remaining command line arguments.
+        self.usage = usage
+
+COMMANDS = OrderedDict()
+
+def command(name, needs = ('gpio',), usage = ''):
+    def register(func):
+        COMMANDS[name] = Command(name, func, needs, usage)
+        return func
+    return register
+
+@command('reset-pins')
+def reset_pins(pi):
+    set_all_gpio_to_input(pi)
+
+@command('reboot')
+def reboot(pi):
+    # Toggle power
+    set_all_gpio_to_input(pi)
+    set_buttons_to_input(pi)
+    REBOOT.run(pi)
+    set_buttons_to_output(pi)
+
+@command('off')
+def off(pi):
+    set_all_gpio_to_input(pi)
+    set_buttons_to_input(pi)
+    POWER_OFF.run(pi)
+
+@command('on')
+def on(pi):
+    POWER_ON.run(pi)
+
+@command('reset')
+def reset(pi):
+    RESET.run(pi)
+
+@command('reboot-into-bootrom')
+def reboot_into_bootrom(pi):
+    set_all_gpio_to_input(pi)
+    set_buttons_to_input(pi)
+    REBOOT_INTO_BOOTROM.run(pi)
+    set_buttons_to_output(pi)
+
+@command('reset-into-bootrom')
+def reset_into_bootrom(pi):
+    RESET_INTO_BOOTROM.run(pi)
+
+@command('reset-buttons')
+def reset_buttons(pi):
+    set_buttons_to_output(pi)
+    BUTTONS.write(pi, 1)
+
+@command('toggle-button-1')
+def toggle_button_1(pi):
+    TOGGLE_BUTTON[1].run(pi)
+
+@command('toggle-button-2')
+def toggle_button_2(pi):
+    TOGGLE_BUTTON[2].run(pi)
+
+@command('toggle-button-3')
+def toggle_button_3(pi):
+    TOGGLE_BUTTON[3].run(pi)
+
+@command('nfc-on', needs = ('pcsc',))
+def nfc_on(pi):
+    try_to_set_nfc_field(1)
+
+@command('nfc-off', needs = ('pcsc',))
+def nfc_off(pi):
+    try_to_set_nfc_field(0)
+
+@command('switch-into-passive-mode', needs = ('gpio', 'pcsc'))
+def switch_into_passive_mode(pi):
+    set_all_gpio_to_input(pi)
+    try_to_set_nfc_field(0)
+    set_buttons_to_input(pi)
+    pin_state(pi).set_mode([Pins.ISP], pigpio.OUTPUT)
+    on_usb = usb_present(*SOLO2_USB_ID)
+    start = time.monotonic()
+    POWER_OFF.run(pi)
+    if on_usb:
+        # Dropping off USB says the device stopped, not that its rails have
+        # drained, so still give it REBOOT's power-off time.
+        try:
+            wait_for(lambda: not usb_present(*SOLO2_USB_ID), PASSIVE_SETTLE)
+        except TimeoutError:
+            pass
+        settle = PASSIVE_SETTLE_AFTER_USB
+    else:
+        # Nothing to go by (e.g. NFC only), the full settle time.
+        settle = PASSIVE_SETTLE
+    time.sleep(max(0, settle - (time.monotonic() - start)))
+
+    try_to_set_nfc_field(1)
+
+@command('nfc-cycle', needs = ('pcsc',))
+def nfc_cycle(pi):
+    nfc_session.cycle_field()
+
+@command('nfc-params', needs = ('pcsc',), usage = '[name=value ...]')
+def nfc_params(pi, argv):
+    # Whether set values outlast the transparent session is up to the reader.
+    values = OrderedDict()
+    for arg in argv:
+        name, _, value = arg.partition('=')
+        values[name] = int(value, 0)
+
+    def run(tester):
+        if values:
+            tester.set_parameters(**values)
+        return tester.get_parameters()
+
+    for name, value in nfc_session.run_in_session(run).items():
+        print(f'{name}: {value}')
 
-    if len(sys.argv) < 2:
-        print(f"usage: {sys.argv[0]} <command>")
+def measure_nfc(tester, rounds, writes):
+    """
+    Times `rounds` SELECTs of the DUT's tester applet and `writes` 240 byte
+    WRITE BINARYs into its file buffer.  Returns (round trip seconds,
+    write bytes/s, failed exchanges).
+    """
+    failures = 0
+    round_trips = []
+    select = Apdu(0x00, 0xa4, 0x04, 0x00, TESTER_AID)
+    for _ in range(rounds):
+        start = time.monotonic()
+        try:
+            ok = tester.transceive(select).status == 0x9000
+        except (TransparentExchangeError, ValueError):
+            ok = False
+        if ok:
+            round_trips.append(time.monotonic() - start)
+        else:
+            failures += 1
+
+    # Wrapped in sendRecv it has to fit the short APDU to the reader.
+    write = Apdu(0x00, 0xd0, 0x00, 0x00, bytes(240))
+    written = 0
+    took = 0
+    try:
+        tester.transceive(Apdu(0x00, 0xa4, 0x00, 0x00, TESTER_FILE_ID))
+        start = time.monotonic()
+        for _ in range(writes):
+            if tester.transceive(write).status == 0x9000:
+                written += len(write.data)
+            else:
+                failures += 1
+        took = time.monotonic() - start
+    except (TransparentExchangeError, ValueError):
+        failures += 1
+    return round_trips, written / took if took else 0, failures
+
+def nfc_sweep(tester, combinations, rounds, writes):
+    """
+    Measures the DUT over NFC with each {parameter: value} combination and
+    returns a result dict per combination.  The reader's parameters are
+    restored afterwards.
+    """
+    results = []
+    defaults = tester.get_parameters()
+    try:
+        for combination in combinations:
+            result = {'parameters': combination}
+            try:
+                tester.set_parameters(**combination)
+                # Frame sizes and bit rates are agreed on when the card is activated.
+                tester.turn_off_field()
+                tester.turn_on_field()
+                tester.activate_layer_4()
+            except TransparentExchangeError as e:
+                result['error'] = str(e)
+            else:
+                round_trips, bytes_per_s, failures = measure_nfc(tester, rounds, writes)
+                round_trips.sort()
+                result.update({
+                    'rtt_ms_p50': round_trips[len(round_trips) // 2] * 1000 if round_trips else None,
+                    'rtt_ms_max': round_trips[-1] * 1000 if round_trips else None,
+                    'bytes_per_s': bytes_per_s,
+                    'failures': failures,
+                    'stable': failures == 0,
+                })
+            results.append(result)
+            label = ' '.join(f'{name}={value}' for name, value in combination.items())
+            if 'error' in result:
+                print(f'{label}: rejected, {result["error"]}', flush = True)
+            else:
+                print(f'{label}: rtt p50 {result["rtt_ms_p50"] or 0:.1f} ms max {result["rtt_ms_max"] or 0:.1f} ms,'
+                      f' {bytes_per_s:.0f} B/s, {failures} failures', flush = True)
+    finally:
+        tester.set_parameters(**defaults)
+    return results
+
+@command('nfc-sweep', needs = ('pcsc',), usage = '[--frame-sizes 5,6,8] [--speeds 0,1,2,3] [--fwti N,..] [--rounds N] [--writes N] [--output file]')
+def nfc_sweep_main(pi, argv):
+    import json
+    import argparse
+    import itertools
+    ints = lambda text: [int(value, 0) for value in text.split(',')]
+    parser = argparse.ArgumentParser(prog = 'control.py nfc-sweep', description = 'Find the fastest stable ACR1252 transparent session parameters for the DUT.')
+    parser.add_argument('--frame-sizes', type = ints, default = [5, 6, 7, 8], help = 'frameSizeIFD/ICC indexes to try (default: 5,6,7,8)')
+    parser.add_argument('--speeds', type = ints, default = [0, 1, 2, 3], help = 'maxCommSpeedIFD/ICC to try (default: 0,1,2,3)')
+    parser.add_argument('--fwti', type = ints, help = 'FWTI values to try (default: leave as is)')
+    parser.add_argument('--rounds', type = int, default = 50, help = 'SELECT round trips per combination (default: %(default)s)')
+    parser.add_argument('--writes', type = int, default = 40, help = '240 byte writes per combination (default: %(default)s)')
+    parser.add_argument('--output', help = 'write the results as JSON')
+    args = parser.parse_args(argv)
+
+    combinations = []
+    for frame_size, speed, fwti in itertools.product(args.frame_sizes, args.speeds, args.fwti or [None]):
+        combination = OrderedDict([('frameSizeIFD', frame_size), ('frameSizeICC', frame_size),
+                ('maxCommSpeedIFD', speed), ('maxCommSpeedICC', speed)])
+        if fwti is not None:
+            combination['FWTI'] = fwti
+        combinations.append(combination)
+
+    results = nfc_session.run_in_session(lambda tester: nfc_sweep(tester, combinations, args.rounds, args.writes))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 1)
+
+    stable = [r for r in results if r.get('stable')]
+    if not stable:
+        print('No stable combination')
         sys.exit(1)
+    best = max(stable, key = lambda r: (r['bytes_per_s'], -(r['rtt_ms_p50'] or 0)))
+    print(f'Fastest stable: {best["bytes_per_s"]:.0f} B/s, rtt p50 {best["rtt_ms_p50"] or 0:.1f} ms')
+    print('    python3 control.py nfc-params ' + ' '.join(f'{name}={value}' for name, value in best['parameters'].items()))
 
-    command = sys.argv[1].lower()
-
-    if command == 'reset-pins':
-        set_all_gpio_to_input(pi)
-
-    elif command == 'reboot':
-        # Toggle power
-        set_all_gpio_to_input(pi)
-        set_buttons_to_input(pi)
-        pi.set_mode(Pins.Power, pigpio.OUTPUT)
-        pi.write(Pins.Power, 0)
-        time.sleep(.150)
-        pi.write(Pins.Power, 1)
-        set_buttons_to_output(pi)
-    elif command == 'off':
-        set_all_gpio_to_input(pi)
-        set_buttons_to_input(pi)
-        pi.set_mode(Pins.Power, pigpio.OUTPUT)
-        pi.write(Pins.Power, 0)
-    elif command == 'on':
-        pi.set_mode(Pins.Power, pigpio.OUTPUT)
-        pi.write(Pins.Power, 1)
-    elif command == 'reset':
-        pi.set_mode(Pins.nReset, pigpio.OUTPUT)
-        pi.write(Pins.nReset, 0)
-        time.sleep(.100)
-        pi.set_mode(Pins.nReset, pigpio.OUTPUT)
-        pi.write(Pins.nReset, 1)
-
-    elif command == 'reboot-into-bootrom':
-        set_all_gpio_to_input(pi)
-        set_buttons_to_input(pi)
-        pi.set_mode(Pins.Power, pigpio.OUTPUT)
-        pi.set_mode(Pins.ISP, pigpio.OUTPUT)
-        pi.write(Pins.Power, 0)
-
-        # while power is turned out, assert ISP.
-        pi.write(Pins.ISP, 0)
-        time.sleep(.150)
-        pi.write(Pins.Power, 1)
-
-        # after 100ms release ISP
-        time.sleep(.100)
-        pi.write(Pins.ISP, 1)
-        set_buttons_to_output(pi)
-
-    elif command == 'reset-into-bootrom':
-        pi.set_mode(Pins.nReset, pigpio.OUTPUT)
-        pi.set_mode(Pins.ISP, pigpio.OUTPUT)
-        pi.write(Pins.nReset, 0)
-
-        # while reset asserted, assert ISP.
-        pi.write(Pins.ISP, 0)
-        time.sleep(.100)
-        pi.write(Pins.nReset, 1)
-
-        # after 50ms release nReset
-        time.sleep(.100)
-        pi.write(Pins.ISP, 1)
-    elif command == 'reset-buttons':
-        pi.set_mode(Pins.Button1, pigpio.OUTPUT)
-        pi.set_mode(Pins.Button2, pigpio.OUTPUT)
-        pi.set_mode(Pins.Button3, pigpio.OUTPUT)
-
-        pi.write(Pins.Button1, 1)
-        pi.write(Pins.Button2, 1)
-        pi.write(Pins.Button3, 1)
-    elif command == 'toggle-button-1':
-        pi.set_mode(Pins.Button1, pigpio.OUTPUT)
-        pi.write(Pins.Button1, 0)
-        time.sleep(.100)
-        pi.write(Pins.Button1, 1)
-
-    elif command == 'toggle-button-2':
-        pi.set_mode(Pins.Button2, pigpio.OUTPUT)
-        pi.write(Pins.Button2, 0)
-        time.sleep(.100)
-        pi.write(Pins.Button2, 1)
-
-    elif command == 'toggle-button-3':
-        pi.set_mode(Pins.Button3, pigpio.OUTPUT)
-        pi.write(Pins.Button3, 0)
-        time.sleep(.100)
-        pi.write(Pins.Button3, 1)
-
-    elif command == 'nfc-on':
-        try_to_set_nfc_field(1)
-    elif command == 'nfc-off':
-        try_to_set_nfc_field(0)
-    elif command == 'switch-into-passive-mode':
-        set_all_gpio_to_input(pi)
-        try_to_set_nfc_field(0)
-        set_buttons_to_input(pi)
-        pi.set_mode(Pins.Power, pigpio.OUTPUT)
-        pi.set_mode(Pins.ISP, pigpio.OUTPUT)
-        pi.write(Pins.Power, 0)
-        time.sleep(.250)
-
-        try_to_set_nfc_field(1)
-    else:
+# VID:PID of the DUT in its different modes
+SOLO2_USB_ID = (0x1209, 0xbeee)
+SOLO2_PROVISIONER_USB_ID = (0x1209, 0xb000)
+LPC55_BOOTROM_USB_ID = (0x1fc9, 0x0021)
+
+# Seconds from power off to field on in switch-into-passive-mode, and the
+# least of it once the device was seen leaving USB.
+PASSIVE_SETTLE = .250
+PASSIVE_SETTLE_AFTER_USB = .150
+
+def wait_for(condition, timeout, interval = .005):
+    """
+    Calls `condition` until it returns something truthy and returns
+    (result, seconds waited).  Raises TimeoutError after `timeout` seconds.
+    """
+    start = time.monotonic()
+    while True:
+        result = condition()
+        elapsed = time.monotonic() - start
+        if result:
+            return result, elapsed
+        if elapsed > timeout:
+            raise TimeoutError(f'not ready after {timeout}s')
+        time.sleep(interval)
+
+def usb_present(vid, pid):
+    # sysfs is cheap enough to poll every few ms, unlike a libusb enumeration.
+    try:
+        devices = os.listdir('/sys/bus/usb/devices')
+    except FileNotFoundError:
+        return False
+    for dev in devices:
+        try:
+            with open(f'/sys/bus/usb/devices/{dev}/idVendor') as f:
+                if int(f.read(), 16) != vid:
+                    continue
+            with open(f'/sys/bus/usb/devices/{dev}/idProduct') as f:
+                if int(f.read(), 16) == pid:
+                    return True
+        except (OSError, ValueError):
+            pass
+    return False
+
+def tcp_accepting(host, port):
+    try:
+        socket.create_connection((host, port), timeout = .1).close()
+        return True
+    except OSError:
+        return False
+
+def wait_for_card(pattern, timeout):
+    """
+    Blocks until a reader whose name contains one of the `|` separated names
+    in `pattern` reports a card, returns the reader.
+    """
+    load_dependency('pcsc')
+    names = pattern.split('|') if pattern else ['']
+    return reader_registry.wait_for(names, card = True, timeout = timeout)
+
+def parse_usb_id(text):
+    vid, pid = text.split(':')
+    return int(vid, 16), int(pid, 16)
+
+@command('wait-for', needs = (), usage = '<usb|usb-gone|card|tcp> [VID:PID | reader name | [host:]port] [--timeout s]')
+def wait_for_main(pi, argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog = 'control.py wait-for', description = 'Block until the hardware is ready.')
+    parser.add_argument('kind', choices = ['usb', 'usb-gone', 'card', 'tcp'])
+    parser.add_argument('target', nargs = '?', default = '', help = "VID:PID, reader name ('|' separated) or [host:]port")
+    parser.add_argument('--timeout', type = float, default = 30)
+    args = parser.parse_args(argv)
+    kind, target, timeout = args.kind, args.target, args.timeout
+
+    try:
+        if kind == 'usb':
+            result, elapsed = wait_for(lambda: usb_present(*parse_usb_id(target)), timeout)
+        elif kind == 'usb-gone':
+            result, elapsed = wait_for(lambda: not usb_present(*parse_usb_id(target)), timeout)
+        elif kind == 'tcp':
+            host, _, port = target.rpartition(':')
+            result, elapsed = wait_for(lambda: tcp_accepting(host or 'localhost', int(port)), timeout)
+        elif kind == 'card':
+            start = time.monotonic()
+            reader = wait_for_card(target, timeout)
+            elapsed = time.monotonic() - start
+            print(f'card in {reader.name}')
+    except TimeoutError as e:
+        print(f'{kind} {target}: {e}')
+        sys.exit(1)
+    print(f'{kind} {target} ready in {elapsed * 1000:.0f} ms')
+
+
+def run_command(pi, command):
+    """
+    Runs a single rig command.  `pi` may be None for commands that don't need gpio.
+    """
+    if command not in COMMANDS or COMMANDS[command].usage:
         raise ValueError(f"Invalid command: {command}")
+    cmd = COMMANDS[command]
+    for need in cmd.needs:
+        load_dependency(need)
+    if pi is not None:
+        pin_state(pi).forget()
+    nfc_session.forget_field()
+    cmd.func(pi)
 
 
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one command per line and answers with `ok <ms>` or `error <message>`.
+    """
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode('utf8').strip().lower()
+            if not command:
+                continue
+            start = time.monotonic()
+            try:
+                with self.server.lock:
+                    run_command(self.server.pi, command)
+                reply = 'ok %.3f' % ((time.monotonic() - start) * 1000)
+            except Exception as e:
+                reply = f'error {e}'
+            print(f'[{start:.6f}] {command}: {reply}', flush=True)
+            self.wfile.write((reply + '\n').encode('utf8'))
+            self.wfile.flush()
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Long lived rig control service.  Keeps the pigpio socket and, once an nfc
+    command has loaded pyscard, the reader registry and ACR1252 connection
+    open, so each command only costs the GPIO/reader traffic itself.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, pi):
+        self.pi = pi
+        # Commands drive shared hardware, only run one at a time.
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, ControlRequestHandler)
+
+# pyscard is loaded by the first command that needs it, so the daemon also
+# runs off-Pi against pigpiod_stub.py without it.
+@command('serve', needs = ('gpio',), usage = '[socket-path]')
+def serve(pi, argv):
+    path = argv[0] if argv else CONTROL_SOCKET
+    server = ControlServer(path, pi)
+    print(f'listening on {path}', flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+# CTAPHID: KEEPALIVE command (0x80 | 0x3b) with status UPNEEDED.
+CTAPHID_KEEPALIVE = 0xbb
+KEEPALIVE_STATUS_UPNEEDED = 2
+
+def find_hidraw(vid, pid):
+    """
+    Returns the /dev/hidrawN path of the first HID device with the given VID:PID, or None.
+    """
+    hid_id = '%08X:%08X' % (vid, pid)
+    try:
+        names = sorted(os.listdir('/sys/class/hidraw'))
+    except FileNotFoundError:
+        return None
+    for name in names:
+        try:
+            with open(f'/sys/class/hidraw/{name}/device/uevent') as f:
+                if hid_id in f.read().upper():
+                    return f'/dev/{name}'
+        except OSError:
+            pass
+    return None
+
+class GpioPresenceSignal:
+    """
+    Device signals it is waiting for user presence with an edge on one of the extra GPIOs.
+    """
+    def __init__(self, pin, edge = 'falling'):
+        self.pin = pin
+        self.edge = {'rising': pigpio.RISING_EDGE, 'falling': pigpio.FALLING_EDGE, 'either': pigpio.EITHER_EDGE}[edge]
 
-def hexify(number):
+    def start(self, pi, loop, notify):
+        pin_state(pi).set_mode([self.pin], pigpio.INPUT)
+        # pigpio runs callbacks on its notification thread.
+        self.callback = pi.callback(self.pin, self.edge, lambda gpio, level, tick: loop.call_soon_threadsafe(notify))
+
+class HidKeepalivePresenceSignal:
     """
-    Convert integer to hex string representation, e.g. 12 to '0C'
+    Watches the device's CTAPHID traffic for KEEPALIVE(UPNEEDED).  Linux hands every
+    reader of a hidraw node a copy of each input report, so this does not take
+    anything away from the test client.
     """
-    if number < 0:
-        raise ValueError('Invalid number to hexify - must be positive')
+    def __init__(self, path = None, vid = None, pid = None):
+        self.path = path
+        self.vid = vid
+        self.pid = pid
+        self.fd = None
+
+    def start(self, pi, loop, notify):
+        self.loop = loop
+        self.notify = notify
+        self._open()
+
+    def _open(self):
+        path = self.path or find_hidraw(self.vid, self.pid)
+        try:
+            self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK) if path else None
+        except OSError:
+            self.fd = None
+        if self.fd is None:
+            # Device is rebooting or not enumerated yet.
+            self.loop.call_later(.25, self._open)
+            return
+        self.loop.add_reader(self.fd, self._read)
+
+    def _read(self):
+        try:
+            report = os.read(self.fd, 64)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.loop.call_later(.25, self._open)
+            return
+        if len(report) > 7 and report[4] == CTAPHID_KEEPALIVE and report[7] == KEEPALIVE_STATUS_UPNEEDED:
+            self.notify()
+
+def parse_presence_signal(spec):
+    """
+    gpio:<pin name or number>[:rising|falling|either], hid:<vid>:<pid> or hid:/dev/hidrawN
+    """
+    kind, _, rest = spec.partition(':')
+    if kind == 'gpio':
+        pin, _, edge = rest.partition(':')
+        pin = int(pin) if pin.isdigit() else getattr(Pins, pin)
+        return GpioPresenceSignal(pin, edge or 'falling')
+    elif kind == 'hid':
+        if rest.startswith('/'):
+            return HidKeepalivePresenceSignal(path = rest)
+        vid, pid = rest.split(':')
+        return HidKeepalivePresenceSignal(vid = int(vid, 16), pid = int(pid, 16))
+    raise ValueError(f"Invalid presence signal: {spec}")
+
+async def run_presser(pi, signal, latency = 0, press = 100, cooldown = 250):
+    """
+    Presses Button1 whenever the device asks for user presence.  Times are in ms.
+    `cooldown` swallows the repeated requests (e.g. keepalives every 100ms) that
+    were already in flight when the button was pressed.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    requested = asyncio.Event()
+    signal.start(pi, loop, requested.set)
+    sequence = Sequence().low(Pins.Button1).wait(press).high(Pins.Button1)
+
+    while True:
+        await requested.wait()
+        start = time.monotonic()
+        if latency:
+            await asyncio.sleep(latency / 1000)
+        await loop.run_in_executor(None, sequence.run, pi)
+        print(f'[{start:.6f}] pressed Button1', flush=True)
+        await asyncio.sleep(cooldown / 1000)
+        requested.clear()
+
+@command('presser', usage = '[--signal ...] [--latency ms] [--press ms] [--cooldown ms]')
+def presser_main(pi, argv):
+    import argparse
+    import asyncio
+    parser = argparse.ArgumentParser(prog = 'control.py presser', description = 'Press Button1 when the device waits for user presence.')
+    parser.add_argument('--signal', default = 'hid:1209:beee', help = 'gpio:ExtraGpio1[:falling], hid:1209:beee or hid:/dev/hidrawN')
+    parser.add_argument('--latency', type = float, default = 0, help = 'ms to wait before pressing')
+    parser.add_argument('--press', type = float, default = 100, help = 'ms to hold the button')
+    parser.add_argument('--cooldown', type = float, default = 250, help = 'ms to ignore requests after a press')
+    args = parser.parse_args(argv)
+    asyncio.run(run_presser(pi, parse_presence_signal(args.signal), args.latency, args.press, args.cooldown))
+
+
+def profile(label, start):
+    print(f'{label}: {(time.perf_counter() - start) * 1000:.1f} ms', file = sys.stderr)
 
-    result = hex(int(number)).replace('0x', '').upper()
-    if divmod(len(result), 2)[1] == 1:
-        # Padding
-        result = '0{}'.format(result)
-    return result
+if __name__ == "__main__":
+    profile_startup = '--profile-startup' in sys.argv
+    argv = [arg for arg in sys.argv if arg != '--profile-startup']
+
+    if len(argv) < 2 or argv[1].lower() not in COMMANDS:
+        print(f"usage: {argv[0]} [--profile-startup] <command>")
+        for cmd in COMMANDS.values():
+            print(f"    {cmd.name} {cmd.usage}")
+        sys.exit(1)
 
+    cmd = COMMANDS[argv[1].lower()]
+    if profile_startup:
+        profile('load control.py', _module_start)
+
+    for need in cmd.needs:
+        start = time.perf_counter()
+        load_dependency(need)
+        if profile_startup:
+            profile(f'import {need}', start)
+
+    pi = None
+    if 'gpio' in cmd.needs:
+        start = time.perf_counter()
+        # if running on PC, set PIGPIO_ADDR=192.168.1.111, or to whatever your pi addr is.
+        pi = pigpio.pi()
+        if profile_startup:
+            profile('connect pigpiod', start)
+
+    start = time.perf_counter()
+    if cmd.usage:
+        cmd.func(pi, argv[2:])
+    else:
+        cmd.func(pi)
+    if profile_startup:
+        profile(f'run {cmd.name}', start)
+        profile('total', _module_start)
@@ -0,0 +1,49 @@
+import os
+import sys
+import socket
+
+# Thin client for `control.py serve`.  Only uses the standard library so it
+# starts quickly; if no daemon is listening it falls back to running
+# control.py directly.
+#
+#   python3 control.py serve &
+#   python3 control_client.py toggle-button-1
+#
+# From a shell without python: echo toggle-button-1 | nc -U /tmp/solo2-hw-ci-control.sock
+
+CONTROL_SOCKET = os.environ.get('SOLO2_CONTROL_SOCKET', '/tmp/solo2-hw-ci-control.sock')
+
+def send_commands(commands, path = CONTROL_SOCKET):
+    """
+    Sends each command to the daemon and returns the list of replies.
+    """
+    replies = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        f = s.makefile('rwb')
+        for command in commands:
+            f.write((command + '\n').encode('utf8'))
+            f.flush()
+            replies.append(f.readline().decode('utf8').strip())
+    return replies
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} <command> [<command> ...]")
+        sys.exit(1)
+
+    try:
+        replies = send_commands(sys.argv[1:])
+    except (FileNotFoundError, ConnectionRefusedError):
+        control = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'control.py')
+        for command in sys.argv[1:]:
+            if os.spawnv(os.P_WAIT, sys.executable, [sys.executable, control, command]) != 0:
+                sys.exit(1)
+        sys.exit(0)
+
+    failed = False
+    for command, reply in zip(sys.argv[1:], replies):
+        print(f'{command}: {reply}')
+        if not reply.startswith('ok'):
+            failed = True
+    sys.exit(1 if failed else 0)
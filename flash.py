@@ -0,0 +1,394 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import socket
+import struct
+import hashlib
+import argparse
+import binascii
+import xml.etree.ElementTree as ElementTree
+
+# Programs the DUT through JLinkGDBServer's GDB remote protocol port, without
+# gdb: the ELF's PT_LOAD segments are erased and written with vFlashErase/
+# vFlashWrite/vFlashDone and verified with qCRC.  The hash of the last image
+# flashed to each DUT is kept in a state file, when it matches and the flash
+# still checksums to it the image is not flashed again.
+#
+#   python3 flash.py program provisioner/runner --dut provisioner
+#   python3 flash.py run &
+#
+# `run` takes the place of jlink.gdb's rebootloop: it enables semihosting,
+# resets the target and keeps it running, restarting it whenever it stops.
+# gdbserver_stub.py stands in for JLinkGDBServer off the rig.
+
+GDBSERVER = os.environ.get('SOLO2_GDBSERVER', 'localhost:2331')
+STATE_PATH = os.environ.get('SOLO2_FLASH_STATE', os.path.expanduser('~/.cache/solo2-hw-ci/flash-state.json'))
+
+PT_LOAD = 1
+
+class FlashError(Exception):
+    pass
+
+def load_segments(path):
+    """
+    [(load address, contents)] of the PT_LOAD segments of a little endian ELF32 file.
+    """
+    with open(path, 'rb') as f:
+        elf = f.read()
+    if elf[:4] != b'\x7fELF' or elf[4] != 1 or elf[5] != 1:
+        raise FlashError(f"{path} is not a little endian ELF32 file")
+    phoff, = struct.unpack_from('<I', elf, 28)
+    phentsize, phnum = struct.unpack_from('<HH', elf, 42)
+    segments = []
+    for i in range(phnum):
+        p_type, offset, vaddr, paddr, filesz, memsz, flags, align = struct.unpack_from('<8I', elf, phoff + i * phentsize)
+        # Like gdb's load, at the physical (load) address, .data is copied out of flash at boot.
+        if p_type == PT_LOAD and filesz:
+            segments.append((paddr, elf[offset:offset + filesz]))
+    return sorted(segments)
+
+def image_hash(segments):
+    """
+    Hash of what gets programmed, so rebuilds that only change debug info still match.
+    """
+    h = hashlib.sha256()
+    for address, data in segments:
+        h.update(struct.pack('<II', address, len(data)))
+        h.update(data)
+    return h.hexdigest()
+
+# Bit reversal of each byte value.
+_REVERSED = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+def _reverse32(value):
+    return int('{:032b}'.format(value)[::-1], 2)
+
+def crc32(data, crc = 0xffffffff):
+    """
+    The checksum qCRC answers with: CRC-32 polynomial 0x04c11db7, MSB first,
+    no final xor.  zlib does the reflected variant of the same CRC, so it is
+    fed bit reversed bytes and the result reversed back.
+    """
+    return _reverse32(zlib.crc32(data.translate(_REVERSED), _reverse32(crc) ^ 0xffffffff) ^ 0xffffffff)
+
+def escape(data):
+    # Binary packet data, see "Binary Data" in the GDB remote protocol docs
+    return re.sub(rb'[#$}*]', lambda m: bytes((0x7d, m.group()[0] ^ 0x20)), data)
+
+def unescape(data):
+    return re.sub(rb'}(.)', lambda m: bytes((m.group(1)[0] ^ 0x20,)), data, flags = re.DOTALL)
+
+def decode_run_length(data):
+    # X*n repeats X another ord(n) - 29 times
+    return re.sub(rb'(.)\*(.)', lambda m: m.group(1) * (m.group(2)[0] - 28), data, flags = re.DOTALL)
+
+class GdbRemote():
+    """
+    Client side of the GDB remote serial protocol, just what flashing needs.
+    """
+
+    def __init__(self, address = GDBSERVER, timeout = 30):
+        host, _, port = address.rpartition(':')
+        self.sock = socket.create_connection((host or 'localhost', int(port)), timeout = timeout)
+        # Every packet waits for its reply, don't let Nagle hold them back.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+        self.ack = True
+        self.packet_size = 400
+        supported = self.command(b'qSupported:multiprocess-;swbreak+;hwbreak+').split(b';')
+        self.features = {}
+        for feature in supported:
+            name, _, value = feature.partition(b'=')
+            self.features[name.decode()] = value.decode() if value else True
+        if 'PacketSize' in self.features:
+            self.packet_size = int(self.features['PacketSize'], 16)
+        if 'QStartNoAckMode+' in self.features:
+            if self.command(b'QStartNoAckMode') == b'OK':
+                self.ack = False
+        self.command(b'?')
+
+    def _read(self, n = 1):
+        while len(self.buffer) < n:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise FlashError("GDB server closed the connection")
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def send(self, payload):
+        packet = b'$' + payload + b'#%02x' % (sum(payload) & 0xff)
+        while True:
+            self.sock.sendall(packet)
+            if not self.ack:
+                return
+            reply = self._read()
+            while reply not in b'+-':
+                reply = self._read()
+            if reply == b'+':
+                return
+
+    def receive(self):
+        while self._read() != b'$':
+            pass
+        payload = bytearray()
+        while True:
+            c = self._read()
+            if c == b'#':
+                break
+            payload += c
+        checksum = int(self._read(2), 16)
+        if self.ack:
+            if sum(payload) & 0xff != checksum:
+                self.sock.sendall(b'-')
+                return self.receive()
+            self.sock.sendall(b'+')
+        return decode_run_length(bytes(payload))
+
+    def command(self, payload, output = None):
+        """
+        Sends a packet and returns the reply.  Console output ('O' packets) on
+        the way is passed to `output`, printed by default.
+        """
+        self.send(payload)
+        while True:
+            reply = self.receive()
+            if reply.startswith(b'O') and reply != b'OK' and len(reply) % 2:
+                text = binascii.unhexlify(reply[1:]).decode('utf8', 'replace')
+                (output or sys.stdout.write)(text)
+                continue
+            return reply
+
+    def checked(self, payload):
+        reply = self.command(payload)
+        if reply != b'OK':
+            raise FlashError(f"{payload[:32].decode('ascii', 'replace')}: {reply.decode('ascii', 'replace') or 'not supported'}")
+
+    def monitor(self, text):
+        """
+        A `monitor` command, returns what the server printed.
+        """
+        output = []
+        reply = self.command(b'qRcmd,' + binascii.hexlify(text.encode()), output.append)
+        if reply != b'OK':
+            raise FlashError(f"monitor {text}: {reply.decode('ascii', 'replace')}")
+        return ''.join(output)
+
+    def memory_map(self):
+        """
+        [(start, length, type, blocksize)], empty if the server has no memory map.
+        """
+        if 'qXfer:memory-map:read+' not in self.features:
+            return []
+        xml = b''
+        while True:
+            reply = self.command(b'qXfer:memory-map:read::%x,%x' % (len(xml), self.packet_size - 5))
+            if not reply or reply[:1] not in b'ml':
+                raise FlashError(f"memory map: {reply.decode('ascii', 'replace')}")
+            xml += unescape(reply[1:])
+            if reply[:1] == b'l':
+                break
+        regions = []
+        for memory in ElementTree.fromstring(xml).iter('memory'):
+            blocksize = memory.find("property[@name='blocksize']")
+            regions.append((int(memory.get('start'), 0), int(memory.get('length'), 0), memory.get('type'),
+                    int(blocksize.text, 0) if blocksize is not None else None))
+        return regions
+
+    def write_packets(self, data, address, flash = True):
+        """
+        Writes `data` with as few vFlashWrite (or X, for RAM) packets as fit the server's packet size.
+        """
+        position = 0
+        while position < len(data):
+            # ",<length>" of X takes at most 9 more bytes
+            header = b'vFlashWrite:%x:' % (address + position) if flash else b'X%x,' % (address + position)
+            room = self.packet_size - len(header) - (4 if flash else 13)
+            n = room
+            chunk = escape(data[position:position + n])
+            while len(chunk) > room:
+                n -= len(chunk) - room
+                chunk = escape(data[position:position + n])
+            n = min(n, len(data) - position)
+            if not flash:
+                header += b'%x:' % n
+            reply = self.command(header + chunk)
+            if reply != b'OK':
+                raise FlashError(f"write at {address + position:#x}: {reply.decode('ascii', 'replace')}")
+            position += n
+
+    def crc(self, address, length):
+        reply = self.command(b'qCRC:%x,%x' % (address, length))
+        if not reply.startswith(b'C'):
+            raise FlashError(f"qCRC at {address:#x}: {reply.decode('ascii', 'replace')}")
+        return int(reply[1:], 16)
+
+    def detach(self):
+        try:
+            self.command(b'D')
+        finally:
+            self.sock.close()
+
+def erase_ranges(segments, regions):
+    """
+    Flash blocks covering the segments in flash, merged, as [(start, end)].
+    """
+    ranges = []
+    for address, data in segments:
+        end = address + len(data)
+        for start, length, kind, blocksize in regions:
+            if kind == 'flash' and start <= address < start + length:
+                blocksize = blocksize or 1
+                address = start + (address - start) // blocksize * blocksize
+                end = min(start + length, start + -(-(end - start) // blocksize) * blocksize)
+                break
+        else:
+            if regions:
+                # RAM, written with plain memory writes
+                continue
+        if ranges and address <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((address, end))
+    return ranges
+
+def in_flash(address, regions):
+    if not regions:
+        return True
+    return any(kind == 'flash' and start <= address < start + length for start, length, kind, _ in regions)
+
+def verify(remote, segments):
+    """
+    Addresses of the segments whose qCRC doesn't match the image.
+    """
+    return [address for address, data in segments if remote.crc(address, len(data)) != crc32(data)]
+
+class FlashState():
+    """
+    {DUT: last image flashed}, in a JSON file.
+    """
+
+    def __init__(self, path = STATE_PATH):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, dut):
+        return self.load().get(dut)
+
+    def put(self, dut, entry):
+        state = self.load()
+        if entry is None:
+            state.pop(dut, None)
+        else:
+            state[dut] = entry
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f, indent = 1)
+        os.replace(self.path + '.tmp', self.path)
+
+def program(remote, segments, state, dut, force = False):
+    """
+    Flashes `segments` unless the state says the DUT already has them and the
+    flash checksums agree.  Returns True if it flashed.
+    """
+    digest = image_hash(segments)
+    size = sum(len(data) for _, data in segments)
+    last = state.get(dut)
+    if not force and last is not None and last['sha256'] == digest:
+        start = time.monotonic()
+        if not verify(remote, segments):
+            print(f"{dut} already has image {digest[:16]}, {size} bytes checked by CRC in {time.monotonic() - start:.2f} s")
+            return False
+        print(f"{dut} should have image {digest[:16]} but its flash differs, flashing")
+
+    # Until verified the flash contents are unknown.
+    state.put(dut, None)
+    regions = remote.memory_map()
+    timings = []
+    start = time.monotonic()
+    for address, end in erase_ranges(segments, regions):
+        remote.checked(b'vFlashErase:%x,%x' % (address, end - address))
+    timings.append(('erase', time.monotonic() - start))
+
+    start = time.monotonic()
+    for address, data in segments:
+        remote.write_packets(data, address, in_flash(address, regions))
+    remote.checked(b'vFlashDone')
+    timings.append(('write', time.monotonic() - start))
+
+    start = time.monotonic()
+    bad = verify(remote, segments)
+    timings.append(('verify', time.monotonic() - start))
+    if bad:
+        raise FlashError("CRC mismatch after flashing at " + ', '.join(f'{address:#x}' for address in bad))
+
+    state.put(dut, {'sha256': digest, 'bytes': size, 'flashed': time.time()})
+    print(f"Flashed {dut} with image {digest[:16]}, {size} bytes: " + ', '.join(f'{name} {took:.2f} s' for name, took in timings))
+    return True
+
+def run(remote, semihosting = True):
+    """
+    Keeps the target running, resetting it whenever it stops, until interrupted.
+    """
+    if semihosting:
+        remote.monitor('semihosting enable')
+        remote.monitor('semihosting IOClient 3')
+    remote.monitor('reset')
+    # The target may run for the rest of the job.
+    remote.sock.settimeout(None)
+    def output(text):
+        # Unbuffered, for semihosting.py reading from a pipe
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    try:
+        while True:
+            reply = remote.command(b'c', output)
+            print(f"target stopped ({reply.decode('ascii', 'replace')}), restarting", flush = True)
+            remote.monitor('reset')
+    except KeyboardInterrupt:
+        remote.sock.sendall(b'\x03')
+        remote.receive()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Flash the DUT through JLinkGDBServer.")
+    parser.add_argument('--gdbserver', default = GDBSERVER, help = "[host:]port (default: %(default)s)")
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    p = commands.add_parser('program', help = "flash an ELF image unless the DUT already has it")
+    p.add_argument('image')
+    p.add_argument('--dut', default = os.environ.get('SOLO2_DUT', 'lpc55'), help = "name the state is kept under (default: %(default)s)")
+    p.add_argument('--state', default = STATE_PATH, help = "state file (default: %(default)s)")
+    p.add_argument('--force', action = 'store_true', help = "flash even if the DUT has the image")
+    p.add_argument('--no-reset', action = 'store_true', help = "leave the target halted")
+
+    p = commands.add_parser('run', help = "keep the target running with semihosting, like jlink.gdb's rebootloop")
+    p.add_argument('--no-semihosting', action = 'store_true')
+
+    args = parser.parse_args()
+    try:
+        remote = GdbRemote(args.gdbserver)
+        if args.command == 'program':
+            segments = load_segments(args.image)
+            program(remote, segments, FlashState(args.state), args.dut, args.force)
+            if not args.no_reset:
+                remote.monitor('reset')
+                remote.monitor('go')
+            remote.detach()
+        elif args.command == 'run':
+            try:
+                run(remote, not args.no_semihosting)
+            finally:
+                remote.detach()
+    except (FlashError, OSError) as e:
+        print(f"flash.py {args.command}: {e}")
+        sys.exit(1)
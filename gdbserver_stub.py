@@ -0,0 +1,202 @@
+import re
+import sys
+import socket
+import time
+import binascii
+import threading
+import socketserver
+
+from flash import crc32, escape, unescape
+
+# Minimal stand-in for JLinkGDBServer so flash.py can be exercised off the rig.
+# It speaks enough of the GDB remote protocol for flashing: qSupported with
+# no-ack mode, a memory map, vFlashErase/vFlashWrite/vFlashDone, X, m, qCRC,
+# qRcmd and D.  Flash starts erased and keeps its contents between
+# connections, like the real part.  `c` never stops, interrupt it with ^C.
+# qCRC and binary data use flash.py's helpers, so both ends agree bit for bit.
+#
+#   python3 gdbserver_stub.py 2331 &
+#   python3 flash.py --gdbserver localhost:2331 program provisioner/runner
+
+# LPC55S69: 608 KB of flash in 512 byte pages, 256 KB of RAM
+FLASH = (0x0, 0x98000, 0x200)
+RAM = (0x20000000, 0x40000)
+
+MEMORY_MAP = (
+    '<?xml version="1.0"?>\n'
+    '<!DOCTYPE memory-map PUBLIC "+//IDN gnu.org//DTD GDB Memory Map V1.0//EN" "http://sourceware.org/gdb/gdb-memory-map.dtd">\n'
+    '<memory-map>\n'
+    f'<memory type="flash" start="{FLASH[0]:#x}" length="{FLASH[1]:#x}"><property name="blocksize">{FLASH[2]:#x}</property></memory>\n'
+    f'<memory type="ram" start="{RAM[0]:#x}" length="{RAM[1]:#x}"/>\n'
+    '</memory-map>\n'
+).encode()
+
+PACKET_SIZE = 0x4000
+
+class Target:
+    """
+    Memory of the fake LPC55, shared by all connections.
+    """
+    def __init__(self, verbose = False):
+        self.lock = threading.Lock()
+        self.verbose = verbose
+        self.flash = bytearray(b'\xff' * FLASH[1])
+        self.ram = bytearray(RAM[1])
+        # Bytes erased and written, to see what a flash.py run did.
+        self.erased = 0
+        self.written = 0
+        # [(address, length)] of every erase and write, for test_flash.py
+        self.erases = []
+        self.writes = []
+
+    def log(self, text):
+        if self.verbose:
+            print(f'[{time.monotonic():.6f}] {text}', flush=True)
+
+    def region(self, address, length):
+        for (start, size, *_), memory in ((FLASH, self.flash), (RAM, self.ram)):
+            if start <= address and address + length <= start + size:
+                return memory, address - start
+        raise IndexError(f'{address:#x}+{length:#x} is not mapped')
+
+    def erase(self, address, length):
+        start, size, page = FLASH
+        if (address - start) % page or length % page:
+            raise IndexError(f'erase of {address:#x}+{length:#x} is not page aligned')
+        memory, offset = self.region(address, length)
+        memory[offset:offset + length] = b'\xff' * length
+        self.erased += length
+        self.erases.append((address, length))
+
+    def write(self, address, data, flash):
+        memory, offset = self.region(address, len(data))
+        if flash and memory is self.flash and memory[offset:offset + len(data)].count(0xff) != len(data):
+            raise IndexError(f'write to {address:#x} is not erased')
+        memory[offset:offset + len(data)] = data
+        self.written += len(data)
+        self.writes.append((address, len(data)))
+
+    def read(self, address, length):
+        memory, offset = self.region(address, length)
+        return bytes(memory[offset:offset + length])
+
+class GdbRequestHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+        self.ack = True
+
+    def read(self, n = 1):
+        while len(self.buffer) < n:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                raise ConnectionError()
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def receive(self):
+        while True:
+            c = self.read()
+            if c == b'$':
+                break
+            if c == b'\x03':
+                return b'\x03'
+        while b'#' not in self.buffer:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                raise ConnectionError()
+            self.buffer += chunk
+        payload = self.read(self.buffer.index(b'#'))
+        self.read(3)
+        if self.ack:
+            self.request.sendall(b'+')
+        return payload
+
+    def send(self, payload):
+        self.request.sendall(b'$' + payload + b'#%02x' % (sum(payload) & 0xff))
+        if self.ack:
+            self.read()
+
+    def handle(self):
+        target = self.server.target
+        target.log('connected')
+        try:
+            while True:
+                packet = self.receive()
+                with target.lock:
+                    reply = self.dispatch(target, packet)
+                if reply is not None:
+                    self.send(reply)
+                if packet == b'D':
+                    break
+        except ConnectionError:
+            pass
+        target.log(f'disconnected, {target.erased} bytes erased and {target.written} written so far')
+
+    def dispatch(self, target, packet):
+        name = re.match(rb'[a-zA-Z?!]+', packet)
+        name = name.group() if name else packet[:1]
+        try:
+            if packet.startswith(b'qSupported'):
+                return b'PacketSize=%x;QStartNoAckMode+;qXfer:memory-map:read+' % PACKET_SIZE
+            if packet == b'QStartNoAckMode':
+                self.send(b'OK')
+                self.ack = False
+                return None
+            if packet == b'?':
+                return b'S05'
+            if packet.startswith(b'qXfer:memory-map:read::'):
+                offset, length = (int(v, 16) for v in packet.split(b'::')[1].split(b','))
+                chunk = MEMORY_MAP[offset:offset + length]
+                return (b'm' if offset + length < len(MEMORY_MAP) else b'l') + escape(chunk)
+            if packet.startswith(b'vFlashErase:'):
+                address, length = (int(v, 16) for v in packet[12:].split(b','))
+                target.erase(address, length)
+                target.log(f'erased {address:#x}+{length:#x}')
+                return b'OK'
+            if packet.startswith(b'vFlashWrite:') or packet.startswith(b'X'):
+                flash = packet.startswith(b'v')
+                header, _, data = packet[12 if flash else 1:].partition(b':')
+                address = int(header.split(b',')[0], 16)
+                target.write(address, unescape(data), flash)
+                return b'OK'
+            if packet == b'vFlashDone':
+                target.log('flash done')
+                return b'OK'
+            if packet.startswith(b'm'):
+                address, length = (int(v, 16) for v in packet[1:].split(b','))
+                return binascii.hexlify(target.read(address, length))
+            if packet.startswith(b'qCRC:'):
+                address, length = (int(v, 16) for v in packet[5:].split(b','))
+                return b'C%08x' % crc32(target.read(address, length))
+            if packet.startswith(b'qRcmd,'):
+                command = binascii.unhexlify(packet[6:]).decode()
+                target.log(f'monitor {command}')
+                self.send(b'O' + binascii.hexlify(f'{command}: done\n'.encode()))
+                return b'OK'
+            if packet in (b'c', b'\x03'):
+                # Runs until interrupted, the interrupt is answered as the stop.
+                return None if packet == b'c' else b'S02'
+            if packet in (b'D', b'k'):
+                return b'OK'
+        except IndexError as e:
+            target.log(f'{name.decode()}: {e}')
+            return b'E01'
+        target.log(f'unsupported packet {name.decode()}')
+        return b''
+
+class GdbServerStub(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, verbose = False):
+        self.target = Target(verbose)
+        super().__init__(address, GdbRequestHandler)
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 2331
+    server = GdbServerStub(('localhost', port), verbose = True)
+    print(f'gdbserver stub listening on localhost:{port}', flush=True)
+    server.serve_forever()
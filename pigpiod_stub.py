@@ -0,0 +1,217 @@
+import sys
+import time
+import struct
+import threading
+import socketserver
+
+# Minimal stand-in for pigpiod so control.py can be exercised off-Pi.
+# It speaks enough of the pigpiod socket protocol for the pigpio python
+# module: pin modes, levels, bank reads/writes, level change notifications
+# and one-shot waves.
+#
+#   python3 pigpiod_stub.py 8888 &
+#   PIGPIO_ADDR=localhost PIGPIO_PORT=8888 python3 control.py serve
+
+CMD_MODES = 0
+CMD_MODEG = 1
+CMD_READ = 3
+CMD_WRITE = 4
+CMD_BR1 = 10
+CMD_BC1 = 12
+CMD_BS1 = 14
+CMD_TICK = 16
+CMD_NB = 19
+CMD_NC = 21
+CMD_WVCLR = 27
+CMD_WVAG = 28
+CMD_WVBSY = 32
+CMD_WVHLT = 33
+CMD_WVCRE = 49
+CMD_WVDEL = 50
+CMD_WVTX = 51
+CMD_WVNEW = 53
+CMD_NOIB = 99
+
+MODE_INPUT = 0
+MODE_OUTPUT = 1
+
+class GpioState:
+    """
+    Shared pin state of the fake Pi.
+    """
+    def __init__(self, verbose = False):
+        self.lock = threading.Lock()
+        self.verbose = verbose
+        self.start = time.monotonic()
+        self.modes = {}
+        self.levels = 0
+        # handle -> [socket, monitored bits, sequence number]
+        self.notifiers = {}
+        self.next_handle = 0
+        self.pending_pulses = []
+        self.waves = {}
+        self.next_wave = 0
+        self.wave_thread = None
+        self.wave_stop = threading.Event()
+
+    def tick(self):
+        return int((time.monotonic() - self.start) * 1e6) & 0xffffffff
+
+    def set_mode(self, gpio, mode):
+        with self.lock:
+            self.modes[gpio] = mode
+        if self.verbose:
+            print(f'[{time.monotonic():.6f}] mode {gpio} = {mode}', flush=True)
+
+    def change_levels(self, set_bits, clear_bits):
+        with self.lock:
+            levels = (self.levels | set_bits) & ~clear_bits
+            changed = levels ^ self.levels
+            self.levels = levels
+            if changed:
+                self._notify(changed)
+        if self.verbose and changed:
+            print(f'[{time.monotonic():.6f}] levels {levels:08x} (changed {changed:08x})', flush=True)
+
+    def _notify(self, changed):
+        tick = self.tick()
+        for handle, notifier in list(self.notifiers.items()):
+            sock, bits, seq = notifier
+            if bits & changed:
+                notifier[2] = (seq + 1) & 0xffff
+                try:
+                    sock.sendall(struct.pack('HHII', seq, 0, tick, self.levels))
+                except OSError:
+                    del self.notifiers[handle]
+
+    def add_notifier(self, sock):
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+            self.notifiers[handle] = [sock, 0, 0]
+        return handle
+
+    def set_notify_bits(self, handle, bits):
+        with self.lock:
+            if handle in self.notifiers:
+                self.notifiers[handle][1] = bits
+
+    def close_notifier(self, handle):
+        with self.lock:
+            self.notifiers.pop(handle, None)
+
+    def create_wave(self):
+        wave = self.next_wave
+        self.next_wave += 1
+        self.waves[wave] = self.pending_pulses
+        self.pending_pulses = []
+        return wave
+
+    def send_wave(self, wave):
+        pulses = self.waves[wave]
+        self.wave_stop.clear()
+
+        def transmit():
+            # Real pigpiod uses DMA, sleeping is close enough for testing.
+            for on, off, delay in pulses:
+                if self.wave_stop.is_set():
+                    break
+                self.change_levels(on, off)
+                time.sleep(delay / 1e6)
+
+        self.wave_thread = threading.Thread(target = transmit, daemon = True)
+        self.wave_thread.start()
+
+    def wave_busy(self):
+        return self.wave_thread is not None and self.wave_thread.is_alive()
+
+
+class PigpiodRequestHandler(socketserver.BaseRequestHandler):
+
+    def recv_exact(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError()
+            data += chunk
+        return data
+
+    def handle(self):
+        state = self.server.state
+        try:
+            while True:
+                cmd, p1, p2, p3 = struct.unpack('IIII', self.recv_exact(16))
+                ext = self.recv_exact(p3) if p3 else b''
+                res = self.dispatch(state, cmd, p1, p2, ext)
+                if cmd == CMD_NC:
+                    # Notification socket is being closed, no reply expected.
+                    return
+                self.request.sendall(struct.pack('IIII', cmd, p1, p2, res & 0xffffffff))
+        except (ConnectionError, OSError):
+            pass
+
+    def dispatch(self, state, cmd, p1, p2, ext):
+        if cmd == CMD_MODES:
+            state.set_mode(p1, p2)
+        elif cmd == CMD_MODEG:
+            return state.modes.get(p1, MODE_INPUT)
+        elif cmd == CMD_READ:
+            return (state.levels >> p1) & 1
+        elif cmd == CMD_WRITE:
+            # pigpiod switches the pin to output on write.
+            state.set_mode(p1, MODE_OUTPUT)
+            if p2:
+                state.change_levels(1 << p1, 0)
+            else:
+                state.change_levels(0, 1 << p1)
+        elif cmd == CMD_BR1:
+            return state.levels
+        elif cmd == CMD_BS1:
+            state.change_levels(p1, 0)
+        elif cmd == CMD_BC1:
+            state.change_levels(0, p1)
+        elif cmd == CMD_TICK:
+            return state.tick()
+        elif cmd == CMD_NOIB:
+            return state.add_notifier(self.request)
+        elif cmd == CMD_NB:
+            state.set_notify_bits(p1, p2)
+        elif cmd == CMD_NC:
+            state.close_notifier(p1)
+        elif cmd in (CMD_WVNEW, CMD_WVCLR):
+            state.pending_pulses = []
+            if cmd == CMD_WVCLR:
+                state.waves.clear()
+        elif cmd == CMD_WVAG:
+            for i in range(0, len(ext), 12):
+                state.pending_pulses.append(struct.unpack('III', ext[i:i + 12]))
+        elif cmd == CMD_WVCRE:
+            return state.create_wave()
+        elif cmd == CMD_WVTX:
+            state.send_wave(p1)
+        elif cmd == CMD_WVBSY:
+            return int(state.wave_busy())
+        elif cmd == CMD_WVHLT:
+            state.wave_stop.set()
+        elif cmd == CMD_WVDEL:
+            state.waves.pop(p1, None)
+        elif state.verbose:
+            print(f'unhandled command {cmd} ({p1}, {p2})', flush=True)
+        return 0
+
+
+class PigpiodStub(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, verbose = False):
+        self.state = GpioState(verbose)
+        super().__init__(address, PigpiodRequestHandler)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8888
+    server = PigpiodStub(('localhost', port), verbose = True)
+    print(f'pigpiod stub listening on localhost:{port}', flush=True)
+    server.serve_forever()
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import atexit
+import threading
+from collections import deque
+
+# Opt-in timing of every APDU.  Set SOLO2_APDU_STATS to a path prefix and
+# SmartCardDevice (and control.py's Reader) record each command's
+# time.monotonic() start and end, instruction, payload size and status word.
+# Latencies go into fixed-bucket histograms per instruction.  At exit they
+# are written to <prefix>.json and to <prefix>.prom, a Prometheus textfile
+# for node_exporter.
+#
+#   SOLO2_APDU_STATS=/tmp/provision python3 provision_fido2_trussed.py ...
+
+# Upper bounds in seconds, the last bucket catches the rest.
+BUCKETS = (.0005, .001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5, float('inf'))
+
+# Most recent records kept for the JSON dump, the histograms count everything.
+MAX_RECORDS = 100000
+
+class Histogram():
+    """
+    Fixed-bucket latency histogram, percentiles are interpolated within a bucket.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.bytes = 0
+        self.status = {}
+
+    def add(self, seconds, size, sw):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.bytes += size
+        self.status[sw] = self.status.get(sw, 0) + 1
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = max(BUCKETS[i - 1] if i else 0.0, self.min)
+                upper = min(BUCKETS[i], self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+class ApduStats():
+    """
+    Per-instruction histograms and the latest raw records.  Anything with a
+    `record(ins, size, sw, start, end)` method can stand in for it.
+    """
+
+    def __init__(self, names = None):
+        # ins -> name, e.g. {0xa4: 'Select'}; unknown ones show up as hex
+        self.names = names or {}
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.histograms = {}
+        self.records = deque(maxlen = MAX_RECORDS)
+
+    def name(self, ins):
+        return self.names.get(ins, '0x%02x' % ins)
+
+    def record(self, ins, size, sw, start, end):
+        with self.lock:
+            histogram = self.histograms.get(ins)
+            if histogram is None:
+                histogram = self.histograms[ins] = Histogram()
+            histogram.add(end - start, size, sw)
+            self.records.append((start, end, ins, size, sw))
+
+    def summary(self):
+        """
+        Per-instruction count, latency percentiles in ms and bytes sent, as text.
+        """
+        lines = [f'{"instruction":28} {"count":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8} {"bytes":>9}']
+        with self.lock:
+            for ins, h in sorted(self.histograms.items(), key = lambda item: -item[1].sum):
+                lines.append(f'{self.name(ins):28} {h.count:7} {h.percentile(50) * 1000:8.1f} {h.percentile(95) * 1000:8.1f}'
+                             f' {h.percentile(99) * 1000:8.1f} {h.max * 1000:8.1f} {h.bytes:9}')
+        return '\n'.join(lines)
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'buckets': [bound if bound != float('inf') else None for bound in BUCKETS],
+                'instructions': {
+                    self.name(ins): {
+                        'ins': ins,
+                        'count': h.count,
+                        'sum': h.sum,
+                        'min': h.min,
+                        'max': h.max,
+                        'bytes': h.bytes,
+                        'counts': h.counts,
+                        'p50': h.percentile(50),
+                        'p95': h.percentile(95),
+                        'p99': h.percentile(99),
+                        'status': {'%04x' % sw: count for sw, count in h.status.items()},
+                    } for ins, h in self.histograms.items()
+                },
+                # [start, end] in time.monotonic() seconds, to line up with other logs
+                'records': [[start, end, self.name(ins), size, '%04x' % sw] for start, end, ins, size, sw in self.records],
+            }
+
+    def to_prometheus(self):
+        lines = [
+            '# HELP solo2_apdu_duration_seconds Time from sending an APDU to its response.',
+            '# TYPE solo2_apdu_duration_seconds histogram',
+        ]
+        with self.lock:
+            for ins, h in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'solo2_apdu_duration_seconds_bucket{{ins="{self.name(ins)}",le="{le}"}} {cumulative}')
+                lines.append(f'solo2_apdu_duration_seconds_sum{{ins="{self.name(ins)}"}} {h.sum}')
+                lines.append(f'solo2_apdu_duration_seconds_count{{ins="{self.name(ins)}"}} {h.count}')
+            lines.append('# HELP solo2_apdu_bytes_total Command payload bytes sent.')
+            lines.append('# TYPE solo2_apdu_bytes_total counter')
+            for ins, h in self.histograms.items():
+                lines.append(f'solo2_apdu_bytes_total{{ins="{self.name(ins)}"}} {h.bytes}')
+            lines.append('# HELP solo2_apdu_status_total Responses by status word.')
+            lines.append('# TYPE solo2_apdu_status_total counter')
+            for ins, h in self.histograms.items():
+                for sw, count in h.status.items():
+                    lines.append(f'solo2_apdu_status_total{{ins="{self.name(ins)}",sw="{sw:04x}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, prefix):
+        # Written aside and renamed, node_exporter must never read half a file.
+        for suffix, text in (('.json', json.dumps(self.to_json())), ('.prom', self.to_prometheus())):
+            with open(prefix + suffix + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(prefix + suffix + '.tmp', prefix + suffix)
+
+def from_environment(names = None):
+    """
+    An ApduStats dumped at exit to $SOLO2_APDU_STATS.{json,prom}, or None when it isn't set.
+    """
+    prefix = os.environ.get('SOLO2_APDU_STATS')
+    if not prefix:
+        return None
+    stats = ApduStats(names)
+    atexit.register(stats.dump, prefix)
+    return stats
+
+def print_summary_at_exit(stats):
+    if stats is not None:
+        atexit.register(lambda: print(stats.summary()))
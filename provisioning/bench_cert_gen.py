@@ -0,0 +1,80 @@
+import sys
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, x25519
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta
+
+from cert_gen import Issuer, TemplateIssuer
+
+# Certificates per second for device subjects of each key type:
+#   parse each  - a fresh Issuer per certificate, what generate_cert used to cost
+#   issuer      - one Issuer, sign() in a loop
+#   template    - one TemplateIssuer, sign() in a loop
+#   pool        - one TemplateIssuer, sign_many() over a process pool
+#
+#   python3 bench_cert_gen.py [count] [<ca_cert.pem> <ca_key.pem>]
+#
+# Without a CA a throwaway P256 one is generated.  test_cert_gen.py checks
+# that template certificates match CertificateBuilder ones.
+
+HOSTNAME = "SoloKeys trussed Attestation"
+
+SUBJECTS = {
+    'P256': lambda: ec.generate_private_key(ec.SECP256R1()).public_key(),
+    'Ed25519': lambda: ed25519.Ed25519PrivateKey.generate().public_key(),
+    'X25519': lambda: x25519.X25519PrivateKey.generate().public_key(),
+}
+
+def throwaway_ca(generate = lambda: ec.generate_private_key(ec.SECP256R1())):
+    key = generate()
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Benchmark CA")])
+    now = datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(1)
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=1), True)
+        .sign(key, None if isinstance(key, ed25519.Ed25519PrivateKey) else hashes.SHA256())
+    )
+    return (
+        cert.public_bytes(serialization.Encoding.PEM),
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()),
+    )
+
+def rate(func, count):
+    start = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    if len(sys.argv) == 4:
+        ca_cert = open(sys.argv[2],'rb').read()
+        ca_key = open(sys.argv[3],'rb').read()
+    else:
+        ca_cert, ca_key = throwaway_ca()
+
+    issuer = Issuer(ca_cert, ca_key, HOSTNAME)
+    templates = TemplateIssuer(ca_cert, ca_key, HOSTNAME)
+    with templates.process_pool() as pool:
+        # Spin the workers up before timing.
+        templates.sign_many([(SUBJECTS['P256'](), 1)], pool)
+
+        print(f'{"subject":10} {"parse each/s":>13} {"issuer/s":>10} {"template/s":>11} {"pool/s":>10}')
+        for name, generate in SUBJECTS.items():
+            # UUID sized serials, as provisioning uses.
+            requests = [(generate(), 2**127 + serial) for serial in range(count)]
+
+            fresh = rate(lambda: [Issuer(ca_cert, ca_key, HOSTNAME).sign(key, serial) for key, serial in requests], count)
+            once = rate(lambda: [issuer.sign(key, serial) for key, serial in requests], count)
+            patched = rate(lambda: [templates.sign(key, serial) for key, serial in requests], count)
+            fanned = rate(lambda: templates.sign_many(requests, pool), count)
+            print(f'{name:10} {fresh:13.0f} {once:10.0f} {patched:11.0f} {fanned:10.0f}')
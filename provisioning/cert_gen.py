@@ -3,6 +3,9 @@ import ipaddress
 import six
 import random
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 from cryptography import x509
 from cryptography.x509.oid import NameOID, ObjectIdentifier
@@ -11,7 +14,8 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
 import asn1
 
@@ -36,52 +40,257 @@ def public_key(self, key):
 
 x509.CertificateBuilder.public_key = public_key
 
-def generate_cert(ca_cert, ca_key, public_key, hostname, serial_number):
-    """Generates self signed certificate for a hostname, and optional IP addresses."""
-    # For some reason, x509 can't handle "TRUSTED CERTIFICATE" in pem header
-    ca_cert = ca_cert.replace(b"TRUSTED ", b"")
+def serial_number_extension(serial_number):
+    encoder = asn1.Encoder()
+    encoder.start()
+    encoder.write(serial_number, asn1.Numbers.Integer)
+    # Add custom extension for device serial number
+    return x509.UnrecognizedExtension(ObjectIdentifier("1.3.6.1.4.1.41482.3.7"), encoder.output())
 
-    ca_cert = x509.load_pem_x509_certificate(
-        ca_cert, default_backend()
-    )
-    ca_key = serialization.load_pem_private_key(
-        ca_key,
-        password=None
-    )
+class Issuer():
+    """
+    A CA certificate and key, loaded and checked once, that signs any number of
+    device certificates with the subject `hostname`.
+    """
+
+    def __init__(self, ca_cert, ca_key, hostname):
+        # Kept as PEM so process pool workers can rebuild the issuer.
+        self.pem = (ca_cert, ca_key)
+        self.hostname = hostname
+
+        # For some reason, x509 can't handle "TRUSTED CERTIFICATE" in pem header
+        self.ca_cert = x509.load_pem_x509_certificate(
+            ca_cert.replace(b"TRUSTED ", b""), default_backend()
+        )
+        self.ca_key = serialization.load_pem_private_key(
+            ca_key,
+            password=None
+        )
+
+        der = serialization.Encoding.DER
+        spki = serialization.PublicFormat.SubjectPublicKeyInfo
+        if self.ca_key.public_key().public_bytes(der, spki) != self.ca_cert.public_key().public_bytes(der, spki):
+            raise ValueError("CA key does not match the CA certificate")
+        try:
+            if not self.ca_cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca:
+                raise ValueError("CA certificate is not allowed to issue certificates")
+        except x509.ExtensionNotFound:
+            pass
+
+        self.algorithm = None if isinstance(self.ca_key, Ed25519PrivateKey) else hashes.SHA256()
+        self.builder = (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name([
+                x509.NameAttribute(NameOID.COMMON_NAME, hostname)
+            ]))
+            .issuer_name(self.ca_cert.subject)
+        )
+        self.key_constraints = x509.BasicConstraints(ca=False, path_length=None)
+        self.ca_constraints = x509.BasicConstraints(ca=True, path_length=0)
 
+    def sign(self, public_key, serial_number, now = None):
+        """
+        DER certificate for `public_key`, valid for 50 years from `now`.
+        """
+        if isinstance(public_key, X25519PublicKey):
+            basic_contraints = self.key_constraints
+        else:
+            basic_contraints = self.ca_constraints
+        if now is None:
+            now = datetime.utcnow()
 
-    name = x509.Name([
-        x509.NameAttribute(NameOID.COMMON_NAME, hostname)
-    ])
+        cert = (
+            self.builder
+            .public_key(public_key)
+            .serial_number(serial_number)
+            .not_valid_before(now)
+            .not_valid_after(now + timedelta(days=50*365))
+            .add_extension(basic_contraints, True)
+            .add_extension(serial_number_extension(serial_number), False)
+            .sign(self.ca_key, self.algorithm, default_backend())
+        )
+        return cert.public_bytes(encoding=serialization.Encoding.DER)
+
+    def process_pool(self, workers = None):
+        """
+        Process pool whose workers each hold their own copy of this issuer, for sign_many.
+        """
+        return ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+                initargs = (type(self), self.pem[0], self.pem[1], self.hostname))
+
+    def job(self, public_key, serial_number):
+        """
+        What sign_job() takes in a process_pool() worker.  Key objects don't
+        pickle, the key goes as SubjectPublicKeyInfo.
+        """
+        return (public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo), serial_number)
+
+    def sign_many(self, requests, pool = None):
+        """
+        Signs (public_key, serial_number) pairs over a process pool (a fresh
+        one if `pool` isn't given), returning the DER certificates in order.
+        """
+        jobs = [self.job(public_key, serial_number) for public_key, serial_number in requests]
+        # Signing one certificate is cheaper than a round trip to a worker, send them in chunks.
+        chunksize = max(1, len(jobs) // (4 * (os.cpu_count() or 1)))
+        if pool is not None:
+            return list(pool.map(sign_job, jobs, chunksize = chunksize))
+        with self.process_pool() as pool:
+            return list(pool.map(sign_job, jobs, chunksize = chunksize))
+
+def _der_length(length):
+    if length < 0x80:
+        return bytes([length])
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(encoded)]) + encoded
+
+def _der_children(der, start, end):
+    """
+    (start, content start, end) of each DER element in der[start:end].
+    """
+    while start < end:
+        length = der[start + 1]
+        content = start + 2
+        if length & 0x80:
+            count = length & 0x7f
+            length = int.from_bytes(der[content:content + count], 'big')
+            content += count
+        yield start, content, content + length
+        start = content + length
+
+def _der_content(der, element):
+    return list(_der_children(der, element[1], element[2]))
+
+def _public_key_kind(public_key):
+    if isinstance(public_key, ec.EllipticCurvePublicKey) and isinstance(public_key.curve, ec.SECP256R1):
+        return 'p256'
+    if isinstance(public_key, Ed25519PublicKey):
+        return 'ed25519'
     if isinstance(public_key, X25519PublicKey):
-        basic_contraints = x509.BasicConstraints(ca=False, path_length=None)
-    else:
-        basic_contraints = x509.BasicConstraints(ca=True, path_length=0)
-    now = datetime.utcnow()
+        return 'x25519'
+    return None
 
-    encoder = asn1.Encoder()
-    encoder.start()
-    encoder.write(serial_number, asn1.Numbers.Integer)
-    serial_number_der = encoder.output()
+def _raw_public_key(public_key):
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        return public_key.public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    return public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
 
-    print(public_key)
+def _der_time(when):
+    # RFC 5280: UTCTime through 2049, GeneralizedTime after.
+    if when.year < 2050:
+        return when.strftime('%y%m%d%H%M%SZ').encode()
+    return when.strftime('%Y%m%d%H%M%SZ').encode()
 
-    cert = (
-        x509.CertificateBuilder()
-        .subject_name(name)
-        .issuer_name(ca_cert.subject)
-        .public_key(public_key)
-        .serial_number(serial_number)
-        .not_valid_before(now)
-        .not_valid_after(now + timedelta(days=50*365))
-        .add_extension(basic_contraints, True)
-        # Add custom extension for device serial number
-        .add_extension(x509.UnrecognizedExtension(ObjectIdentifier("1.3.6.1.4.1.41482.3.7"), serial_number_der), False)
-        .sign(ca_key, hashes.SHA256(), default_backend())
-    )
-    cert_der = cert.public_bytes(encoding=serialization.Encoding.DER)
+class CertTemplate():
+    """
+    The DER TBSCertificate of one signed certificate, with the offsets of the
+    fields that change per device: the serial number (twice, the second time
+    in the 41482.3.7 extension), the validity dates and the raw public key.
+    """
+
+    def __init__(self, cert_der, serial_length):
+        cert = next(_der_children(cert_der, 0, len(cert_der)))
+        tbs, signature_algorithm, _ = _der_content(cert_der, cert)
+        self.tbs = cert_der[tbs[0]:tbs[2]]
+        self.signature_algorithm = cert_der[signature_algorithm[0]:signature_algorithm[2]]
+
+        fields = _der_content(self.tbs, next(_der_children(self.tbs, 0, len(self.tbs))))
+        _, serial, _, _, validity, _, spki, extensions = fields
+        self.serial = slice(serial[1], serial[2])
+        not_before, not_after = _der_content(self.tbs, validity)
+        self.not_before = slice(not_before[1], not_before[2])
+        self.not_after = slice(not_after[1], not_after[2])
+        self.spki_end = spki[2]
+
+        serial_der = self.tbs[serial[0]:serial[2]]
+        self.extension_serial = None
+        for extension in _der_content(self.tbs, _der_content(self.tbs, extensions)[0]):
+            value = _der_content(self.tbs, extension)[-1]
+            if self.tbs[value[1]:value[2]] == serial_der:
+                self.extension_serial = slice(value[2] - serial_length, value[2])
+        assert self.extension_serial is not None
+
+    def tbs_for(self, raw_public_key, serial, not_before, not_after):
+        tbs = bytearray(self.tbs)
+        tbs[self.serial] = serial
+        tbs[self.extension_serial] = serial
+        tbs[self.not_before] = not_before
+        tbs[self.not_after] = not_after
+        tbs[self.spki_end - len(raw_public_key):self.spki_end] = raw_public_key
+        return tbs
+
+    def certificate(self, tbs, signature):
+        signature = b'\x03' + _der_length(len(signature) + 1) + b'\x00' + signature
+        body = len(tbs) + len(self.signature_algorithm) + len(signature)
+        return b'\x30' + _der_length(body) + tbs + self.signature_algorithm + signature
+
+class TemplateIssuer(Issuer):
+    """
+    Issuer that builds the first certificate of each shape (key type, serial
+    length, date encodings) with CertificateBuilder, then only patches the
+    per device fields into its DER and signs.  Certificates are the same as
+    Issuer.sign's, bar the signature for randomized (ECDSA) CA keys.
+    """
+
+    def __init__(self, ca_cert, ca_key, hostname):
+        super().__init__(ca_cert, ca_key, hostname)
+        self.templates = {}
+        # Signing threads share the templates, only one builds each shape.
+        self.templates_lock = threading.Lock()
+        if isinstance(self.ca_key, ec.EllipticCurvePrivateKey):
+            self.sign_tbs = lambda tbs: self.ca_key.sign(tbs, ec.ECDSA(hashes.SHA256()))
+        elif isinstance(self.ca_key, Ed25519PrivateKey):
+            self.sign_tbs = self.ca_key.sign
+        elif isinstance(self.ca_key, rsa.RSAPrivateKey):
+            self.sign_tbs = lambda tbs: self.ca_key.sign(tbs, padding.PKCS1v15(), hashes.SHA256())
+        else:
+            self.sign_tbs = None
 
-    return cert_der
+    def sign(self, public_key, serial_number, now = None):
+        kind = _public_key_kind(public_key)
+        if kind is None or self.sign_tbs is None or serial_number <= 0:
+            return super().sign(public_key, serial_number, now)
+        if now is None:
+            now = datetime.utcnow()
+
+        serial = serial_number.to_bytes(serial_number.bit_length() // 8 + 1, 'big')
+        not_before = _der_time(now)
+        not_after = _der_time(now + timedelta(days=50*365))
+        shape = (kind, len(serial), len(not_before), len(not_after))
+
+        template = self.templates.get(shape)
+        if template is None:
+            with self.templates_lock:
+                template = self.templates.get(shape)
+                if template is None:
+                    cert = super().sign(public_key, serial_number, now)
+                    self.templates[shape] = CertTemplate(cert, len(serial))
+                    return cert
+
+        tbs = template.tbs_for(_raw_public_key(public_key), serial, not_before, not_after)
+        return template.certificate(tbs, self.sign_tbs(bytes(tbs)))
+
+_worker_issuer = None
+
+def _init_worker(cls, ca_cert, ca_key, hostname):
+    global _worker_issuer
+    _worker_issuer = cls(ca_cert, ca_key, hostname)
+
+def sign_job(job):
+    """
+    Signs an Issuer.job() in a process_pool() worker.
+    """
+    public_key, serial_number = job
+    return _worker_issuer.sign(serialization.load_der_public_key(public_key), serial_number)
+
+@lru_cache(maxsize = 8)
+def get_issuer(ca_cert, ca_key, hostname):
+    return Issuer(ca_cert, ca_key, hostname)
+
+def generate_cert(ca_cert, ca_key, public_key, hostname, serial_number):
+    """Generates a certificate for public_key, signed by the PEM encoded ca_cert and ca_key."""
+    print(public_key)
+    return get_issuer(ca_cert, ca_key, hostname).sign(public_key, serial_number)
 
 if __name__ == "__main__":
     # Usage example
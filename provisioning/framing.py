@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import argparse
+import threading
+
+# How each reader gets APDUs to the card.  Readers differ: CCID over USB
+# passes extended APDUs, a contactless reader (the ACR1252, see frameSizeIFD/
+# frameSizeICC in control.py's AcrTlv) may only pass short frames, and large
+# commands then have to be chained.  SmartCardDevice probes this once per
+# reader name with WRITE BINARYs of growing size to the tester's file buffer,
+# which only answer 9000 if the whole payload arrived, and caches the result
+# here:
+#
+#   extended     send commands as one extended APDU, up to max_data bytes
+#   chunk_size   short APDU size when chaining (not extended, or beyond max_data)
+#   bytes_per_s  measured throughput of the largest frame
+#
+# Set SOLO2_FRAMING_CACHE to move the cache, and run this to reprobe the
+# attached readers and show what they got:
+#
+#   python3 framing.py [reader name]
+
+CACHE_PATH = os.environ.get('SOLO2_FRAMING_CACHE', os.path.expanduser('~/.cache/solo2-hw-ci/framing.json'))
+
+# Extended APDU payloads tried in turn, the first one that doesn't reach the
+# card ends the probe.  Up to the largest command the scripts send in one
+# go (files, certificates), anything bigger is chained.
+EXTENDED_SIZES = (256, 512, 1024, 2048, 4096)
+# Short APDU payloads for chaining, the first one that reaches the card is used.
+SHORT_SIZES = (255, 250, 224, 192, 128, 64, 32)
+# Frames timed for the throughput, the fastest one counts.
+REPEATS = 3
+# Bumped when the probe changes, older cache entries are probed again.
+PROBE_VERSION = 3
+FIELDS = ('extended', 'max_data', 'chunk_size', 'bytes_per_s', 'probed')
+
+class Framing():
+
+    def __init__(self, extended = True, max_data = 0xffff, chunk_size = 250, bytes_per_s = None, probed = None):
+        self.extended = extended
+        self.max_data = max_data
+        self.chunk_size = chunk_size
+        self.bytes_per_s = bytes_per_s
+        self.probed = probed
+
+    def __repr__(self):
+        mode = f"extended up to {self.max_data} bytes" if self.extended else "chained"
+        speed = f", {self.bytes_per_s:.0f} B/s" if self.bytes_per_s else ""
+        return f"Framing({mode}, {self.chunk_size} byte chunks{speed})"
+
+    def to_json(self):
+        return {
+            'version': PROBE_VERSION,
+            'extended': self.extended,
+            'max_data': self.max_data,
+            'chunk_size': self.chunk_size,
+            'bytes_per_s': self.bytes_per_s,
+            'probed': self.probed,
+        }
+
+class FramingCache():
+    """
+    {reader name: Framing}, in a JSON file shared by every script on this host.
+    """
+
+    def __init__(self, path = CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def get(self, reader_name):
+        """
+        The cached Framing, or None if there is none or it is stale or
+        unreadable, and the reader should be probed.
+        """
+        entry = self._load().get(reader_name)
+        if not isinstance(entry, dict) or entry.get('version') != PROBE_VERSION:
+            return None
+        try:
+            return Framing(**{name: entry[name] for name in FIELDS if name in entry})
+        except (TypeError, ValueError):
+            return None
+
+    def put(self, reader_name, framing):
+        with self.lock:
+            entries = self._load()
+            entries[reader_name] = framing.to_json()
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+            # Another process may be reading it, swap in the whole file.
+            tmp = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(entries, f, indent = 1)
+            os.replace(tmp, self.path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Probe and cache the APDU framing of the attached readers.")
+    parser.add_argument('name', nargs = '?', default = '', help = "only readers whose name contains this")
+    args = parser.parse_args()
+
+    from util import SmartCardDevice
+    # Without a cache every connection probes, store what they found.
+    SmartCardDevice.framing_cache = None
+    cache = FramingCache()
+    found = False
+    for card in SmartCardDevice.list_devices(args.name):
+        found = True
+        if card.framing.probed is not None:
+            cache.put(card.name, card.framing)
+        print(f"{card.name}: {card.framing}")
+    if not found:
+        print("No cards found")
+        sys.exit(1)
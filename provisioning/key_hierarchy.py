@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ObjectIdentifier
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa, ed25519
+
+# Test key hierarchy for provisioning, the same files key-gen/gen-all.sh makes
+# with openssl:
+#
+#   test-root-{key,cert}.pem                      RSA 2048 root
+#   fido2/test-intermediate-{key,cert}.pem        P256 FIDO2 intermediate CA
+#   fido2/test-{key,cert}.{pem,der}               P256 FIDO2 attestation
+#   trussed/test-{key,cert}-{p256,ed255}.pem      trussed attestation sub CAs
+#
+# Not for secure devices, only testing/demo/hacker ones.  A hierarchy is cached
+# under a hash of CONFIG, so runs with an unchanged CONFIG copy it instead.
+#
+#   python3 key_hierarchy.py [output-dir]
+
+CACHE_DIR = os.environ.get('SOLO2_KEY_CACHE', os.path.expanduser('~/.cache/solo2-hw-ci/key-gen'))
+
+DAYS = 18250
+
+CONFIG = {
+    'version': 1,
+    'days': DAYS,
+    'root': {
+        'subject': [('C', 'CH'), ('O', 'Hacker Root Trussed CA'), ('OU', 'Demo Root CA'), ('CN', 'solokeys.com')],
+        'key': 'rsa2048',
+    },
+    'fido2-intermediate': {
+        'subject': [('C', 'CH'), ('O', 'Hacker Intermediate'), ('OU', 'Demo FIDO2 Attestation'), ('CN', 'Demo FIDO2 Intermediate CA')],
+        'serial': 0xbbbbbbbbbbbbbbbb,
+        'key': 'p256',
+    },
+    'fido2': {
+        'subject': [('C', 'US'), ('O', 'SoloKeys'), ('OU', 'Authenticator Attestation'), ('CN', 'Demo FIDO2 Attestation Serial 0xaaaaaaaaaaaaaaaa')],
+        'serial': 0xaaaaaaaaaaaaaaaa,
+        'key': 'p256',
+        'aaguid': '8bc5496807b14d5fb249607f5d527da2',
+    },
+    'trussed': {
+        'subject': [('O', 'SoloKeys'), ('OU', 'Demo Trussed Attestation'), ('CN', 'Demo Trussed Sub CA Serial 0xaaaaaaaaaaaaaaaa')],
+        'serial': 0xaaaaaaaaaaaaaaaa,
+        'keys': ['p256', 'ed255'],
+    },
+}
+
+NAME_OIDS = {
+    'C': NameOID.COUNTRY_NAME,
+    'O': NameOID.ORGANIZATION_NAME,
+    'OU': NameOID.ORGANIZATIONAL_UNIT_NAME,
+    'CN': NameOID.COMMON_NAME,
+}
+
+AAGUID_OID = ObjectIdentifier("1.3.6.1.4.1.45724.1.1.4")
+TRANSPORTS_OID = ObjectIdentifier("1.3.6.1.4.1.45724.2.1.1")
+SERIAL_OID = ObjectIdentifier("1.3.6.1.4.1.41482.3.7")
+
+# BIT STRING with bits 2 and 3 (USB, NFC) set
+TRANSPORTS_USB_NFC = b'\x03\x02\x04\x30'
+
+def config_hash(config = CONFIG):
+    return hashlib.sha256(json.dumps(config, sort_keys = True).encode()).hexdigest()[:16]
+
+def generate_key(kind):
+    if kind == 'rsa2048':
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if kind == 'p256':
+        return ec.generate_private_key(ec.SECP256R1())
+    if kind == 'ed255':
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError(f"Unknown key kind {kind}")
+
+def name(subject):
+    return x509.Name([x509.NameAttribute(NAME_OIDS[attribute], value) for attribute, value in subject])
+
+def key_pem(key):
+    if isinstance(key, ec.EllipticCurvePrivateKey):
+        # SEC1, what `openssl ecparam -genkey` writes and ecdsa reads
+        private_format = serialization.PrivateFormat.TraditionalOpenSSL
+    else:
+        private_format = serialization.PrivateFormat.PKCS8
+    return key.private_bytes(serialization.Encoding.PEM, private_format, serialization.NoEncryption())
+
+def cert_pem(cert):
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+def issue(subject, public_key, issuer_cert, issuer_key, serial, extensions):
+    """
+    Certificate for `public_key` signed by `issuer_key`, self signed if there is no `issuer_cert`.
+    """
+    now = datetime.utcnow()
+    issuer_name = issuer_cert.subject if issuer_cert is not None else subject
+    issuer_public_key = issuer_key.public_key()
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer_name)
+        .public_key(public_key)
+        .serial_number(serial)
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=DAYS))
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_public_key), False)
+    )
+    for extension, critical in extensions:
+        builder = builder.add_extension(extension, critical)
+    algorithm = None if isinstance(issuer_key, ed25519.Ed25519PrivateKey) else hashes.SHA256()
+    return builder.sign(issuer_key, algorithm)
+
+def check(cert, key, issuer_cert):
+    """
+    Signs and verifies with the new key, and checks the certificate against its issuer.
+    """
+    data = b'test data to sign ' + os.urandom(8)
+    if isinstance(key, ec.EllipticCurvePrivateKey):
+        cert.public_key().verify(key.sign(data, ec.ECDSA(hashes.SHA256())), data, ec.ECDSA(hashes.SHA256()))
+    elif isinstance(key, ed25519.Ed25519PrivateKey):
+        cert.public_key().verify(key.sign(data), data)
+    cert.verify_directly_issued_by(issuer_cert)
+
+def generate_root(config):
+    key = generate_key(config['root']['key'])
+    subject = name(config['root']['subject'])
+    extensions = [
+        (x509.BasicConstraints(ca=True, path_length=None), True),
+        (x509.KeyUsage(False, False, False, False, False, True, True, False, False), True),
+    ]
+    cert = issue(subject, key.public_key(), None, key, x509.random_serial_number(), extensions)
+    cert.verify_directly_issued_by(cert)
+    return {'test-root-key.pem': key_pem(key), 'test-root-cert.pem': cert_pem(cert)}, cert, key
+
+def generate_fido2(config, root_cert, root_key):
+    intermediate = config['fido2-intermediate']
+    intermediate_key = generate_key(intermediate['key'])
+    intermediate_cert = issue(name(intermediate['subject']), intermediate_key.public_key(), root_cert, root_key, intermediate['serial'], [
+        (x509.BasicConstraints(ca=True, path_length=None), True),
+        (x509.KeyUsage(False, False, False, False, False, True, True, False, False), True),
+    ])
+    check(intermediate_cert, intermediate_key, root_cert)
+
+    attestation = config['fido2']
+    key = generate_key(attestation['key'])
+    aaguid = bytes.fromhex(attestation['aaguid'])
+    cert = issue(name(attestation['subject']), key.public_key(), intermediate_cert, intermediate_key, attestation['serial'], [
+        (x509.BasicConstraints(ca=False, path_length=None), False),
+        (x509.KeyUsage(True, True, True, True, False, False, False, False, False), False),
+        (x509.UnrecognizedExtension(AAGUID_OID, b'\x04' + bytes([len(aaguid)]) + aaguid), False),
+        (x509.UnrecognizedExtension(TRANSPORTS_OID, TRANSPORTS_USB_NFC), False),
+    ])
+    check(cert, key, intermediate_cert)
+
+    return {
+        'test-intermediate-key.pem': key_pem(intermediate_key),
+        'test-intermediate-cert.pem': cert_pem(intermediate_cert),
+        'test-key.pem': key_pem(key),
+        'test-cert.pem': cert_pem(cert),
+        'test-key.der': key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()),
+        'test-cert.der': cert.public_bytes(serialization.Encoding.DER),
+    }
+
+def generate_trussed(config, root_cert, root_key):
+    trussed = config['trussed']
+    serial = trussed['serial'].to_bytes(8, 'big')
+    files = {}
+    for kind in trussed['keys']:
+        key = generate_key(kind)
+        cert = issue(name(trussed['subject']), key.public_key(), root_cert, root_key, trussed['serial'], [
+            (x509.BasicConstraints(ca=True, path_length=1), True),
+            (x509.KeyUsage(False, False, False, False, False, True, False, False, False), True),
+            (x509.UnrecognizedExtension(SERIAL_OID, b'\x03' + bytes([len(serial) + 1, 0]) + serial), False),
+        ])
+        check(cert, key, root_cert)
+        files[f'test-key-{kind}.pem'] = key_pem(key)
+        files[f'test-cert-{kind}.pem'] = cert_pem(cert)
+    return files
+
+def generate(config = CONFIG):
+    """
+    {relative path: contents} of a fresh hierarchy.  The FIDO2 and trussed
+    branches only depend on the root and are generated concurrently.
+    """
+    files, root_cert, root_key = generate_root(config)
+    with ThreadPoolExecutor(max_workers = 2) as pool:
+        fido2 = pool.submit(generate_fido2, config, root_cert, root_key)
+        trussed = pool.submit(generate_trussed, config, root_cert, root_key)
+        for directory, branch in (('fido2', fido2), ('trussed', trussed)):
+            for filename, contents in branch.result().items():
+                files[os.path.join(directory, filename)] = contents
+    return files
+
+def write_files(files, directory):
+    for path, contents in files.items():
+        path = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'wb') as f:
+            f.write(contents)
+    for path in files:
+        if path.endswith('key.pem') or path.endswith('key.der'):
+            os.chmod(os.path.join(directory, path), 0o600)
+
+def cached_hierarchy(config = CONFIG, cache_dir = CACHE_DIR):
+    """
+    Directory holding the hierarchy for `config`, generated on first use.
+    """
+    directory = os.path.join(cache_dir, config_hash(config))
+    if os.path.isdir(directory):
+        return directory, True
+    os.makedirs(cache_dir, exist_ok = True)
+    staging = tempfile.mkdtemp(dir = cache_dir)
+    write_files(generate(config), staging)
+    try:
+        os.rename(staging, directory)
+    except OSError:
+        # Another run got there first, use theirs.
+        shutil.rmtree(staging)
+    return directory, False
+
+def install(output_dir, cache = True):
+    if cache:
+        source, hit = cached_hierarchy()
+    else:
+        source, hit = tempfile.mkdtemp(), False
+        write_files(generate(), source)
+
+    # Like gen-all.sh, the branch directories are replaced as a whole.
+    for branch in ('fido2', 'trussed'):
+        shutil.rmtree(os.path.join(output_dir, branch), ignore_errors = True)
+    shutil.copytree(source, output_dir, dirs_exist_ok = True)
+    if not cache:
+        shutil.rmtree(source)
+    return hit
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generate the test provisioning key hierarchy.")
+    parser.add_argument('output_dir', nargs = '?', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'key-gen'))
+    parser.add_argument('--no-cache', action = 'store_true', help = "always generate fresh keys, and don't cache them")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    hit = install(args.output_dir, cache = not args.no_cache)
+    took = (time.monotonic() - start) * 1000
+    print(f"{'Reused cached' if hit else 'Generated'} key hierarchy {config_hash()} in {args.output_dir} ({took:.0f} ms)")
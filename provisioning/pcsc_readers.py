@@ -0,0 +1,167 @@
+from smartcard import scard
+from smartcard.pcsc.PCSCExceptions import ListReadersException
+from smartcard.pcsc.PCSCReader import PCSCReader
+
+from threading import Lock
+import time
+
+# The PC/SC reader list, kept up to date from pcscd's PnP notifications
+# instead of enumerating on every lookup.  Used by util.py's SmartCardDevice
+# and by control.py, which imports it without the rest of util.py.
+
+class ReaderRegistry():
+    """
+    Caches the PC/SC reader list and only re-enumerates when pcscd reports a
+    reader was added or removed (SCardGetStatusChange on the PnP pseudo reader).
+    Callers can also block until a matching reader, optionally with a card, appears.
+    """
+    PNP_NOTIFICATION = '\\\\?PnP?\\Notification'
+
+    def __init__(self):
+        self._lock = Lock()
+        self._context = None
+        self._readers = None
+        self._pnp_state = scard.SCARD_STATE_UNAWARE
+
+    def _establish(self):
+        if self._context is None:
+            hresult, self._context = scard.SCardEstablishContext(scard.SCARD_SCOPE_USER)
+            if hresult != scard.SCARD_S_SUCCESS:
+                self._context = None
+                raise ListReadersException(hresult)
+            self._readers = None
+            self._pnp_state = scard.SCARD_STATE_UNAWARE
+        return self._context
+
+    def _reset(self):
+        # pcscd restarted or the context went stale, start over.
+        if self._context is not None:
+            scard.SCardReleaseContext(self._context)
+        self._context = None
+        self._readers = None
+
+    def _pnp_changed(self, timeout_ms):
+        hresult, states = scard.SCardGetStatusChange(self._context, timeout_ms, [(self.PNP_NOTIFICATION, self._pnp_state)])
+        if hresult == scard.SCARD_E_TIMEOUT:
+            return False
+        if hresult != scard.SCARD_S_SUCCESS:
+            # No PnP support (or a stale context), fall back to enumerating.
+            self._reset()
+            return True
+        self._pnp_state = states[0][1] & ~scard.SCARD_STATE_CHANGED
+        return True
+
+    def _refresh(self):
+        hresult, names = scard.SCardListReaders(self._context, [])
+        if hresult not in (scard.SCARD_S_SUCCESS, scard.SCARD_E_NO_READERS_AVAILABLE):
+            self._reset()
+            self._establish()
+            hresult, names = scard.SCardListReaders(self._context, [])
+        self._readers = [PCSCReader(name) for name in (names or [])]
+
+    def readers(self):
+        with self._lock:
+            self._establish()
+            changed = self._pnp_changed(0)
+            if self._readers is None or changed:
+                self._establish()
+                self._refresh()
+            return list(self._readers)
+
+    def find(self, names):
+        """
+        Readers whose name contains any of `names`, in the order of `names`.
+        """
+        readers = self.readers()
+        return [r for name in names for r in readers if name in r.name]
+
+    def wait_for(self, names, card = False, timeout = 10):
+        """
+        Blocks until a reader matching `names` appears (and holds a card, if
+        `card`), without polling.  Returns the reader or raises TimeoutError.
+        """
+        deadline = time.monotonic() + timeout
+        # Blocking calls get their own context so other threads' lookups aren't held up.
+        hresult, context = scard.SCardEstablishContext(scard.SCARD_SCOPE_USER)
+        if hresult != scard.SCARD_S_SUCCESS:
+            raise ListReadersException(hresult)
+        try:
+            states = {}
+            pnp_state = scard.SCARD_STATE_UNAWARE
+            while True:
+                matches = self.find(names)
+                if matches and not card:
+                    return matches[0]
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No reader matching {names} after {timeout}s")
+                query = [(r.name, states.get(r.name, scard.SCARD_STATE_UNAWARE)) for r in matches]
+                query.append((self.PNP_NOTIFICATION, pnp_state))
+                hresult, results = scard.SCardGetStatusChange(context, int(remaining * 1000), query)
+                if hresult == scard.SCARD_E_TIMEOUT:
+                    raise TimeoutError(f"No reader matching {names} after {timeout}s")
+                if hresult != scard.SCARD_S_SUCCESS:
+                    # A reader went away between find() and the wait, or pcscd
+                    # restarted.  Back off and start again with a fresh context.
+                    time.sleep(min(.1, remaining))
+                    hresult, fresh = scard.SCardEstablishContext(scard.SCARD_SCOPE_USER)
+                    if hresult != scard.SCARD_S_SUCCESS:
+                        raise ListReadersException(hresult)
+                    scard.SCardReleaseContext(context)
+                    context = fresh
+                    states = {}
+                    pnp_state = scard.SCARD_STATE_UNAWARE
+                    continue
+                for name, event_state, atr in results:
+                    if name == self.PNP_NOTIFICATION:
+                        pnp_state = event_state & ~scard.SCARD_STATE_CHANGED
+                    elif event_state & scard.SCARD_STATE_PRESENT:
+                        return next(r for r in matches if r.name == name)
+                    else:
+                        states[name] = event_state & ~scard.SCARD_STATE_CHANGED
+        finally:
+            scard.SCardReleaseContext(context)
+
+# Shared so every lookup in a process reuses one cached reader list.
+reader_registry = ReaderRegistry()
+
+class ReaderWatcher():
+    """
+    Follows the readers matching `names` and whether each holds a card, for
+    callers that handle several readers at once (hot plugging included).
+    """
+
+    def __init__(self, names, registry = reader_registry):
+        self.names = names
+        self.registry = registry
+        hresult, self._context = scard.SCardEstablishContext(scard.SCARD_SCOPE_USER)
+        if hresult != scard.SCARD_S_SUCCESS:
+            raise ListReadersException(hresult)
+        self._states = {}
+        self._pnp_state = scard.SCARD_STATE_UNAWARE
+
+    def wait(self, timeout):
+        """
+        Blocks until a matching reader or its card comes or goes (at most
+        `timeout` seconds), then returns {reader: card present}.  Readers
+        seen for the first time are reported straight away.
+        """
+        readers = self.registry.find(self.names)
+        self._states = {r.name: self._states.get(r.name, scard.SCARD_STATE_UNAWARE) for r in readers}
+        query = list(self._states.items())
+        query.append((ReaderRegistry.PNP_NOTIFICATION, self._pnp_state))
+        hresult, results = scard.SCardGetStatusChange(self._context, int(timeout * 1000), query)
+        if hresult == scard.SCARD_S_SUCCESS:
+            for name, event_state, atr in results:
+                if name == ReaderRegistry.PNP_NOTIFICATION:
+                    self._pnp_state = event_state & ~scard.SCARD_STATE_CHANGED
+                else:
+                    self._states[name] = event_state & ~scard.SCARD_STATE_CHANGED
+        elif hresult != scard.SCARD_E_TIMEOUT:
+            # A reader went away mid-call, or pcscd restarted.
+            time.sleep(.1)
+        return {r: bool(self._states[r.name] & scard.SCARD_STATE_PRESENT) for r in readers}
+
+    def close(self):
+        scard.SCardReleaseContext(self._context)
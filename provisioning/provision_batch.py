@@ -0,0 +1,194 @@
+import os
+import re
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import threading
+import traceback
+
+import ecdsa
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from apdu_stats import print_summary_at_exit
+from util import SmartCardDevice, AsyncCard, ReaderWatcher
+from cert_gen import TemplateIssuer
+from provision_fido2_trussed import provision
+
+# Provisions every device attached to this host, each on its own thread.
+# Readers matching "Provisioner"/"SoloKeys" are picked up as they are
+# plugged in, and a device starts as soon as its card shows up.  All of them
+# share one loaded CA and one pool of signing processes (Issuer.process_pool,
+# each holding its own copy of the CA), so many devices signing at once
+# aren't held up by the GIL.  Each device logs to
+# <log-dir>/<reader>-<n>.log; the console only gets one line per device
+# and a summary on exit (Ctrl-C, --count or --idle).
+#
+#   python3 provision_batch.py key-gen/fido2/test-cert.der key-gen/fido2/test-key.pem \
+#       key-gen/trussed/test-cert-p256.pem key-gen/trussed/test-key-p256.pem --count 8
+
+READER_NAMES = ["Provisioner", "SoloKeys"]
+
+class ThreadOutput():
+    """
+    Stands in for sys.stdout: threads that attached a log file write there,
+    everyone else to the real stdout.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def attach(self, f):
+        self.local.f = f
+
+    def detach(self):
+        self.local.f = None
+
+    def write(self, text):
+        return (getattr(self.local, 'f', None) or self.stream).write(text)
+
+    def flush(self):
+        (getattr(self.local, 'f', None) or self.stream).flush()
+
+class Batch():
+    """
+    Devices in flight and the tally of finished ones.
+    """
+
+    def __init__(self, args, issuer, signer, output):
+        self.args = args
+        self.issuer = issuer
+        self.signer = signer
+        self.output = output
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.last_activity = self.start
+        # reader name -> worker thread, and readers whose card was already handled
+        self.active = {}
+        self.handled = set()
+        self.logs = {}
+        self.provisioned = []
+        self.failures = []
+
+    def log_path(self, reader_name):
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', reader_name).strip('_')
+        n = self.logs[name] = self.logs.get(name, 0) + 1
+        return os.path.join(self.args.log_dir, f'{name}-{n}.log')
+
+    def update(self, cards):
+        """
+        Starts a worker for every reader that has a card we haven't handled yet.
+        """
+        with self.lock:
+            # Reader unplugged, e.g. the DUT's own CCID reader.  Whatever shows
+            # up under its name next is a new device.
+            self.handled &= {reader.name for reader in cards}
+            for reader, present in cards.items():
+                if not present:
+                    # Card pulled, the next one in this reader is a new device.
+                    self.handled.discard(reader.name)
+                elif reader.name not in self.active and reader.name not in self.handled:
+                    self.handled.add(reader.name)
+                    worker = threading.Thread(target = self.provision_device, args = (reader,), daemon = True)
+                    self.active[reader.name] = worker
+                    self.last_activity = time.monotonic()
+                    worker.start()
+
+    def provision_device(self, reader):
+        path = self.log_path(reader.name)
+        start = time.monotonic()
+        uuid = None
+        error = None
+        with open(path, 'w') as log:
+            self.output.attach(log)
+            try:
+                # The card thread prints too, point it at the same log.
+                card = AsyncCard(SmartCardDevice(reader.createConnection(), reader.name),
+                        initializer = lambda: self.output.attach(log))
+                try:
+                    uuid = asyncio.run(provision(card, self.args.cert_der, self.args.private_key_raw, self.issuer, self.signer,
+                            self.args.journal, False, self.args.retries, self.args.backoff))
+                finally:
+                    card.close()
+            except Exception as e:
+                error = e
+                traceback.print_exc(file = log)
+            finally:
+                self.output.detach()
+        self.finished(reader.name, uuid, error, time.monotonic() - start, path)
+
+    def finished(self, reader_name, uuid, error, took, path):
+        with self.lock:
+            del self.active[reader_name]
+            self.last_activity = time.monotonic()
+            if error is None:
+                self.provisioned.append((reader_name, uuid, took))
+                print(f'{reader_name}: provisioned {uuid.hex()} in {took:.1f} s', flush = True)
+            else:
+                self.failures.append((reader_name, error, path))
+                print(f'{reader_name}: FAILED after {took:.1f} s: {error!r} (see {path})', flush = True)
+
+    def done(self):
+        with self.lock:
+            if self.active:
+                return False
+            if self.args.count and len(self.provisioned) + len(self.failures) >= self.args.count:
+                return True
+            return self.args.idle is not None and time.monotonic() - self.last_activity > self.args.idle
+
+    def report(self):
+        minutes = (time.monotonic() - self.start) / 60
+        print()
+        print(f'{len(self.provisioned)} provisioned, {len(self.failures)} failed in {minutes * 60:.1f} s'
+              f' ({len(self.provisioned) / minutes:.1f} devices/minute)')
+        if self.provisioned:
+            took = sorted(device[2] for device in self.provisioned)
+            print(f'per device: fastest {took[0]:.1f} s, median {took[len(took) // 2]:.1f} s, slowest {took[-1]:.1f} s')
+        for reader_name, error, path in self.failures:
+            print(f'  {reader_name}: {error!r} ({path})')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Provision every device on every attached reader.")
+    parser.add_argument('fido_cert', help = "fido-attestation-cert.der")
+    parser.add_argument('fido_key', help = "fido-attestation-key.pem")
+    parser.add_argument('ca_cert', help = "ca-intermediate-cert.pem")
+    parser.add_argument('ca_key', help = "ca-intermediate-key.pem")
+    parser.add_argument('--count', type = int, help = "stop after this many devices")
+    parser.add_argument('--idle', type = float, help = "stop after this many seconds without a device")
+    parser.add_argument('--log-dir', default = 'logs', help = "per device logs (default: %(default)s)")
+    parser.add_argument('--journal', default = 'journal', help = "directory of per device step journals (default: %(default)s)")
+    parser.add_argument('--retries', type = int, default = 3, help = "retries of a step that lost the selection (default: %(default)s)")
+    parser.add_argument('--backoff', type = float, default = .05, help = "seconds before the first retry, doubling after (default: %(default)s)")
+    parser.add_argument('--signers', type = int, help = "certificate signing processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    # LOGLEVEL=DEBUG traces every APDU, into each device's log
+    logging.basicConfig(level = os.environ.get('LOGLEVEL', 'WARNING'), stream = output)
+    # SOLO2_APDU_STATS=<prefix> times every APDU, of all devices together
+    print_summary_at_exit(SmartCardDevice.stats)
+
+    args.cert_der = open(args.fido_cert,'rb').read()
+    args.private_key_raw = ecdsa.SigningKey.from_pem(open(args.fido_key,'rb').read()).to_string()
+    issuer = TemplateIssuer(open(args.ca_cert,'rb').read(), open(args.ca_key,'rb').read(), "SoloKeys trussed Attestation")
+    os.makedirs(args.log_dir, exist_ok = True)
+
+    signer = issuer.process_pool(args.signers)
+    # Start the workers before any device thread runs, they fork from here.
+    issuer.sign_many([(ec.generate_private_key(ec.SECP256R1()).public_key(), 1)], signer)
+    batch = Batch(args, issuer, signer, output)
+    watcher = ReaderWatcher(READER_NAMES)
+    print(f'Waiting for devices on readers matching {READER_NAMES}..', flush = True)
+    try:
+        while not batch.done():
+            batch.update(watcher.wait(timeout = 1))
+    except KeyboardInterrupt:
+        print('Interrupted, devices in flight keep their journals.')
+    finally:
+        watcher.close()
+        signer.shutdown(wait = False)
+        batch.report()
+    sys.exit(1 if batch.failures else 0)
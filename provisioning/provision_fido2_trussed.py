@@ -1,7 +1,16 @@
+import os
 import sys
+import json
+import time
 import struct
+import asyncio
+import logging
 import hmac
 import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 
 import ecdsa
 
@@ -14,99 +23,215 @@ from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.asymmetric import ed25519, x25519
 
 from write_random import write_random_file
-from util import Constants, SmartCardDevice, assert_ok, select, reset_fs, assert_not_ok, SmartCardError
-from cert_gen import generate_cert
+from apdu_stats import print_summary_at_exit
+from util import Constants, SmartCardDevice, AsyncCard, assert_ok, select, reset_fs, assert_not_ok, SmartCardError, get_uuid, write_file, SW_LOST_SELECTION
+from cert_gen import TemplateIssuer, sign_job
+from workload_trace import TraceWriter
 
 
-def write_file(card, filename, contents):
-    tester_filename_id = b'\xe1\x01'
-    tester_file_id = b'\xe1\x02'
+class StageTimer():
+    """
+    Start and end of each provisioning stage, relative to when provisioning started.
+    Stages may overlap, the card ones run while the host ones sign certificates.
+    """
 
-    print('writing contents to', filename)
-    print(contents[:64])
+    def __init__(self):
+        self.start = time.monotonic()
+        self.stages = []
+
+    def add(self, name, start, end):
+        self.stages.append((name, start - self.start, end - self.start))
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic())
+
+    def report(self, card_busy):
+        wall = time.monotonic() - self.start
+        print(f'{"stage":32} {"start ms":>9} {"end ms":>9} {"took ms":>9}')
+        for name, start, end in sorted(self.stages, key = lambda stage: stage[1]):
+            print(f'{name:32} {start * 1000:9.1f} {end * 1000:9.1f} {(end - start) * 1000:9.1f}')
+        print(f'card busy {card_busy * 1000:.1f} ms of {wall * 1000:.1f} ms wall time')
+
+def timed(func, *args):
+    start = time.monotonic()
+    result = func(*args)
+    return result, start, time.monotonic()
+
+def public_p256_key(data):
+    assert len(data) == 64  # P256 public key should be 64 bytes
+    x = int.from_bytes(data[:32], byteorder='big', signed=False)
+    y = int.from_bytes(data[32:64], byteorder='big', signed=False)
+    return ec.EllipticCurvePublicNumbers(x, y, ec.SECP256R1()).public_key()
+
+def public_ed255_key(data):
+    assert len(data) == 32  # ED255 public key should be 32 bytes
+    return ed25519.Ed25519PublicKey.from_public_bytes(bytes(data))
+
+def public_x255_key(data):
+    assert len(data) == 32  # X255 public key should be 32 bytes
+    return x25519.X25519PublicKey.from_public_bytes(bytes(data))
+
+# (name, generate ins, save cert ins, public key from the generate response)
+TRUSSED_KEYS = [
+    ('p256', Constants.Ins.GenerateP256, Constants.Ins.SaveP256Cert, public_p256_key),
+    ('ed255', Constants.Ins.GenerateED255, Constants.Ins.SaveED255Cert, public_ed255_key),
+    ('x255', Constants.Ins.GenerateX255, Constants.Ins.SaveX255Cert, public_x255_key),
+]
+
+class Journal():
+    """
+    Steps already done on one device, and their results, kept in
+    <directory>/<uuid>.json so a run that stopped halfway resumes where it
+    stopped.  The journal is removed once the device is fully provisioned.
+    """
 
-    # Select filename buffer
-    res = card.transmit_recv(0x00, Constants.Ins.Select, 0x00, 0x00, tester_filename_id)
-    assert_ok(res)
+    def __init__(self, directory, uuid, fresh = False):
+        self.path = os.path.join(directory, uuid.hex() + '.json')
+        self.steps = {}
+        if not fresh and os.path.exists(self.path):
+            with open(self.path) as f:
+                self.steps = json.load(f)['steps']
+        os.makedirs(directory, exist_ok = True)
 
-    # Write filename
-    res = card.transmit_recv(0x00, Constants.Ins.WriteBinary, 0x00, 0x00, filename)
-    assert_ok(res)
+    def done(self, step):
+        return step in self.steps
 
-    # Select file buffer
-    res = card.transmit_recv(0x00, Constants.Ins.Select, 0x00, 0x00, tester_file_id)
-    assert_ok(res)
+    def result(self, step):
+        return self.steps.get(step)
 
-    # Write file contents
-    res = card.transmit_recv(0x00, Constants.Ins.WriteBinary, 0x00, 0x00, contents)
-    assert_ok(res)
+    def record(self, step, result = None):
+        self.steps[step] = result
+        # Written whole and renamed, so a crash never leaves half a journal.
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'steps': self.steps}, f, indent = 1)
+        os.replace(self.path + '.tmp', self.path)
 
-    # flush
-    res = card.transmit_recv(0x00, Constants.Ins.WriteFile, 0x00, 0x00)
-    assert_ok(res)
-
-def get_uuid(card,):
-    # flush
-    res = card.transmit_recv(0x00, Constants.Ins.GetUUID, 0x00, 0x00)
-    assert_ok(res)
+    def finish(self):
+        os.remove(self.path)
 
-    assert len(res[:-2]) == 16
-    return res[:-2]
-
-def run_trussed_attestation(card,uuid,ca_cert_path,ca_key_path):
-
-    # Test that writing certs first doesn't work
-    res = card.transmit_recv(0x00, Constants.Ins.SaveP256Cert, 0x00, 0x00, b"\xAB" * 1500)
-    assert_not_ok(res)
-    res = card.transmit_recv(0x00, Constants.Ins.SaveED255Cert, 0x00, 0x00, b"\xAB" * 1500)
-    assert_not_ok(res)
+class StepRunner():
+    """
+    Runs provisioning steps on the card thread.  Steps already in the journal
+    are skipped.  A step that fails because the card lost its selection
+    (pcsc selecting something behind our back) is retried on its own, after
+    an exponential backoff and a fresh SELECT.
+    """
 
-    # Generate secret key
-    res = card.transmit_recv(0x00, Constants.Ins.GenerateP256, 0x00, 0x00)
+    def __init__(self, card, timer, retries = 3, backoff = .05):
+        self.card = card
+        self.timer = timer
+        self.retries = retries
+        self.backoff = backoff
+        # Set once the UUID is known.
+        self.journal = None
+        self.skipped = 0
+        self.retried = 0
+
+    def done(self, name):
+        return self.journal is not None and self.journal.done(name)
+
+    def record(self, name, result = None):
+        if self.journal is not None:
+            self.journal.record(name, result)
+
+    async def run(self, name, func, *args):
+        """
+        Awaits func(device, *args) as step `name` and returns its result, which
+        is journaled along with it, so it has to be JSON serializable.
+        """
+        if self.done(name):
+            self.skipped += 1
+            return self.journal.result(name)
+
+        with self.timer.stage(name):
+            for attempt in range(self.retries + 1):
+                try:
+                    if attempt:
+                        await self.card.run(select)
+                    result = await self.card.run(func, *args)
+                    break
+                except SmartCardError as e:
+                    if e.code not in SW_LOST_SELECTION or attempt == self.retries:
+                        raise
+                    delay = self.backoff * 2 ** attempt
+                    print(f"{name}: device returned {hex(e.code)}, retrying in {delay * 1000:.0f} ms")
+                    self.retried += 1
+                    await asyncio.sleep(delay)
+
+        self.record(name, result)
+        return result
+
+def generate_key(card, ins):
+    res = card.transmit_recv(0x00, ins, 0x00, 0x00)
     assert_ok(res)
-    assert len(res[:-2]) == 64  # P256 public key should be 64 bytes
-    x = int.from_bytes(res[:32], byteorder='big', signed=False)
-    y = int.from_bytes(res[32:64], byteorder='big', signed=False)
-    public_p256 = ec.EllipticCurvePublicNumbers(x, y, ec.SECP256R1()).public_key()
+    return bytes(res.data).hex()
 
-    # Generate secret key
-    res = card.transmit_recv(0x00, Constants.Ins.GenerateED255, 0x00, 0x00)
+def save(card, ins, data):
+    res = card.transmit_recv(0x00, ins, 0x00, 0x00, data)
     assert_ok(res)
-    assert len(res[:-2]) == 32  # ED255 public key should be 32 bytes
-    public_ed255 = ed25519.Ed25519PublicKey.from_public_bytes(res[:32])
 
-    # Generate secret key
-    res = card.transmit_recv(0x00, Constants.Ins.GenerateX255, 0x00, 0x00)
-    assert_ok(res)
-    assert len(res[:-2]) == 32  # ED255 public key should be 32 bytes
-    public_x255 = x25519.X25519PublicKey.from_public_bytes(res[:32])
+def expect_rejected(card, ins, data):
+    """
+    Sends a command the firmware must refuse, returns the status word it did
+    so with.  An unknown class or instruction, or a missing file, means the
+    tester wasn't selected, which proves nothing: that is raised so the step
+    is retried after a fresh SELECT.
+    """
+    res = card.transmit_recv(0x00, ins, 0x00, 0x00, data)
+    if res.sw in SW_LOST_SELECTION:
+        raise SmartCardError(f"Device returned {hex(res.sw)}", res.sw)
+    assert_not_ok(res)
+    return res.sw
+
+async def sign_cert(steps, name, issuer, signer, public_key, serial_number):
+    if steps.done(name):
+        steps.skipped += 1
+        return bytes.fromhex(steps.journal.result(name))
+    loop = asyncio.get_running_loop()
+    if isinstance(signer, ProcessPoolExecutor):
+        # Issuer.process_pool() workers sign with their own copy of the issuer.
+        cert, start, end = await loop.run_in_executor(signer, timed, sign_job, issuer.job(public_key, serial_number))
+    else:
+        cert, start, end = await loop.run_in_executor(signer, timed, issuer.sign, public_key, serial_number)
+    steps.timer.add(name, start, end)
+    steps.record(name, cert.hex())
+    return cert
+
+async def run_trussed_attestation(steps, uuid, issuer, signer):
+    """
+    Generates the trussed keys on the card and writes back their certificates.
+    Each certificate is signed by `issuer` in the `signer` pool as soon as its
+    public key is known, while the card generates the next key.
+    """
+    # Test that writing certs first doesn't work
+    await steps.run('reject early p256 cert', expect_rejected, Constants.Ins.SaveP256Cert, b"\xAB" * 1500)
+    await steps.run('reject early ed255 cert', expect_rejected, Constants.Ins.SaveED255Cert, b"\xAB" * 1500)
 
     uuid_integer = int.from_bytes(uuid, byteorder='big', signed=False)
-    hostname = "SoloKeys trussed Attestation"
-    cert_p256  = generate_cert(ca_cert, ca_key, public_p256, hostname, serial_number=uuid_integer)
-    cert_ed255 = generate_cert(ca_cert, ca_key, public_ed255, hostname, serial_number=uuid_integer)
-    cert_x255 = generate_cert(ca_cert, ca_key, public_x255, hostname, serial_number=uuid_integer)
 
+    certs = []
+    for name, generate_ins, _, public_key in TRUSSED_KEYS:
+        # Generate secret key, a retry just replaces it.  The journaled public
+        # key keeps the certificate matching whichever key the card kept.
+        public = bytes.fromhex(await steps.run('generate ' + name, generate_key, generate_ins))
+        certs.append(asyncio.ensure_future(
+            sign_cert(steps, 'sign ' + name, issuer, signer, public_key(public), uuid_integer)))
 
     # Test that writing tiny certs doesn't work
-    res = card.transmit_recv(0x00, Constants.Ins.SaveP256Cert, 0x00, 0x00, b"\xAB" * 16)
-    assert_not_ok(res)
-    res = card.transmit_recv(0x00, Constants.Ins.SaveED255Cert, 0x00, 0x00, b"\xAB" * 16)
-    assert_not_ok(res)
-    res = card.transmit_recv(0x00, Constants.Ins.SaveX255Cert, 0x00, 0x00, b"\xAB" * 16)
-    assert_not_ok(res)
+    for name, _, save_ins, _ in TRUSSED_KEYS:
+        await steps.run(f'reject tiny {name} cert', expect_rejected, save_ins, b"\xAB" * 16)
 
-    # Write back certificates
-    res = card.transmit_recv(0x00, Constants.Ins.SaveP256Cert, 0x00, 0x00, cert_p256)
-    assert_ok(res)
-    res = card.transmit_recv(0x00, Constants.Ins.SaveED255Cert, 0x00, 0x00, cert_ed255)
-    assert_ok(res)
-    res = card.transmit_recv(0x00, Constants.Ins.SaveX255Cert, 0x00, 0x00, cert_x255)
-    assert_ok(res)
+    # Write back certificates, in order as they are signed
+    for (name, _, save_ins, _), cert in zip(TRUSSED_KEYS, certs):
+        await steps.run('save ' + name, save, save_ins, await cert)
 
     # Write T1 public key (dont currently have ed255 cert in setup, but any random bytes will do)
-    res = card.transmit_recv(0x00, Constants.Ins.SaveT1IntermediatePublicKey, 0x00, 0x00, b'A' * 32)
-    assert_ok(res)
+    await steps.run('save t1 key', save, Constants.Ins.SaveT1IntermediatePublicKey, b'A' * 32)
 
 
 def test_trussed_attestation(card,):
@@ -121,29 +246,28 @@ def test_trussed_attestation(card,):
     """
     print("Testing P256...")
     res = card.transmit_recv(0x00, Constants.Ins.TestAttestation, 0x00, 0x00)
-    code = res[-1] | (res[-2] << 8)
-    if code == 0x6a81:
+    if res.sw == 0x6a81:
         print("TestAttestion is NOT enabled in device, skipping.")
         return
     assert_ok(res)
-    chal = res[0:32]
-    sig = res[32:-2]
+    chal = bytes(res.data[0:32])
+    sig = bytes(res.data[32:])
 
     res = card.transmit_recv(0x00, Constants.Ins.TestAttestation, 0x01, 0x00)
     assert_ok(res)
-    cert_der = res[:-2]
+    cert_der = bytes(res.data)
     cert = x509.load_der_x509_certificate(cert_der)
 
     cert.public_key().verify(sig, chal, ec.ECDSA(hashes.SHA256()))
     print("Testing ED255...")
     res = card.transmit_recv(0x00, Constants.Ins.TestAttestation, 0x02, 0x00)
     assert_ok(res)
-    chal = res[0:32]
-    sig = res[32:-2]
+    chal = bytes(res.data[0:32])
+    sig = bytes(res.data[32:])
 
     res = card.transmit_recv(0x00, Constants.Ins.TestAttestation, 0x03, 0x00)
     assert_ok(res)
-    cert_der = res[:-2]
+    cert_der = bytes(res.data)
     cert = x509.load_der_x509_certificate(cert_der)
     # taking more pedantic way to verify ed255 sig.
     pubkey_ed255 = ed25519.Ed25519PublicKey.from_public_bytes(
@@ -157,13 +281,13 @@ def test_trussed_attestation(card,):
 
     res = card.transmit_recv(0x00, Constants.Ins.TestAttestation, 0x04, 0x00, our_x255_bytes)
     assert_ok(res)
-    chal = res[0:32]
-    sig = res[32:-2]
+    chal = bytes(res.data[0:32])
+    sig = bytes(res.data[32:])
     print('GOT OK')
 
     res = card.transmit_recv(0x00, Constants.Ins.TestAttestation, 0x05, 0x00)
     assert_ok(res)
-    cert_der = res[:-2]
+    cert_der = bytes(res.data)
     cert = x509.load_der_x509_certificate(cert_der)
     # taking more pedantic way to verify ed255 sig.
     pubkey_x255 = x25519.X25519PublicKey.from_public_bytes(
@@ -182,56 +306,97 @@ def test_trussed_attestation(card,):
 
 
 
-if len(sys.argv) != 5:
-    print('Usage: %s <fido-attestation-cert.der> <fido-attestation-key.pem> <ca-intermediate-cert.pem> <ca-intermediate-key.pem>' % sys.argv[0])
-    sys.exit(1)
+def write_random_files(card, count):
+    for _ in islice(write_random_file(card), count):
+        pass
 
-cert_der = open(sys.argv[1],'rb').read()
-private_key_pem = open(sys.argv[2],'rb').read()
-private_key_raw = ecdsa.SigningKey.from_pem(private_key_pem).to_string()
-
-# for trussed certs
-ca_cert = open(sys.argv[3],'rb').read()
-ca_key = open(sys.argv[4],'rb').read()
-
-try:
-    card = next(SmartCardDevice.list_devices(name = "Provisioner"))
-except:
-    card = next(SmartCardDevice.list_devices(name = "SoloKeys"))
-
-fido2_key_filename = b'/fido/sec/00'
-fido2_cert_filename = b'/fido/x5c/00'
+async def write_random_file_steps(steps, name, count):
+    # One step per file, so a lost selection only costs that file.
+    for i in range(count):
+        await steps.run(f'{name} {i}', write_random_files, 1)
 
+async def provision(card, cert_der, private_key_raw, issuer, signer,
+        journal_dir = 'journal', fresh = False, retries = 3, backoff = .05):
+    """
+    Provisions the device behind `card`, resuming from its journal in
+    `journal_dir` unless `fresh`.
+    """
+    timer = StageTimer()
+    steps = StepRunner(card, timer, retries, backoff)
 
-try:
+    print ("Selecting tester..")
+    await steps.run('select', select)
+    uuid = bytes.fromhex(await steps.run('get uuid', lambda device: get_uuid(device).hex()))
+    steps.journal = Journal(journal_dir, uuid, fresh)
+    if steps.journal.steps:
+        print(f"Resuming {uuid.hex()} after {len(steps.journal.steps)} journaled steps")
 
-    print ("Selecting tester and resetting..")
-    select(card)
-    reset_fs(card)
+    print ("Resetting..")
+    await steps.run('reset fs', reset_fs)
 
     print("Writing FIDO2 attestation")
     flags = (1 << 1) # SENSITIVE
     kind = 5 # P256
-    write_file(card, fido2_key_filename, struct.pack(">HH", flags, kind) + private_key_raw)
-    write_file(card, fido2_cert_filename, cert_der)
+    await steps.run('write fido2 key', write_file, fido2_key_filename, struct.pack(">HH", flags, kind) + private_key_raw)
+    await steps.run('write fido2 cert', write_file, fido2_cert_filename, cert_der)
 
     print("Generating trussed attestation")
+    await write_random_file_steps(steps, 'random file', 10)
 
+    await run_trussed_attestation(steps, uuid, issuer, signer)
 
-    uuid = get_uuid(card)
-
-    for i in range(0,10):
-        write_random_file(card)
+    await write_random_file_steps(steps, 'more random file', 10)
 
-    run_trussed_attestation(card, uuid, ca_cert, ca_key)
+    await steps.run('verify', test_trussed_attestation)
 
-    for i in range(0,10):
-        write_random_file(card)
+    steps.journal.finish()
+    timer.report(card.busy)
+    print(f"{steps.skipped} steps skipped from the journal, {steps.retried} retried")
+    return uuid
 
-    test_trussed_attestation(card)
+fido2_key_filename = b'/fido/sec/00'
+fido2_cert_filename = b'/fido/x5c/00'
 
-except SmartCardError as e:
-    # Occasionally the OS's PCSC steps in and tries to select some nonexistant app,
-    # making our test return "not found" because our applet is no longer selected..
-    assert e.code == 0x6a82
-    print("Thanks pcsc. restarting..")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Provision the FIDO2 and trussed attestation of a device.")
+    parser.add_argument('fido_cert', help = "fido-attestation-cert.der")
+    parser.add_argument('fido_key', help = "fido-attestation-key.pem")
+    parser.add_argument('ca_cert', help = "ca-intermediate-cert.pem")
+    parser.add_argument('ca_key', help = "ca-intermediate-key.pem")
+    parser.add_argument('--journal', default = 'journal', help = "directory of per device step journals (default: %(default)s)")
+    parser.add_argument('--fresh', action = 'store_true', help = "ignore any journal and provision from scratch")
+    parser.add_argument('--retries', type = int, default = 3, help = "retries of a step that lost the selection (default: %(default)s)")
+    parser.add_argument('--backoff', type = float, default = .05, help = "seconds before the first retry, doubling after (default: %(default)s)")
+    parser.add_argument('--record', help = "write the run (files written, every other APDU) as a trace for workload_trace.py replay")
+    args = parser.parse_args()
+
+    # LOGLEVEL=DEBUG traces every APDU
+    logging.basicConfig(level = os.environ.get('LOGLEVEL', 'WARNING'))
+    # SOLO2_APDU_STATS=<prefix> times every APDU
+    print_summary_at_exit(SmartCardDevice.stats)
+
+    cert_der = open(args.fido_cert,'rb').read()
+    private_key_pem = open(args.fido_key,'rb').read()
+    private_key_raw = ecdsa.SigningKey.from_pem(private_key_pem).to_string()
+
+    # for trussed certs
+    ca_cert = open(args.ca_cert,'rb').read()
+    ca_key = open(args.ca_key,'rb').read()
+    issuer = TemplateIssuer(ca_cert, ca_key, "SoloKeys trussed Attestation")
+
+    card = AsyncCard(SmartCardDevice.wait_for_device(["Provisioner", "SoloKeys"]))
+    if args.record:
+        card.device.trace = TraceWriter(args.record)
+    signer = ThreadPoolExecutor(max_workers = len(TRUSSED_KEYS), thread_name_prefix = 'sign')
+
+    try:
+        asyncio.run(provision(card, cert_der, private_key_raw, issuer, signer,
+                args.journal, args.fresh, args.retries, args.backoff))
+    except SmartCardError as e:
+        print(f"Provisioning stopped: {e}.  Run again to resume from the journal.")
+        sys.exit(1)
+    finally:
+        card.close()
+        signer.shutdown()
+        if args.record:
+            card.device.trace.close()
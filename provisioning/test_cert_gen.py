@@ -0,0 +1,64 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+from cert_gen import Issuer, TemplateIssuer
+from bench_cert_gen import HOSTNAME, SUBJECTS, throwaway_ca
+
+# TemplateIssuer must issue the certificates CertificateBuilder (Issuer)
+# does, for every CA and subject key kind and every serial and date shape.
+#
+#   cd provisioning && python3 -m pytest test_cert_gen.py
+
+# Every serial length and sign boundary of a 128 bit UUID, and dates either
+# side of the UTCTime/GeneralizedTime switch.
+SERIALS = [1, 0x7f, 0x80, 0xff, 0x100] + [bound for bits in range(15, 129, 8) for bound in (2**bits - 1, 2**bits)] + [2**128 - 1]
+DATES = [
+    datetime(2026, 10, 18, 12, 30, 45),
+    datetime(2026, 10, 18, 12, 30, 45, 999999),
+    datetime(2049, 12, 31, 23, 59, 59),
+    datetime(2050, 1, 1, 0, 0, 0),
+]
+
+CAS = {
+    'P256': lambda: ec.generate_private_key(ec.SECP256R1()),
+    'Ed25519': ed25519.Ed25519PrivateKey.generate,
+    'RSA': lambda: rsa.generate_private_key(public_exponent=65537, key_size=2048),
+}
+
+# ECDSA signatures are randomized, the others sign the same bytes the same way.
+DETERMINISTIC = ('Ed25519', 'RSA')
+
+@pytest.fixture(scope = 'module', params = list(CAS))
+def ca(request):
+    ca_cert, ca_key = throwaway_ca(CAS[request.param])
+    return request.param, Issuer(ca_cert, ca_key, HOSTNAME), TemplateIssuer(ca_cert, ca_key, HOSTNAME)
+
+@pytest.mark.parametrize('subject', list(SUBJECTS))
+def test_template_matches_certificate_builder(ca, subject):
+    ca_name, reference, template = ca
+    generate = SUBJECTS[subject]
+    for serial in SERIALS:
+        for now in DATES:
+            # The first certificate of a shape is the template itself, start from a different key.
+            template.sign(generate(), serial, now)
+            public_key = generate()
+            expected = reference.sign(public_key, serial, now)
+            der = template.sign(public_key, serial, now)
+            shape = (ca_name, subject, hex(serial), now)
+            if ca_name in DETERMINISTIC:
+                assert der == expected, shape
+            else:
+                cert = x509.load_der_x509_certificate(der)
+                expected = x509.load_der_x509_certificate(expected)
+                assert cert.tbs_certificate_bytes == expected.tbs_certificate_bytes, shape
+                assert cert.signature_algorithm_oid == expected.signature_algorithm_oid, shape
+                cert.verify_directly_issued_by(reference.ca_cert)
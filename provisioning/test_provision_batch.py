@@ -0,0 +1,70 @@
+import os
+import sys
+import argparse
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+pytest.importorskip('smartcard')
+
+from provision_batch import Batch
+
+#   cd provisioning && python3 -m pytest test_provision_batch.py
+
+class FakeReader():
+
+    def __init__(self, name):
+        self.name = name
+
+class FakeWatcher():
+    """
+    Plays back {reader: card present} snapshots, like ReaderWatcher.wait() reports them.
+    """
+
+    def __init__(self, *snapshots):
+        self.snapshots = list(snapshots)
+
+    def wait(self, timeout):
+        return self.snapshots.pop(0)
+
+class RecordingBatch(Batch):
+    """
+    Notes which readers a worker was started for instead of provisioning,
+    and finishes each worker straight away.
+    """
+
+    def __init__(self):
+        super().__init__(argparse.Namespace(count = None, idle = None), None, None, None)
+        self.started = []
+
+    def provision_device(self, reader):
+        self.started.append(reader.name)
+        self.finished(reader.name, b'\x00' * 16, None, 0, None)
+
+def run(batch, watcher):
+    while watcher.snapshots:
+        batch.update(watcher.wait(timeout = 1))
+        for worker in list(batch.active.values()):
+            worker.join()
+
+def test_card_is_provisioned_once():
+    reader = FakeReader('SoloKeys Solo 2 00 00')
+    batch = RecordingBatch()
+    run(batch, FakeWatcher({reader: True}, {reader: True}, {reader: True}))
+    assert batch.started == [reader.name]
+
+def test_card_swapped_in_same_reader():
+    reader = FakeReader('Provisioner 00 00')
+    batch = RecordingBatch()
+    run(batch, FakeWatcher({reader: True}, {reader: False}, {reader: True}))
+    assert batch.started == [reader.name] * 2
+
+def test_reader_unplugged_and_replaced():
+    # The DUT is its own reader: unplugging it takes the reader away, and
+    # the next device enumerates under the same name.
+    first = FakeReader('SoloKeys Solo 2 00 00')
+    other = FakeReader('Provisioner 00 00')
+    replacement = FakeReader('SoloKeys Solo 2 00 00')
+    batch = RecordingBatch()
+    run(batch, FakeWatcher({first: True, other: True}, {other: True}, {replacement: True, other: True}))
+    assert batch.started == [first.name, other.name, replacement.name]
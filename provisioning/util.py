@@ -32,21 +32,31 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from smartcard import System
-from smartcard.pcsc.PCSCExceptions import ListReadersException
-from smartcard.pcsc.PCSCContext import PCSCContext
 from smartcard.CardConnection import CardConnection
 
-from binascii import b2a_hex, hexlify
+from binascii import hexlify
+from concurrent.futures import ThreadPoolExecutor
 from threading import Event
-import struct
-import six
+import asyncio
+import time
 import logging
 
+import apdu_stats
+import framing
+from pcsc_readers import ReaderRegistry, ReaderWatcher, reader_registry
+
 SW_SUCCESS = (0x90, 0x00)
 SW_UPDATE = (0x91, 0x00)
 SW1_MORE_DATA = 0x61
 
+# Status words after which we can no longer trust what is selected on the card.
+# 0x6a82 (file not found) shows up when pcscd has selected something behind our back.
+SW_LOST_SELECTION = (0x6a82, 0x6a86, 0x6d00, 0x6e00)
+
+TESTER_AID = b"\xA0\x00\x00\x08\x47\x01\x00\x00\x01"
+TESTER_FILENAME_ID = b'\xe1\x01'
+TESTER_FILE_ID = b'\xe1\x02'
+
 logger = logging.getLogger(__name__)
 
 class SmartCardError(Exception):
@@ -54,111 +64,323 @@ class SmartCardError(Exception):
         super().__init__(message)
         self.code = code
 
-def _list_readers():
-    try:
-        return System.readers()
-    except ListReadersException:
-        # If the PCSC system has restarted the context might be stale, try
-        # forcing a new context (This happens on Windows if the last reader is
-        # removed):
-        PCSCContext.instance = None
-        return System.readers()
-
-def assert_ok(response_apdu):
-    code = response_apdu[-1] | (response_apdu[-2] << 8)
-    if code == 0x9000:
-        pass
-    else:
-        raise SmartCardError(f"Device returned {hex(code)}", code)
-
-def assert_not_ok(response_apdu):
-    code = response_apdu[-1] | (response_apdu[-2] << 8)
-    assert code != 0x9000
+def assert_ok(response):
+    if response.sw != 0x9000:
+        raise SmartCardError(f"Device returned {hex(response.sw)}", response.sw)
+
+def assert_not_ok(response):
+    assert response.sw != 0x9000
+
+
+class ApduResponse():
+    """
+    Response data as a memoryview (no copies when slicing) and the status word as an int.
+    """
+    __slots__ = ('data', 'sw')
+
+    def __init__(self, data, sw):
+        self.data = data
+        self.sw = sw
+
+    def __repr__(self):
+        return "ApduResponse(%s, 0x%04x)" % (hexlify(self.data).decode(), self.sw)
 
 
 class SmartCardDevice():
+    # CLA INS P1 P2 00 Lc1 Lc2 + data
+    MAX_APDU_SIZE = 7 + 0xffff
+    # Records every command when set, see apdu_stats.py
+    stats = None
+    # Writes every command to a workload trace when set, see workload_trace.py
+    trace = None
+    # Where the framing probed for each reader is kept, see framing.py.
+    # Without one every connection probes.
+    framing_cache = None
+
     def __init__(self, connection, name):
         self._capabilities = 0
-        self.use_ext_apdu = True
         self._conn = connection
-        self._conn.connect(CardConnection.T1_protocol)
+        self._protocol = CardConnection.T1_protocol
+        self._conn.connect(self._protocol)
         self._name = name
+        # Every APDU is assembled in place here and sent from a view of it.
+        self._buffer = bytearray(self.MAX_APDU_SIZE)
+        self._view = memoryview(self._buffer)
+        # What we last selected on the card, so repeated SELECTs can be skipped.
+        self.selected_applet = None
+        self.selected_file = None
+        self.uuid = None
+        self.set_framing(self._negotiate_framing())
 
     def __repr__(self):
         return "SmartCardDevice(%s)" % self._name
 
+    @property
+    def name(self):
+        return self._name
+
+    def _build_apdu(self, cla, ins, p1, p2, data, extended, le = None):
+        buf = self._buffer
+        buf[0] = cla
+        buf[1] = ins
+        buf[2] = p1
+        buf[3] = p2
+        length = len(data)
+        if extended:
+            buf[4] = 0
+            buf[5] = length >> 8
+            buf[6] = length & 0xff
+            offset = 7
+        elif length:
+            buf[4] = length
+            offset = 5
+        else:
+            offset = 4
+        buf[offset:offset + length] = data
+        offset += length
+        if le is not None:
+            buf[offset] = le
+            offset += 1
+        return self._view[:offset]
+
     def _apdu_exchange(self, apdu, protocol):
         """Exchange data with smart card.
-        :param apdu: byte string. data to exchange with card
-        :return: byte string. response from card
+        :param apdu: memoryview of the assembled command
+        :return: response bytes, sw1, sw2
         """
-
-        logger.debug("apdu %s", b2a_hex(apdu))
-        print('sending', len(list(six.iterbytes(apdu))))
-        resp, sw1, sw2 = self._conn.transmit(list(six.iterbytes(apdu)), protocol)
-        response = bytes(bytearray(resp))
-        logger.debug("response [0x%04X] %s", sw1 << 8 + sw2, b2a_hex(response))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("<< %s", hexlify(apdu).decode())
+        # pyscard only takes lists of ints, this is the one conversion per direction.
+        resp, sw1, sw2 = self._conn.transmit(apdu.tolist(), protocol)
+        response = bytes(resp)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(">> %s %02x%02x", hexlify(response).decode(), sw1, sw2)
 
         return response, sw1, sw2
 
     def _chain_apdus(self, cla, ins, p1, p2, data=b""):
-        if self.use_ext_apdu:
-            print('using T1')
-            header = struct.pack("!BBBBBH", cla, ins, p1, p2, 0x00, len(data))
-            resp, sw1, sw2 = self._apdu_exchange(header + data, CardConnection.T1_protocol)
-            return resp, sw1, sw2
+        if self.use_ext_apdu and len(data) <= self.max_ext_data:
+            apdu = self._build_apdu(cla, ins, p1, p2, data, True)
+            return self._apdu_exchange(apdu, self._protocol)
         else:
-            while len(data) > 250:
-                to_send, data = data[:250], data[250:]
-                header = struct.pack("!BBBBB", 0x10 | cla, ins, p1, p2, len(to_send))
-                resp, sw1, sw2 = self._apdu_exchange(header + to_send, CardConnection.T0_protocol)
+            chunk_size = self.chunk_size
+            data = memoryview(data)
+            while len(data) > chunk_size:
+                to_send, data = data[:chunk_size], data[chunk_size:]
+                apdu = self._build_apdu(0x10 | cla, ins, p1, p2, to_send, False)
+                resp, sw1, sw2 = self._apdu_exchange(apdu, self._protocol)
                 if (sw1, sw2) != SW_SUCCESS:
                     return resp, sw1, sw2
-            apdu = struct.pack("!BBBB", cla, ins, p1, p2)
-            if data:
-                apdu += struct.pack("!B", len(data)) + data
-            resp, sw1, sw2 = self._apdu_exchange(apdu + b"\x00", CardConnection.T0_protocol)
+            apdu = self._build_apdu(cla, ins, p1, p2, data, False, le = 0)
+            resp, sw1, sw2 = self._apdu_exchange(apdu, self._protocol)
+            if sw1 == SW1_MORE_DATA:
+                resp = bytearray(resp)
             while sw1 == SW1_MORE_DATA:
-                apdu = b"\x00\xc0\x00\x00" + struct.pack("!B", sw2)  # sw2 == le
-                lres, sw1, sw2 = self._apdu_exchange(apdu, CardConnection.T0_protocol)
+                apdu = self._build_apdu(0x00, 0xc0, 0x00, 0x00, b"", False, le = sw2)  # sw2 == le
+                lres, sw1, sw2 = self._apdu_exchange(apdu, self._protocol)
                 resp += lres
             return resp, sw1, sw2
 
-    def _call_apdu(self, apdu):
-        if len(apdu) >= 7 and six.indexbytes(apdu, 4) == 0:
-            # Extended APDU
-            data_len = struct.unpack("!H", apdu[5:7])[0]
-            data = apdu[7 : 7 + data_len]
-        else:
-            # Short APDU
-            data_len = six.indexbytes(apdu, 4)
-            data = apdu[5 : 5 + data_len]
-        (cla, ins, p1, p2) = six.iterbytes(apdu[:4])
-        print('send %d bytes' % len(data))
-        resp, sw1, sw2 = self._chain_apdus(cla, ins, p1, p2, data)
-        return resp + struct.pack("!BB", sw1, sw2)
+    def set_framing(self, framing):
+        self.framing = framing
+        self.use_ext_apdu = framing.extended
+        self.max_ext_data = framing.max_data
+        self.chunk_size = framing.chunk_size
+
+    def _negotiate_framing(self):
+        cache = self.framing_cache
+        if cache is not None:
+            cached = cache.get(self._name)
+            if cached is not None:
+                return cached
+        result = self.probe_framing()
+        # Only keep what was actually probed.
+        if cache is not None and result.probed is not None:
+            cache.put(self._name, result)
+        return result
+
+    def _probe_select(self):
+        """
+        Selects the tester's file buffer for the probe, True if the card has it.
+        Sent as short APDUs, no framing is known yet.
+        """
+        for p1, data in ((0x04, TESTER_AID), (0x00, TESTER_FILE_ID)):
+            apdu = self._build_apdu(0x00, Constants.Ins.Select, p1, 0x00, data, False)
+            try:
+                _, sw1, sw2 = self._apdu_exchange(apdu, self._protocol)
+            except Exception as e:
+                logger.debug("Probe SELECT failed: %r", e)
+                return False
+            if (sw1, sw2) != SW_SUCCESS:
+                logger.debug("Probe SELECT returned %02x%02x", sw1, sw2)
+                return False
+        return True
+
+    def _probe_frame(self, size, extended):
+        """
+        Seconds until a WRITE BINARY of `size` bytes to the tester's file
+        buffer was accepted, or None if it didn't get through.  Only 9000
+        proves the whole payload arrived, a reader that truncates or mangles
+        the frame gets 6700, 6A80 and the like back.
+        """
+        kind = 'extended' if extended else 'short'
+        apdu = self._build_apdu(0x00, Constants.Ins.WriteBinary, 0x00, 0x00, b'\xa5' * size, extended)
+        start = time.monotonic()
+        try:
+            _, sw1, sw2 = self._apdu_exchange(apdu, self._protocol)
+        except Exception as e:
+            logger.debug("%d byte %s frame failed: %r", size, kind, e)
+            # Some readers need a fresh connection after choking on a frame,
+            # but one that keeps choking isn't worth a reconnect per size.
+            if not self._probe_reconnected:
+                self._probe_reconnected = True
+                logger.warning("Reconnecting to %s after a %d byte %s frame failed", self._name, size, kind)
+                self._conn.disconnect()
+                self._conn.connect(self._protocol)
+                self._probe_select()
+            return None
+        if (sw1, sw2) != SW_SUCCESS:
+            logger.debug("%d byte %s frame returned %02x%02x", size, kind, sw1, sw2)
+            return None
+        return time.monotonic() - start
+
+    def probe_framing(self):
+        """
+        Finds the largest extended APDU and short APDU chunk this reader passes
+        and times the largest frame.  Returns a framing.Framing, one that only
+        chains short APDUs and has no `probed` time if the card has no tester
+        applet to probe with.
+        """
+        self._probe_reconnected = False
+        try:
+            if not self._probe_select():
+                logger.warning("No tester applet on %s, chaining short APDUs without probing", self._name)
+                return framing.Framing(False, 0, min(framing.SHORT_SIZES))
+            max_data = 0
+            for size in framing.EXTENDED_SIZES:
+                if self._probe_frame(size, True) is None:
+                    break
+                max_data = size
+            chunk_size = next((size for size in framing.SHORT_SIZES if self._probe_frame(size, False) is not None), None)
+            if chunk_size is None and not max_data:
+                raise SmartCardError(f"No APDU got through {self._name}", 0)
+            extended = bool(max_data)
+            frame = max_data if extended else chunk_size
+            took = [self._probe_frame(frame, extended) for _ in range(framing.REPEATS)]
+            took = [t for t in took if t is not None]
+        finally:
+            # The probe selected the tester's file buffer and filled it with junk.
+            self.invalidate_selection()
+        return framing.Framing(extended, max_data or 0, chunk_size or 250,
+                frame / min(took) if took else None, time.time())
 
     def transmit_recv(self, cla, ins, p1, p2, data = b'', le = None):
+        """
+        Sends one command (chained if needed) and returns an ApduResponse.
+        """
+        stats = self.stats
+        trace = self.trace
+        if stats is not None or trace is not None:
+            start = time.monotonic()
+        try:
+            resp, sw1, sw2 = self._chain_apdus(cla, ins, p1, p2, data)
+        except Exception:
+            self.invalidate_selection()
+            raise
+        sw = (sw1 << 8) | sw2
+        if stats is not None:
+            stats.record(ins, len(data), sw, start, time.monotonic())
+        if trace is not None:
+            trace.command(cla, ins, p1, p2, data, sw, time.monotonic() - start)
+        if ins == Constants.Ins.Select:
+            self._track_select(p1, data, sw)
+        elif sw in SW_LOST_SELECTION:
+            self.invalidate_selection()
+        return ApduResponse(memoryview(resp), sw)
+
+    def _track_select(self, p1, data, sw):
+        if sw != 0x9000:
+            self.invalidate_selection()
+        elif p1 == 0x04:
+            self.selected_applet = bytes(data)
+            self.selected_file = None
+        else:
+            self.selected_file = bytes(data)
+
+    def invalidate_selection(self):
+        """
+        Forget what is selected, the next select_applet/select_file goes to the card.
+        """
+        self.selected_applet = None
+        self.selected_file = None
+
+    def select_applet(self, aid):
+        """
+        SELECT by AID, skipped if `aid` is already selected.
+        """
+        if self.selected_applet == aid:
+            return
+        res = self.transmit_recv(0x00, Constants.Ins.Select, 0x04, 0x00, aid)
+        assert_ok(res)
 
-        apdu = struct.pack("!BBBB", cla, ins, p1, p2)
-        # if len(data) > 255:
-        apdu += b'\x00' + struct.pack(">H", len(data))
-        # else:
-            # apdu += struct.pack("!B", len(data))
-        apdu += data
-        print('<<', hexlify(apdu).decode())
-        res = self._call_apdu(apdu)
-        print('>>', hexlify(res).decode())
-        return res
+    def select_file(self, file_id):
+        """
+        SELECT of an elementary file in the current applet, skipped if already selected.
+        """
+        if self.selected_file == file_id:
+            return
+        res = self.transmit_recv(0x00, Constants.Ins.Select, 0x00, 0x00, file_id)
+        assert_ok(res)
 
     @classmethod
     def list_devices(cls,name=""):
-        for reader in _list_readers():
-            if name in reader.name:
-                try:
-                    yield cls(reader.createConnection(), reader.name)
-                except Exception as e:
-                    logger.debug("Error %r", e)
+        for reader in reader_registry.find([name]):
+            try:
+                yield cls(reader.createConnection(), reader.name)
+            except Exception as e:
+                logger.debug("Error %r", e)
+
+    @classmethod
+    def wait_for_device(cls, names, timeout = 10):
+        """
+        Connects to the first card in a reader matching `names`, waiting up to
+        `timeout` seconds for one to be inserted.
+        """
+        reader = reader_registry.wait_for(names, card = True, timeout = timeout)
+        return cls(reader.createConnection(), reader.name)
+
+class AsyncCard():
+    """
+    Runs every exchange with a SmartCardDevice on one dedicated thread, so
+    asyncio code can await card I/O while host work carries on.  `busy` adds
+    up the seconds spent talking to the card.  `initializer` runs first thing
+    on the card thread.
+    """
+
+    def __init__(self, device, initializer = None):
+        self.device = device
+        self.busy = 0.0
+        self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'card', initializer = initializer)
+
+    def _timed(self, func, args):
+        start = time.monotonic()
+        try:
+            return func(self.device, *args)
+        finally:
+            self.busy += time.monotonic() - start
+
+    async def run(self, func, *args):
+        """
+        Awaits func(device, *args) on the card thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._timed, func, args)
+
+    async def transmit_recv(self, cla, ins, p1, p2, data = b'', le = None):
+        return await self.run(lambda device: device.transmit_recv(cla, ins, p1, p2, data, le))
+
+    def close(self):
+        self._executor.shutdown()
 
 class Constants:
     class Ins:
@@ -190,13 +412,68 @@ class Constants:
         RebootToApp = 0x53
         RebootToUpdate = 0x51
 
+INS_NAMES = {ins: name for name, ins in vars(Constants.Ins).items() if not name.startswith('_')}
+
+SmartCardDevice.stats = apdu_stats.from_environment(INS_NAMES)
+SmartCardDevice.framing_cache = framing.FramingCache()
+
 def select(card,):
-    tester_aid = b"\xA0\x00\x00\x08\x47\x01\x00\x00\x01"
-    # select tester app
-    res = card.transmit_recv(0x00, Constants.Ins.Select, 0x04, 0x00, tester_aid)
-    assert_ok(res)
+    # select tester app, a no-op if it is still selected
+    card.select_applet(TESTER_AID)
 
 def reset_fs(card,):
-    # Select filename buffer
     res = card.transmit_recv(0x00, Constants.Ins.ReformatFs, 0x00, 0x00)
+    # The buffers may be cleared along with the filesystem.
+    card.selected_file = None
+    assert_ok(res)
+
+def get_uuid(card,):
+    # The UUID can't change under us, only ask the card once.
+    if card.uuid is None:
+        res = card.transmit_recv(0x00, Constants.Ins.GetUUID, 0x00, 0x00)
+        assert_ok(res)
+
+        assert len(res.data) == 16
+        card.uuid = bytes(res.data)
+    return card.uuid
+
+def write_file(card, filename, contents, verbose = True):
+    """
+    Fills the tester's filename and file buffers and flushes them to a file.
+    A workload trace on the card gets one WRITE_FILE_DATA record for it
+    rather than the APDUs.
+    """
+    if verbose:
+        print('writing contents to', filename)
+        print(contents[:64])
+
+    trace = card.trace
+    if trace is None:
+        return _write_file(card, filename, contents)
+    card.trace = None
+    start = time.monotonic()
+    sw = 0x9000
+    try:
+        _write_file(card, filename, contents)
+    except SmartCardError as e:
+        sw = e.code
+        raise
+    finally:
+        card.trace = trace
+        trace.write_file_data(filename, contents, sw, time.monotonic() - start)
+
+def _write_file(card, filename, contents):
+    buffers = [(TESTER_FILENAME_ID, filename), (TESTER_FILE_ID, contents)]
+    # The buffers are independent, so fill whichever one is still selected
+    # first and save a SELECT per file.
+    if card.selected_file == TESTER_FILE_ID:
+        buffers.reverse()
+
+    for file_id, data in buffers:
+        card.select_file(file_id)
+        res = card.transmit_recv(0x00, Constants.Ins.WriteBinary, 0x00, 0x00, data)
+        assert_ok(res)
+
+    # flush
+    res = card.transmit_recv(0x00, Constants.Ins.WriteFile, 0x00, 0x00)
     assert_ok(res)
@@ -0,0 +1,251 @@
+import sys
+import time
+import random
+import struct
+import argparse
+import binascii
+
+from util import SmartCardDevice, SmartCardError, select, reset_fs, write_file
+
+# Binary traces of the storage workload, to rerun the same writes on another
+# firmware build and compare.
+#
+# A trace is a header (magic, version) followed by records, each a fixed
+# RECORD struct, then the filename and any inline data:
+#   WRITE_FILE       filename, length, content seed (contents regenerated from the seed)
+#   WRITE_FILE_DATA  filename, inline contents (util.write_file with a trace on the card)
+#   REFORMAT
+#   COMMAND          cla/ins/p1/p2, inline data, any other APDU
+# with the status word and latency seen when it was recorded.  Files are read
+# and written one record at a time, so traces can be longer than memory.
+#
+#   python3 workload_trace.py generate stress.trace --seed 1 --files 5000
+#   python3 workload_trace.py replay stress.trace --record build-a.trace
+#   python3 workload_trace.py compare build-a.trace build-b.trace
+
+MAGIC = b'S2TR'
+VERSION = 1
+HEADER = struct.Struct('<4sBxxx')
+# op, cla, ins, p1, p2, filename length, sw, length, seed, latency in us
+RECORD = struct.Struct('<BBBBBBHIQI')
+
+WRITE_FILE = 1
+WRITE_FILE_DATA = 2
+REFORMAT = 3
+COMMAND = 4
+
+OP_NAMES = {WRITE_FILE: 'write file', WRITE_FILE_DATA: 'write file data', REFORMAT: 'reformat', COMMAND: 'command'}
+
+def contents(seed, length):
+    """
+    The file contents a WRITE_FILE record stands for.
+    """
+    return random.Random(seed).randbytes(length)
+
+class Record():
+    __slots__ = ('op', 'cla', 'ins', 'p1', 'p2', 'filename', 'length', 'seed', 'data', 'sw', 'latency')
+
+    def __init__(self, op, filename = b'', length = 0, seed = 0, data = b'', sw = 0, latency = 0.0, cla = 0, ins = 0, p1 = 0, p2 = 0):
+        self.op = op
+        self.cla = cla
+        self.ins = ins
+        self.p1 = p1
+        self.p2 = p2
+        self.filename = filename
+        self.length = length
+        self.seed = seed
+        self.data = data
+        self.sw = sw
+        self.latency = latency
+
+    def contents(self):
+        if self.op == WRITE_FILE:
+            return contents(self.seed, self.length)
+        return self.data
+
+class TraceWriter():
+
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(HEADER.pack(MAGIC, VERSION))
+
+    def write(self, record):
+        inline = record.data if record.op in (WRITE_FILE_DATA, COMMAND) else b''
+        length = len(inline) if inline else record.length
+        self.f.write(RECORD.pack(record.op, record.cla, record.ins, record.p1, record.p2, len(record.filename),
+                record.sw, length, record.seed, min(int(record.latency * 1e6), 0xffffffff)))
+        self.f.write(record.filename)
+        self.f.write(inline)
+
+    def write_file(self, filename, length, seed, sw, latency):
+        self.write(Record(WRITE_FILE, bytes(filename), length, seed, sw = sw, latency = latency))
+
+    def write_file_data(self, filename, data, sw, latency):
+        self.write(Record(WRITE_FILE_DATA, bytes(filename), data = bytes(data), sw = sw, latency = latency))
+
+    def reformat(self, sw, latency):
+        self.write(Record(REFORMAT, sw = sw, latency = latency))
+
+    def command(self, cla, ins, p1, p2, data, sw, latency):
+        """
+        Duck-typed SmartCardDevice.trace hook, every APDU outside of
+        util.write_file becomes a COMMAND record.
+        """
+        self.write(Record(COMMAND, data = bytes(data), sw = sw, latency = latency, cla = cla, ins = ins, p1 = p1, p2 = p2))
+
+    def close(self):
+        self.f.close()
+
+def read_trace(path):
+    """
+    Yields the records of a trace one at a time.
+    """
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} trace")
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            op, cla, ins, p1, p2, name_length, sw, length, seed, latency = RECORD.unpack(header)
+            filename = f.read(name_length)
+            data = f.read(length) if op in (WRITE_FILE_DATA, COMMAND) else b''
+            yield Record(op, filename, length, seed, data, sw, latency / 1e6, cla, ins, p1, p2)
+
+def generate(path, seed, files, sizes, name_length, reformat = True):
+    """
+    A stress trace drawn from `seed`: the same files write_random.py would write.
+    """
+    from write_random import parse_sizes
+    sizes = parse_sizes(sizes)
+    rng = random.Random(seed)
+    trace = TraceWriter(path)
+    if reformat:
+        trace.reformat(0, 0)
+    for _ in range(files):
+        fn_len = rng.randint(*name_length)
+        file_len = sizes(rng)
+        filename = binascii.hexlify(rng.randbytes(fn_len))
+        trace.write_file(filename, file_len, rng.getrandbits(64), 0, 0)
+    trace.close()
+
+def replay_record(card, record):
+    """
+    Runs one record against the card, returns its status word.
+    """
+    try:
+        # Only goes to the card if the selection was lost.
+        select(card)
+        if record.op in (WRITE_FILE, WRITE_FILE_DATA):
+            write_file(card, record.filename, record.contents(), verbose = False)
+        elif record.op == REFORMAT:
+            reset_fs(card)
+        elif record.op == COMMAND:
+            return card.transmit_recv(record.cla, record.ins, record.p1, record.p2, record.data).sw
+        return 0x9000
+    except SmartCardError as e:
+        return e.code
+
+def replay(card, path, record_path = None, stop_on_full = False):
+    """
+    Drives `card` through a trace as fast as it accepts, optionally recording
+    what happened (same records, new status words and latencies).
+    """
+    out = TraceWriter(record_path) if record_path else None
+    count = mismatches = 0
+    start = time.monotonic()
+    try:
+        for record in read_trace(path):
+            op_start = time.monotonic()
+            sw = replay_record(card, record)
+            latency = time.monotonic() - op_start
+            count += 1
+            # Generated traces carry no status words yet.
+            if record.sw and sw != record.sw:
+                mismatches += 1
+                print(f"record {count}: {OP_NAMES[record.op]} {record.filename.decode()} returned {sw:04x}, recorded {record.sw:04x}")
+            if out is not None:
+                record.sw, record.latency = sw, latency
+                out.write(record)
+            if stop_on_full and sw == 0x6a84:
+                print(f"Full at record {count}")
+                break
+    finally:
+        if out is not None:
+            out.close()
+    took = time.monotonic() - start
+    print(f"Replayed {count} records in {took:.1f} s, {mismatches} status word mismatches")
+    return mismatches
+
+def summarize(path):
+    ops = {}
+    for record in read_trace(path):
+        stats = ops.setdefault(record.op, [0, 0, 0.0, {}])
+        stats[0] += 1
+        stats[1] += record.length if record.op != COMMAND else len(record.data)
+        stats[2] += record.latency
+        stats[3][record.sw] = stats[3].get(record.sw, 0) + 1
+    return ops
+
+def compare(a_path, b_path):
+    """
+    Lines up two recordings of the same trace, record by record.
+    """
+    a_total = b_total = 0.0
+    count = 0
+    differing = 0
+    slowest = []
+    for a, b in zip(read_trace(a_path), read_trace(b_path)):
+        count += 1
+        if (a.op, a.filename, a.length, a.seed, a.data) != (b.op, b.filename, b.length, b.seed, b.data):
+            raise ValueError(f"record {count} differs, these are recordings of different traces")
+        if a.sw != b.sw:
+            differing += 1
+            print(f"record {count}: {OP_NAMES[a.op]} {a.filename.decode()} {a.sw:04x} -> {b.sw:04x}")
+        a_total += a.latency
+        b_total += b.latency
+        slowest.append((b.latency - a.latency, count, OP_NAMES[a.op]))
+    slowest.sort(reverse = True)
+    print(f"{count} records, {differing} with different status words")
+    print(f"total latency {a_total:.2f} s -> {b_total:.2f} s ({(b_total - a_total) / a_total * 100 if a_total else 0:+.1f}%)")
+    for delta, index, name in slowest[:5]:
+        print(f"  record {index} ({name}) {delta * 1000:+.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generate, replay and compare storage workload traces.")
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    p = commands.add_parser('generate', help = "write a stress trace from a seed")
+    p.add_argument('path')
+    p.add_argument('--seed', type = int, required = True)
+    p.add_argument('--files', type = int, default = 10 * 1000)
+    p.add_argument('--sizes', default = 'uniform:16:2048', help = "as for write_random.py (default: %(default)s)")
+    p.add_argument('--name-length', default = '6:12', help = "random filename bytes, MIN:MAX (default: %(default)s)")
+    p.add_argument('--keep-fs', action = 'store_true', help = "don't start the trace with a reformat")
+
+    p = commands.add_parser('replay', help = "run a trace against the first device")
+    p.add_argument('path')
+    p.add_argument('--record', help = "record the replay as a trace, with this run's status words and latencies")
+    p.add_argument('--stop-on-full', action = 'store_true', help = "stop at the first 0x6a84")
+
+    p = commands.add_parser('show', help = "summarize a trace")
+    p.add_argument('path')
+
+    p = commands.add_parser('compare', help = "compare two recordings of the same trace")
+    p.add_argument('a')
+    p.add_argument('b')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        low, _, high = args.name_length.partition(':')
+        generate(args.path, args.seed, args.files, args.sizes, (int(low), int(high or low)), not args.keep_fs)
+    elif args.command == 'replay':
+        card = next(SmartCardDevice.list_devices())
+        sys.exit(1 if replay(card, args.path, args.record, args.stop_on_full) else 0)
+    elif args.command == 'show':
+        for op, (count, length, latency, sws) in summarize(args.path).items():
+            status = ', '.join(f'{sw:04x}: {n}' for sw, n in sorted(sws.items()))
+            print(f'{OP_NAMES[op]:16} {count:7} records {length:10} bytes {latency:8.2f} s  ({status})')
+    elif args.command == 'compare':
+        compare(args.a, args.b)
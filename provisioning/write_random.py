@@ -1,99 +1,305 @@
 import sys
 import os
-import binascii
+import json
 import random
 import time
+import logging
+import argparse
+import binascii
 
-from cbor2 import dumps, loads
+from apdu_stats import print_summary_at_exit
+from util import Constants, SmartCardDevice, select, reset_fs, SmartCardError, get_uuid, write_file
+from workload_trace import TraceWriter, contents
 
-from util import Constants, SmartCardDevice, assert_ok, select, reset_fs, assert_not_ok, SmartCardError
-from cert_gen import generate_cert
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.asymmetric import ed25519
+# Filesystem benchmark: writes random files to the device until it is full
+# (0x6a84) or --files have been written, and measures
+#   - bytes/s and files/s for every --window files
+#   - WRITE FILE latency against how much has been written (how littlefs
+#     slows down as it fills)
+#   - capacity when the device runs out of space
+# Results go to --output as JSON; --compare checks them against an earlier
+# run, e.g. of the previous firmware build.  --record writes the run as a
+# trace that workload_trace.py can replay on another build.
+#
+#   python3 write_random.py --seed 1 --sizes uniform:16:2048 --output new.json --compare old.json
 
+def parse_sizes(spec):
+    """
+    File size distribution from a spec: fixed:N, uniform:MIN:MAX,
+    choice:A,B,C or lognormal:MU:SIGMA:MAX.  Returns rng -> size.
+    """
+    kind, _, params = spec.partition(':')
+    if kind == 'fixed':
+        size = int(params)
+        return lambda rng: size
+    if kind == 'uniform':
+        low, high = (int(p) for p in params.split(':'))
+        return lambda rng: rng.randint(low, high)
+    if kind == 'choice':
+        sizes = [int(p) for p in params.split(',')]
+        return lambda rng: rng.choice(sizes)
+    if kind == 'lognormal':
+        mu, sigma, high = params.split(':')
+        return lambda rng: max(1, min(int(high), int(rng.lognormvariate(float(mu), float(sigma)))))
+    raise ValueError(f"Unknown size distribution {spec}")
 
-def write_random_file(card):
+def random_files(rng = None, sizes = parse_sizes('uniform:16:2048'), name_length = (6, 12)):
+    """
+    Yields (filename, file length, contents seed) for random files.  Only
+    draws from `rng`, so a seeded rng gives the same sequence whatever the
+    card answers.
+    """
+    rng = rng or random.Random()
     while True:
-        tester_filename_id = b'\xe1\x01'
-        tester_file_id = b'\xe1\x02'
+        fn_len = rng.randint(*name_length)
+        file_len = sizes(rng)
+        filename = binascii.hexlify(rng.randbytes(fn_len))
+        yield (filename, file_len, rng.getrandbits(64))
+
+def write_one_file(card, filename, file_len, seed, verbose = True, trace = None):
+    """
+    Writes one file with contents from `seed`, which is all a `trace` has to keep.
+    """
+    start = time.monotonic()
+    try:
+        write_file(card, filename, contents(seed, file_len), verbose)
+    except SmartCardError as e:
+        if trace is not None:
+            trace.write_file(filename, file_len, seed, e.code, time.monotonic() - start)
+        raise
+    if trace is not None:
+        trace.write_file(filename, file_len, seed, 0x9000, time.monotonic() - start)
+
+def write_random_file(card, rng = None, sizes = parse_sizes('uniform:16:2048'), name_length = (6, 12), verbose = True, trace = None):
+    """
+    Writes a random file per iteration, yielding (filename length, file length).
+    """
+    for filename, file_len, seed in random_files(rng, sizes, name_length):
+        write_one_file(card, filename, file_len, seed, verbose, trace)
+        yield (len(filename) // 2, file_len)
 
-        fn_len = random.randint(6,12)
-        file_len = random.randint(16, 2048)
-        filename = binascii.hexlify(os.urandom(fn_len))
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
 
-        contents = os.urandom(file_len)
+class WriteFileTimer():
+    """
+    Duck-typed APDU recorder (see apdu_stats.py) that keeps WRITE FILE
+    latencies and passes every record on to `forward`, if any.
+    """
 
-        print('writing contents to', filename)
-        print(contents[:64])
+    def __init__(self, forward = None):
+        self.forward = forward
+        self.latencies = []
 
-        # Select filename buffer
-        res = card.transmit_recv(0x00, Constants.Ins.Select, 0x00, 0x00, tester_filename_id)
-        assert_ok(res)
+    def record(self, ins, size, sw, start, end):
+        if ins == Constants.Ins.WriteFile and sw == 0x9000:
+            self.latencies.append(end - start)
+        if self.forward is not None:
+            self.forward.record(ins, size, sw, start, end)
 
-        # Write filename
-        res = card.transmit_recv(0x00, Constants.Ins.WriteBinary, 0x00, 0x00, filename)
-        assert_ok(res)
+class Benchmark():
 
-        # Select file buffer
-        res = card.transmit_recv(0x00, Constants.Ins.Select, 0x00, 0x00, tester_file_id)
-        assert_ok(res)
+    def __init__(self, card, args, trace = None):
+        self.card = card
+        self.args = args
+        self.trace = trace
+        self.rng = random.Random(args.seed)
+        self.timer = WriteFileTimer(SmartCardDevice.stats)
+        # An instance attribute, only this card reports to the timer.
+        card.stats = self.timer
+        self.windows = []
+        self.files = 0
+        self.bytes = 0
+        self.name_bytes = 0
+        self.lost_selection = 0
+        self.retries = []
+        self.capacity = None
 
-        # Write file contents
-        res = card.transmit_recv(0x00, Constants.Ins.WriteBinary, 0x00, 0x00, contents)
-        assert_ok(res)
+    def window(self, start, files, written):
+        took = time.monotonic() - start
+        latencies = self.timer.latencies
+        self.timer.latencies = []
+        self.windows.append({
+            'files': self.files,
+            'bytes': self.bytes,
+            'seconds': took,
+            'bytes_per_s': written / took,
+            'files_per_s': files / took,
+            'write_file_ms_p50': percentile(latencies, 50) * 1000,
+            'write_file_ms_p95': percentile(latencies, 95) * 1000,
+            'write_file_ms_max': max(latencies) * 1000,
+        })
+        w = self.windows[-1]
+        print(f"{self.files:7} files {self.bytes:9} bytes  {w['bytes_per_s']:8.0f} B/s {w['files_per_s']:6.1f} files/s"
+              f"  WRITE FILE p50 {w['write_file_ms_p50']:6.1f} ms p95 {w['write_file_ms_p95']:6.1f} ms", flush = True)
 
-        # flush
-        res = card.transmit_recv(0x00, Constants.Ins.WriteFile, 0x00, 0x00)
-        assert_ok(res)
-        yield (fn_len, file_len)
+    def run(self):
+        args = self.args
+        sizes = parse_sizes(args.sizes)
+        files = random_files(self.rng, sizes, args.name_length)
+        pending = None
+        start = time.monotonic()
+        window_start, window_files, window_bytes = start, 0, 0
+        while self.files < args.files:
+            # A file the card lost its selection in is written again, so the
+            # same --seed writes the same files.
+            pending = pending or next(files)
+            filename, f, seed = pending
+            try:
+                # Both only reach the card after the selection was lost or on the first file.
+                select(self.card)
+                get_uuid(self.card)
+                write_one_file(self.card, filename, f, seed, verbose = False, trace = self.trace)
+            except SmartCardError as e:
+                if e.code == 0x6a82:
+                    # Thanks PCSC.. the device forgot its selection, so the
+                    # next select() goes to the card again.
+                    self.lost_selection += 1
+                    self.retries.append({'file': self.files, 'filename': filename.decode(), 'length': f})
+                    continue
+                elif e.code == 0x6a84:
+                    # not enough memory
+                    self.capacity = {'files': self.files, 'bytes': self.bytes, 'name_bytes': self.name_bytes}
+                    print(f"Full after {self.files} files, {self.bytes} bytes")
+                    break
+                raise
+            pending = None
+            fn = len(filename) // 2
+            self.files += 1
+            self.bytes += f
+            self.name_bytes += fn
+            window_files += 1
+            window_bytes += f
+            if window_files == args.window:
+                self.window(window_start, window_files, window_bytes)
+                window_start, window_files, window_bytes = time.monotonic(), 0, 0
+        if window_files and self.timer.latencies:
+            self.window(window_start, window_files, window_bytes)
+        self.elapsed = time.monotonic() - start
 
-def get_uuid(card,):
-    # flush
-    res = card.transmit_recv(0x00, Constants.Ins.GetUUID, 0x00, 0x00)
-    assert_ok(res)
+    def results(self):
+        args = self.args
+        if self.capacity is not None:
+            # Now that the capacity is known, place each window on the fill curve.
+            for w in self.windows:
+                w['fill'] = w['bytes'] / self.capacity['bytes']
+        p50s = [w['write_file_ms_p50'] for w in self.windows]
+        return {
+            'label': args.label,
+            'config': {
+                'sizes': args.sizes,
+                'name_length': list(args.name_length),
+                'seed': args.seed,
+                'files': args.files,
+                'window': args.window,
+            },
+            'files': self.files,
+            'bytes': self.bytes,
+            'seconds': self.elapsed,
+            'bytes_per_s': self.bytes / self.elapsed,
+            'files_per_s': self.files / self.elapsed,
+            'write_file_ms_p50': percentile(p50s, 50),
+            'write_file_ms_p50_last_window': p50s[-1] if p50s else None,
+            'lost_selection': self.lost_selection,
+            'retries': self.retries,
+            'framing': self.card.framing.to_json(),
+            'capacity': self.capacity,
+            'windows': self.windows,
+        }
 
-    assert len(res[:-2]) == 16
-    return res[:-2]
+# (result key, True if bigger is better)
+COMPARED = [
+    ('bytes_per_s', True),
+    ('files_per_s', True),
+    ('write_file_ms_p50', False),
+    ('write_file_ms_p50_last_window', False),
+    ('capacity_bytes', True),
+    ('capacity_files', True),
+]
+
+def compare(baseline, results, tolerance):
+    """
+    Prints each metric against the baseline, returns the regressed ones.
+    """
+    if baseline['config'] != results['config']:
+        print(f"warning: configs differ, {baseline['config']} vs {results['config']}")
+    regressions = []
+    print(f'{"metric":30} {baseline.get("label") or "baseline":>14} {results.get("label") or "this run":>14} {"change":>8}')
+    for key, higher_is_better in COMPARED:
+        def value(r):
+            if key.startswith('capacity_'):
+                return (r['capacity'] or {}).get(key[len('capacity_'):])
+            return r.get(key)
+        old, new = value(baseline), value(results)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressions.append(key)
+        print(f'{key:30} {old:14.2f} {new:14.2f} {change:+7.1f}%{flag}')
+    return regressions
+
+def name_length(spec):
+    low, _, high = spec.partition(':')
+    return (int(low), int(high or low))
 
 if __name__ == "__main__":
-    if len(sys.argv) != 1:
-        print('Usage: %s ' % sys.argv[0])
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description = "Benchmark the device filesystem with random files.")
+    parser.add_argument('--files', type = int, default = 10 * 1000, help = "stop after this many files (default: %(default)s)")
+    parser.add_argument('--sizes', default = 'uniform:16:2048', help = "file size distribution: fixed:N, uniform:MIN:MAX, choice:A,B,.. or lognormal:MU:SIGMA:MAX (default: %(default)s)")
+    parser.add_argument('--name-length', type = name_length, default = (6, 12), help = "random filename bytes, MIN:MAX (default: 6:12)")
+    parser.add_argument('--seed', type = int, help = "seed for sizes, names and contents (default: random, recorded in the results)")
+    parser.add_argument('--window', type = int, default = 100, help = "files per throughput sample (default: %(default)s)")
+    parser.add_argument('--keep-fs', action = 'store_true', help = "don't reformat the filesystem before and after")
+    parser.add_argument('--label', help = "name for this run in the results, e.g. the firmware build")
+    parser.add_argument('--output', help = "write the results as JSON")
+    parser.add_argument('--compare', help = "results JSON of an earlier run to compare against")
+    parser.add_argument('--tolerance', type = float, default = 10, help = "percent change that counts as a regression (default: %(default)s)")
+    parser.add_argument('--record', help = "write the run as a trace for workload_trace.py replay")
+    args = parser.parse_args()
+    if args.seed is None:
+        args.seed = random.randrange(2**32)
 
+    # LOGLEVEL=DEBUG traces every APDU
+    logging.basicConfig(level = os.environ.get('LOGLEVEL', 'WARNING'))
+    # SOLO2_APDU_STATS=<prefix> times every APDU
+    print_summary_at_exit(SmartCardDevice.stats)
 
     card = next(SmartCardDevice.list_devices())
 
+    trace = TraceWriter(args.record) if args.record else None
 
     print ("Selecting tester..")
     select(card)
+    if not args.keep_fs:
+        start = time.monotonic()
+        reset_fs(card)
+        if trace is not None:
+            trace.reformat(0x9000, time.monotonic() - start)
+
+    print(f"Writing random files, seed {args.seed}..")
+    benchmark = Benchmark(card, args, trace)
+    benchmark.run()
+    if trace is not None:
+        trace.close()
+    results = benchmark.results()
+    print(f"{results['files']} files, {results['bytes']} bytes in {results['seconds']:.1f} s:"
+          f" {results['bytes_per_s']:.0f} B/s, {results['files_per_s']:.1f} files/s")
+
+    if not args.keep_fs:
+        select(card)
+        reset_fs(card)
 
-    print("Writing random files..")
-    fn_sum = 0
-    file_sum = 0
-    count = 0
-    for i in range(0,10* 1000):
-        try:
-            select(card)
-            get_uuid(card)
-            (fn, f) = next(write_random_file(card,))
-            fn_sum += fn
-            file_sum += f
-            count += 1
-            print(i)
-        except SmartCardError as e:
-            if e.code == 0x6a82:
-                # Thanks PCSC..
-                pass
-            elif e.code == 0x6a84:
-                # not enough memory
-                print()
-                print(f"reset on {fn_sum}, {file_sum}.  {count} files")
-                print()
-                time.sleep(1)
-                select(card)
-                res = card.transmit_recv(0x00, Constants.Ins.ReformatFs, 0x00, 0x00)
-                assert_ok(res)
-                fn_sum = 0
-                file_sum = 0
-                count = 0
-                sys.exit(1)
\ No newline at end of file
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import threading
+from collections import deque
+
+# Captures the firmware's semihosting output (JLinkGDBServer's telnet port
+# with `monitor semihosting IOClient 3`, or anything piped in) to a log file.
+# Each line is stamped with time.monotonic() when its first byte arrived, the
+# clock control.py's daemon and provisioning/apdu_stats.py use, so the log
+# lines up with their timestamps.
+#
+# A reader thread only splits and stamps lines into a bounded ring buffer and
+# a flush thread writes them out, so a firmware that logs heavily never waits
+# on the disk.  If the writer falls behind the oldest lines are dropped and
+# the log says how many.
+#
+#   python3 semihosting.py --output semihosting.log &
+#   python3 flash.py run | python3 semihosting.py --source - --output semihosting.log
+
+SOURCE = os.environ.get('SOLO2_SEMIHOSTING', 'tcp:localhost:2333')
+
+# Lines held for the flush thread.
+BUFFER_LINES = 100000
+# A line without a newline is cut after this many bytes.
+MAX_LINE = 4096
+
+class Collector():
+    """
+    Ring buffer of (monotonic timestamp, line) with a background thread that
+    appends it to `path` every `interval` seconds.
+    """
+
+    def __init__(self, path, size = BUFFER_LINES, interval = .5):
+        self.path = path
+        self.interval = interval
+        self.lines = deque(maxlen = size)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.count = 0
+        self.partial = b''
+        self.partial_start = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self._flush_loop, name = 'semihosting-flush', daemon = True)
+        self.thread.start()
+
+    def feed(self, data, now = None):
+        """
+        Takes bytes as they arrive, in pieces of any size.
+        """
+        now = time.monotonic() if now is None else now
+        if self.partial_start is None and data:
+            self.partial_start = now
+        data = self.partial + data
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._add(self.partial_start, line)
+            self.partial_start = now
+        while len(self.partial) > MAX_LINE:
+            self._add(self.partial_start, self.partial[:MAX_LINE])
+            self.partial = self.partial[MAX_LINE:]
+        if not self.partial:
+            self.partial_start = None
+
+    def _add(self, stamp, line):
+        # Full means the writer is behind, the append pushes out the oldest line.
+        if len(self.lines) == self.lines.maxlen:
+            with self.dropped_lock:
+                self.dropped += 1
+        self.lines.append((stamp, line.rstrip(b'\r')))
+        self.count += 1
+
+    def flush(self):
+        lines = self.lines
+        out = []
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            out.append(f'[{time.monotonic():.6f}] semihosting.py: dropped {dropped} lines\n')
+        while lines:
+            stamp, line = lines.popleft()
+            out.append(f'[{stamp:.6f}] {line.decode("utf8", "replace")}\n')
+        if out:
+            with open(self.path, 'a') as f:
+                f.writelines(out)
+        return dropped
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        if self.partial:
+            self._add(self.partial_start, self.partial)
+            self.partial = b''
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+def read_stream(f, collector, stopped):
+    while not stopped.is_set():
+        data = os.read(f.fileno(), 65536)
+        if not data:
+            return
+        collector.feed(data)
+
+def read_tcp(address, collector, stopped, retry = .2):
+    """
+    Reads from the telnet port until stopped, reconnecting whenever the
+    server isn't there (yet, or any more).
+    """
+    host, _, port = address.rpartition(':')
+    while not stopped.is_set():
+        try:
+            sock = socket.create_connection((host or 'localhost', int(port)), timeout = 1)
+        except OSError:
+            stopped.wait(retry)
+            continue
+        sock.settimeout(.5)
+        with sock:
+            while not stopped.is_set():
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                if not data:
+                    break
+                collector.feed(data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Timestamp and log the firmware's semihosting output.")
+    parser.add_argument('--source', default = SOURCE, help = "tcp:[host:]port, or - for stdin (default: %(default)s)")
+    parser.add_argument('--output', default = 'semihosting.log', help = "log file (default: %(default)s)")
+    parser.add_argument('--append', action = 'store_true', help = "append to the log instead of starting it afresh")
+    parser.add_argument('--buffer', type = int, default = BUFFER_LINES, help = "lines held before the oldest are dropped (default: %(default)s)")
+    parser.add_argument('--interval', type = float, default = .5, help = "seconds between writes (default: %(default)s)")
+    args = parser.parse_args()
+
+    if not args.append:
+        open(args.output, 'w').close()
+    collector = Collector(args.output, args.buffer, args.interval)
+    stopped = threading.Event()
+    # The runner stops background steps with SIGTERM, keep what was collected.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    if args.source == '-':
+        reader = threading.Thread(target = read_stream, args = (sys.stdin.buffer, collector, stopped), daemon = True)
+    elif args.source.startswith('tcp:'):
+        reader = threading.Thread(target = read_tcp, args = (args.source[4:], collector, stopped), daemon = True)
+    else:
+        parser.error(f"unknown source {args.source}")
+    reader.start()
+
+    try:
+        while reader.is_alive() and not stopped.is_set():
+            reader.join(.5)
+    except KeyboardInterrupt:
+        pass
+    stopped.set()
+    collector.close()
+    print(f"semihosting.py: {collector.count} lines to {args.output}", file = sys.stderr)
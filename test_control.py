@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+
+import pytest
+
+pigpio = pytest.importorskip('pigpio')
+
+from pigpiod_stub import PigpiodStub
+from control_client import send_commands
+from control import Pins
+
+# Runs `control.py serve` against pigpiod_stub.py, the way CI drives the rig.
+#
+#   python3 -m pytest test_control.py
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture
+def stub():
+    server = PigpiodStub(('localhost', 0))
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def daemon(stub, tmp_path):
+    path = str(tmp_path / 'control.sock')
+    env = dict(os.environ, PIGPIO_ADDR = 'localhost', PIGPIO_PORT = str(stub.server_address[1]))
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, 'control.py'), 'serve', path], env = env,
+            stdout = subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        assert process.poll() is None, 'control.py serve exited'
+        assert time.monotonic() < deadline, 'control.py serve did not start'
+        time.sleep(.02)
+    yield path
+    process.terminate()
+    process.wait()
+
+def level(stub, pin):
+    return (stub.state.levels >> pin) & 1
+
+def test_power_commands(stub, daemon):
+    assert send_commands(['on'], daemon)[0].startswith('ok')
+    assert level(stub, Pins.Power) == 1
+    assert send_commands(['off'], daemon)[0].startswith('ok')
+    assert level(stub, Pins.Power) == 0
+    assert send_commands(['reboot'], daemon)[0].startswith('ok')
+    assert level(stub, Pins.Power) == 1
+
+def test_button_pulse(stub, daemon):
+    replies = send_commands(['reset-buttons', 'toggle-button-1'], daemon)
+    assert all(reply.startswith('ok') for reply in replies)
+    assert level(stub, Pins.Button1) == 1
+    assert stub.state.modes[Pins.Button1] == 1
+
+def test_pins_driven_by_someone_else(stub, daemon):
+    # Another control.py turned power off between two daemon commands.
+    assert send_commands(['on'], daemon)[0].startswith('ok')
+    stub.state.change_levels(0, 1 << Pins.Power)
+    assert send_commands(['on'], daemon)[0].startswith('ok')
+    assert level(stub, Pins.Power) == 1
+
+def test_errors_are_reported(daemon):
+    replies = send_commands(['no-such-command', 'on'], daemon)
+    assert replies[0].startswith('error')
+    assert replies[1].startswith('ok')
@@ -0,0 +1,109 @@
+import struct
+import threading
+
+import pytest
+
+from flash import GdbRemote, FlashState, crc32, load_segments, program, verify
+from gdbserver_stub import GdbServerStub, FLASH
+
+# Flashes ELF images into gdbserver_stub.py, the way CI programs the DUT.
+#
+#   python3 -m pytest test_flash.py
+
+PAGE = FLASH[2]
+
+# (p_vaddr, p_paddr, contents): .text with bytes that need escaping, .data
+# linked in RAM but loaded from flash, a RAM only segment and .bss.
+SEGMENTS = [
+    (0x0, 0x0, bytes(range(256)) * 390 + b'#$}*' * 50),
+    (0x20000000, 0x20000, b'data' * 750),
+    (0x20001000, 0x20001000, b'ram' * 100),
+    (0x20002000, 0x20002000, b''),
+]
+
+def write_elf(path, segments):
+    """
+    Little endian ELF32 with a PT_LOAD program header per segment.
+    """
+    phoff = 52
+    offset = phoff + 32 * len(segments)
+    header = b'\x7fELF\x01\x01\x01' + b'\0' * 9 + struct.pack('<HHIIIIIHHHHHH', 2, 40, 1, 0, phoff, 0, 0, 52, 32, len(segments), 40, 0, 0)
+    headers, body = b'', b''
+    for vaddr, paddr, data in segments:
+        headers += struct.pack('<8I', 1, offset + len(body), vaddr, paddr, len(data), len(data) or 64, 5, 4)
+        body += data
+    with open(path, 'wb') as f:
+        f.write(header + headers + body)
+
+def merged(ranges):
+    """
+    [(address, length)] as sorted, coalesced [(start, end)].
+    """
+    result = []
+    for address, length in sorted(ranges):
+        if result and address <= result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], address + length))
+        else:
+            result.append((address, address + length))
+    return result
+
+@pytest.fixture
+def stub():
+    server = GdbServerStub(('localhost', 0))
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def image(tmp_path):
+    path = str(tmp_path / 'image.elf')
+    write_elf(path, SEGMENTS)
+    return load_segments(path)
+
+def flash(stub, image, state, force = False):
+    remote = GdbRemote(f'localhost:{stub.server_address[1]}')
+    try:
+        return program(remote, image, state, 'dut', force)
+    finally:
+        remote.detach()
+
+def test_crc32_is_qcrc():
+    # CRC-32/MPEG-2 check value
+    assert crc32(b'123456789') == 0x0376e6e7
+
+def test_ranges_match_segments(stub, image, tmp_path):
+    assert [address for address, _ in image] == [0x0, 0x20000, 0x20001000]
+    assert flash(stub, image, FlashState(str(tmp_path / 'state.json')))
+
+    in_flash = [(address, len(data)) for address, data in image if address < FLASH[1]]
+    pages = [(address - address % PAGE, -(-(address % PAGE + length) // PAGE) * PAGE) for address, length in in_flash]
+    assert merged(stub.target.erases) == merged(pages)
+    assert merged(stub.target.writes) == merged((address, len(data)) for address, data in image)
+    for address, data in image:
+        memory, offset = stub.target.region(address, len(data))
+        assert memory[offset:offset + len(data)] == data
+
+def test_crc_catches_corruption(stub, image, tmp_path):
+    state = FlashState(str(tmp_path / 'state.json'))
+    assert flash(stub, image, state)
+    remote = GdbRemote(f'localhost:{stub.server_address[1]}')
+    try:
+        assert verify(remote, image) == []
+        stub.target.flash[0x20000 + 1234] ^= 0x01
+        assert verify(remote, image) == [0x20000]
+    finally:
+        remote.detach()
+    # The state still has the image, the CRC mismatch makes it flash again.
+    assert flash(stub, image, state)
+    assert stub.target.flash[0x20000 + 1234] == image[1][1][1234]
+
+def test_second_program_is_skipped(stub, image, tmp_path):
+    state = FlashState(str(tmp_path / 'state.json'))
+    assert flash(stub, image, state)
+    erases, writes = len(stub.target.erases), len(stub.target.writes)
+    assert not flash(stub, image, state)
+    assert (len(stub.target.erases), len(stub.target.writes)) == (erases, writes)
+    assert flash(stub, image, state, force = True)
+    assert len(stub.target.erases) > erases